@@ -0,0 +1,249 @@
+"""
+Latency and throughput benchmark of the Query Quality Classifier backends, to size the hardware and
+compare them:
+    original   one query per call, padded to MAX_LENGTH, as classify_query was before run_model
+    single     run_model with one query per call (padded only to its length)
+    batched    run_model with several batch sizes
+    onnx       ONNX Runtime, fp32 and int8 (see query_quality_classifier_onnx.py), if installed
+
+The query sets are sampled from the topics, the BEIR query files and the generated variants, grouped
+by length (short, long and mixed). For each backend the report gives the cold start (import, load and
+first query in a new process), the p50/p95/p99 latency of single queries and the throughput for each
+batch size and number of threads.
+
+By default the model is a randomly initialized ALBERT with the dimensions of the real one and a
+SentencePiece tokenizer trained on the local topics, so no network is needed (the latency and
+throughput depend on the architecture, not on the weights). --model benchmarks an existing model.
+
+Example:
+    python benchmark_classifier.py --threads 1 4 --batch_sizes 8 32 128 --output classifier_benchmark.json
+    python benchmark_classifier.py --model_size tiny --queries 128 --backends original single batched
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import torch
+
+import query_quality_classifier as qqc
+
+try:
+    import onnxruntime
+    from query_quality_classifier_onnx import export_onnx, OnnxClassifier
+except ImportError:
+    onnxruntime = None
+
+
+MODEL_SIZES = {
+    # Dimensions of albert-base-v2, the base of dejanseo/Query-Quality-Classifier
+    "base": {"embedding_size": 128, "hidden_size": 768, "num_attention_heads": 12, "intermediate_size": 3072,
+             "num_hidden_layers": 12},
+    "tiny": {"embedding_size": 64, "hidden_size": 128, "num_attention_heads": 4, "intermediate_size": 256,
+             "num_hidden_layers": 4},
+}
+QUERY_FILES = ["./TREC_*_BEIR/*/*.jsonl", "./CLEF_v2/*.jsonl", "./query_variants_T07/**/*.jsonl"]
+
+
+def load_texts():
+    # Queries (titles, questions, variants) and longer texts (descriptions and narratives) of the repository
+    queries, texts = [], []
+    for path in sorted(glob.glob("./topics/*.xml")):
+        for element in ET.parse(path).getroot().iter():
+            if not element.text or not element.text.strip():
+                continue
+            if element.tag in ["title", "query", "question"]:
+                queries.append(" ".join(element.text.split()))
+            elif element.tag in ["description", "narrative", "background"]:
+                texts.append(" ".join(element.text.split()))
+    for pattern in QUERY_FILES:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        query = json.loads(line)
+                        queries.append(query.get("text") or query.get("title") or "")
+    return [query for query in queries if query], texts
+
+
+def make_query_sets(queries, texts, n, seed=0):
+    # Short (up to 6 words), long (more than 12 words, mostly sentences of the descriptions and
+    # narratives) and mixed query sets of n queries
+    rng = random.Random(seed)
+    sentences = [sentence.strip() for text in texts for sentence in text.split(". ") if sentence.strip()]
+    pool = list(dict.fromkeys(queries + sentences))
+    short = [query for query in pool if len(query.split()) <= 6]
+    long = [query for query in pool if len(query.split()) > 12]
+    return {
+        "short": [rng.choice(short) for _ in range(n)],
+        "long": [rng.choice(long) for _ in range(n)],
+        "mixed": [rng.choice(pool) for _ in range(n)],
+    }
+
+
+def build_local_model(output_dir, texts, size="base", vocab_size=8000, seed=0):
+    # Randomly initialized ALBERT for sequence classification and a SentencePiece tokenizer trained on texts
+    import sentencepiece as spm
+    from transformers import AlbertTokenizer, AlbertConfig, AlbertForSequenceClassification
+
+    corpus_path = os.path.join(output_dir, "corpus.txt")
+    with open(corpus_path, "w") as f:
+        f.write("\n".join(texts))
+    spm.SentencePieceTrainer.train(input=corpus_path, model_prefix=os.path.join(output_dir, "spiece"),
+                                   vocab_size=vocab_size, hard_vocab_limit=False, pad_id=0, unk_id=1, bos_id=2,
+                                   eos_id=3, control_symbols=["[CLS]", "[SEP]", "[MASK]"], minloglevel=2)
+    tokenizer = AlbertTokenizer(os.path.join(output_dir, "spiece.model"))
+    torch.manual_seed(seed)
+    model = AlbertForSequenceClassification(AlbertConfig(vocab_size=len(tokenizer), num_labels=2, **MODEL_SIZES[size]))
+    model_dir = os.path.join(output_dir, "model")
+    tokenizer.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+    return model_dir
+
+
+def original_classify_query(query):
+    # classify_query as it was before run_model: one query padded to MAX_LENGTH and one forward pass (the
+    # tokenizer call is the encode_plus of the original code)
+    inputs = qqc.tokenizer(query, add_special_tokens=True, max_length=qqc.MAX_LENGTH, padding='max_length',
+                           truncation=True, return_attention_mask=True, return_tensors='pt')
+    with torch.no_grad():
+        logits = qqc.model(inputs['input_ids'].to(qqc.device), attention_mask=inputs['attention_mask'].to(qqc.device)).logits
+    return torch.softmax(logits, dim=1).cpu().numpy()[0][1] * 100
+
+
+def classify_one(backend, query):
+    if backend == "original":
+        return original_classify_query(query)
+    return qqc.run_model([query], batch_size=1)[0]
+
+
+def cold_start(backend, model_path, runs=3):
+    # Seconds from the start of a new Python process to the first confidence
+    if backend in ["original", "single", "batched"]:
+        load = f"q.tokenizer, q.model, q.device = q.load_model({model_path!r})"
+    else:
+        load = f"from query_quality_classifier_onnx import load_onnx_model; q.tokenizer, q.model, q.device = load_onnx_model({model_path!r})"
+    if backend == "original":
+        code = f"import query_quality_classifier as q, benchmark_classifier as b; {load}; b.original_classify_query('can vitamin d cure covid')"
+    else:
+        code = f"import query_quality_classifier as q; {load}; q.run_model(['can vitamin d cure covid'])"
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def measure_latency(queries, backend):
+    # Single queries, one call each
+    for query in queries[:2]:
+        classify_one(backend, query)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        classify_one(backend, query)
+        latencies.append(time.perf_counter() - start)
+    return {f"latency_p{p}": float(np.percentile(latencies, p)) for p in [50, 95, 99]}
+
+
+def measure_throughput(queries, batch_size, backend):
+    if backend == "original":
+        classify_one(backend, queries[0])
+        start = time.perf_counter()
+        for query in queries:
+            original_classify_query(query)
+        return len(queries) / (time.perf_counter() - start)
+    qqc.run_model(queries[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    qqc.run_model(queries, batch_size=batch_size)
+    return len(queries) / (time.perf_counter() - start)
+
+
+def run_benchmark(backends, model_dir, onnx_paths, query_sets, threads_list, batch_sizes, latency_queries, cold_runs):
+    results = {"cold_start": {}, "latency": [], "throughput": []}
+    for backend in backends:
+        path = onnx_paths.get(backend, model_dir)
+        print(f"Cold start of {backend}...")
+        results["cold_start"][backend] = cold_start(backend, path, cold_runs)
+
+        qqc.tokenizer, qqc.model, qqc.device = qqc.load_model(model_dir)
+        for threads in threads_list:
+            torch.set_num_threads(threads)
+            if backend in onnx_paths:
+                qqc.model = OnnxClassifier(path, threads=threads)
+            for name, queries in query_sets.items():
+                print(f"{backend}, {threads} threads, {name} queries...")
+                # With one query per call, batched is the same as single
+                if backend != "batched":
+                    results["latency"].append({"backend": backend, "threads": threads, "query_set": name,
+                                               **measure_latency(queries[:latency_queries], backend)})
+                for batch_size in [1] if backend in ["original", "single"] else batch_sizes:
+                    results["throughput"].append({"backend": backend, "threads": threads, "query_set": name,
+                                                  "batch_size": batch_size,
+                                                  "queries_per_second": measure_throughput(queries, batch_size, backend)})
+    return results
+
+
+def print_results(results):
+    print(f"\n{'backend':<10} {'cold start':>10}")
+    for backend, seconds in results["cold_start"].items():
+        print(f"{backend:<10} {seconds:>9.2f}s")
+    print(f"\n{'backend':<10} {'threads':>7} {'queries':<7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for r in results["latency"]:
+        print(f"{r['backend']:<10} {r['threads']:>7} {r['query_set']:<7} {1000 * r['latency_p50']:>8.2f} "
+              f"{1000 * r['latency_p95']:>8.2f} {1000 * r['latency_p99']:>8.2f}")
+    print(f"\n{'backend':<10} {'threads':>7} {'queries':<7} {'batch':>5} {'queries/s':>10}")
+    for r in results["throughput"]:
+        print(f"{r['backend']:<10} {r['threads']:>7} {r['query_set']:<7} {r['batch_size']:>5} {r['queries_per_second']:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and throughput benchmark of the Query Quality Classifier")
+    parser.add_argument("--model", type=str, default=None, help="Model to benchmark (default: a local random ALBERT)")
+    parser.add_argument("--model_size", choices=list(MODEL_SIZES), default="base", help="Size of the local model")
+    parser.add_argument("--backends", nargs="+", choices=["original", "single", "batched", "onnx", "onnx_int8"],
+                        default=["original", "single", "batched", "onnx", "onnx_int8"])
+    parser.add_argument("--threads", nargs="+", type=int, default=sorted({1, os.cpu_count()}))
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[8, 32, 128])
+    parser.add_argument("--queries", type=int, default=256, help="Queries per query set")
+    parser.add_argument("--latency_queries", type=int, default=100, help="Single queries timed for the latency")
+    parser.add_argument("--cold_runs", type=int, default=3, help="New processes started to time the cold start")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="classifier_benchmark.json")
+    args = parser.parse_args()
+
+    backends = args.backends
+    if onnxruntime is None and any(backend.startswith("onnx") for backend in backends):
+        print("onnxruntime is not installed, skipping the ONNX backends")
+        backends = [backend for backend in backends if not backend.startswith("onnx")]
+
+    queries, texts = load_texts()
+    query_sets = make_query_sets(queries, texts, args.queries, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = args.model or build_local_model(tmp, queries + texts, args.model_size, seed=args.seed)
+        onnx_paths = {}
+        if any(backend.startswith("onnx") for backend in backends):
+            fp32_path, int8_path = export_onnx(model_dir, os.path.join(tmp, "onnx"), quantize=True)
+            onnx_paths = {backend: path for backend, path in [("onnx", fp32_path), ("onnx_int8", int8_path)]
+                          if backend in backends}
+
+        results = run_benchmark(backends, model_dir, onnx_paths, query_sets, args.threads, args.batch_sizes,
+                                args.latency_queries, args.cold_runs)
+
+    results["settings"] = {"model": args.model or f"local random ALBERT ({args.model_size})", "queries": args.queries,
+                           "cpu_count": os.cpu_count(), "torch": torch.__version__,
+                           "onnxruntime": onnxruntime.__version__ if onnxruntime else None}
+    print_results(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nReport written to {args.output}")
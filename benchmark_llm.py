@@ -0,0 +1,122 @@
+"""
+Throughput benchmark of the chatgpt.py tasks against the mock OpenAI server (mock_openai_server.py),
+or against any OpenAI-compatible endpoint given with --base_url.
+
+Each task runs end-to-end over the topics of the chosen corpora (one job per corpus, as in
+run_pipeline.py) for each number of workers, and the report gives the wall time, the throughput and
+the latency percentiles of the requests.
+
+Example:
+    python benchmark_llm.py --tasks controversy_temp evaluate evaluate_packed --workers 1 4 --latency_median 0.3
+    python benchmark_llm.py --tasks controversy_temp --grid '--samples 5 --adaptive true' --error_rate 0.02
+"""
+
+import os
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+from openai import OpenAI
+
+import chatgpt
+import run_pipeline
+from telemetry import Telemetry
+from rate_limiter import RateLimiter
+from llm_backends import Backend, BackendPool
+from mock_openai_server import start_server, add_server_arguments, get_server_options
+
+
+def run_benchmark(task, corpora, workers, base_url, args):
+    grid = run_pipeline.parse_args(["--tasks", task, "--corpora"] + corpora + shlex.split(args.grid))
+    jobs = run_pipeline.expand_grid(grid)
+    topics_files = {corpus: os.path.abspath(f"topics/topics_{corpus}.xml") for corpus in corpora}
+
+    client = OpenAI(api_key="mock", base_url=base_url, max_retries=args.max_retries)
+    chatgpt.client = BackendPool([Backend("benchmark", client)], hedge=args.hedge)
+    chatgpt.rate_limiter = RateLimiter(args.requests_per_minute) if args.requests_per_minute else None
+    chatgpt.telemetry = Telemetry()
+    chatgpt.PROMPT_LAYOUT = grid.prompt_layout
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.chdir(output_dir)
+        for d in ["controversy_results", "query_scores", "generated_passages"]:
+            os.makedirs(d, exist_ok=True)
+        start = time.time()
+        try:
+            # The tasks print every prompt and answer
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                failed = run_pipeline.run_jobs(jobs, topics_files, "manifest.jsonl", workers)
+        finally:
+            os.chdir(cwd)
+        elapsed = time.time() - start
+
+    records = chatgpt.telemetry.records
+    latencies = np.array([r["latency"] for r in records if r["error"] is None])
+    tokens = sum(r["prompt_tokens"] + r["completion_tokens"] for r in records)
+    result = {
+        "task": task,
+        "workers": workers,
+        "jobs": len(jobs),
+        "failed_jobs": len(failed),
+        "requests": len(records),
+        "errors": sum(r["error"] is not None for r in records),
+        "retry_requests": sum(r["retries"] > 0 for r in records),
+        "cache_hits": sum(bool(r["cache_hit"]) for r in records),
+        "cached_tokens": sum(r["cached_tokens"] for r in records),
+        "tokens": tokens,
+        "seconds": elapsed,
+        "requests_per_second": len(records) / elapsed,
+        "tokens_per_second": tokens / elapsed,
+    }
+    for percentile in [50, 95, 99]:
+        result[f"latency_p{percentile}"] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+    result.update(chatgpt.client.stats())
+    return result
+
+
+def print_results(results):
+    print(f"\n{'task':<22} {'workers':>7} {'requests':>8} {'errors':>6} {'retries':>7} {'seconds':>8} "
+          f"{'req/s':>7} {'tok/s':>8} {'p50':>6} {'p95':>6} {'p99':>6}")
+    for r in results:
+        percentiles = " ".join(f"{r[f'latency_p{p}']:6.3f}" if r[f'latency_p{p}'] is not None else f"{'-':>6}"
+                               for p in [50, 95, 99])
+        print(f"{r['task']:<22} {r['workers']:>7} {r['requests']:>8} {r['errors']:>6} {r['retry_requests']:>7} "
+              f"{r['seconds']:>8.2f} {r['requests_per_second']:>7.2f} {r['tokens_per_second']:>8.1f} {percentiles}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chatgpt.py tasks against a mock OpenAI server")
+    parser.add_argument("--tasks", nargs="+", choices=list(run_pipeline.TASK_PARAMS),
+                        default=["controversy_temp", "controversy_logprobs", "controversy_packed", "evaluate",
+                                 "evaluate_packed", "variants", "passages"])
+    parser.add_argument("--corpora", nargs="+", choices=["2020", "2021", "2022", "clef"], default=["2020", "2021", "2022", "clef"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 4], help="Numbers of jobs running at the same time")
+    parser.add_argument("--grid", type=str, default="",
+                        help="Extra run_pipeline.py arguments for the jobs (e.g. --grid '--samples 5')")
+    parser.add_argument("--base_url", type=str, help="Endpoint to benchmark instead of a local mock server")
+    parser.add_argument("--max_retries", type=int, default=2, help="Retries of the OpenAI client (e.g. after a 429)")
+    parser.add_argument("--hedge", action="store_true", help="Hedge slow requests (see llm_backends.py)")
+    parser.add_argument("--requests_per_minute", type=int, default=0, help="Rate limit (0 for none)")
+    parser.add_argument("--output", type=str, help="JSON file for the results")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if not base_url:
+        server, base_url = start_server(**get_server_options(args))
+
+    results = []
+    for task in args.tasks:
+        for workers in args.workers:
+            print(f"Running {task} with {workers} workers...")
+            results.append(run_benchmark(task, args.corpora, workers, base_url, args))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -1,15 +1,51 @@
 import os
-from openai import OpenAI
 import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
 import seaborn as sns
 import json
+import ast
+import re
 import configparser
 import numpy as np
 import pandas as pd
+from scipy import stats
+import time
+import queue
+import threading
+from datetime import datetime
+from telemetry import Telemetry
+from llm_backends import create_client
 
 
-def get_prompt_variants(description, role=False, narrative=None, chain_of_thought=1, n=5):
+# gpt-4o limits, used to size the packed prompts
+CONTEXT_WINDOW = 128000
+MAX_TOKENS = 1000
+
+# Ask for JSON-schema constrained answers in the tasks that parse JSON (run_pipeline.py sets it per job)
+STRUCTURED_OUTPUTS = True
+
+# "prefix": the instructions come first and the query-specific lines last, so every prompt of a task
+# starts with the same text and the provider (or local backend) can reuse its cached prefix.
+# "legacy": the original order, with the query in the middle of the instructions (the layout of the
+# published results, kept as the default until compare_prompt_layouts shows that both give the same scores)
+PROMPT_LAYOUT = "legacy"
+
+# Telemetry of the current run (set in the main program)
+telemetry = None
+# Shared rate limiter for concurrent runs (see run_pipeline.py)
+rate_limiter = None
+
+
+def get_query_section(description, narrative=None):
+    query = f"Query\n"
+    query += f"A person has typed [{description}] into a search engine.\n"
+    if narrative:
+        query += f"They were looking for: {narrative}\n"
+    return query
+
+
+def get_prompt_variants(description, role=False, narrative=None, chain_of_thought=1, n=5, layout=None):
+    layout = layout or PROMPT_LAYOUT
     prompt = ""
     if role:
         prompt += f"You are a search engineer trying to improve the relevance, correctness and credibility of search results for health-related queries. "
@@ -17,10 +53,8 @@ def get_prompt_variants(description, role=False, narrative=None, chain_of_though
     prompt += f"Given a query, you must provide a list of {n} alternative queries that express the same information need as the original one, but that "
     prompt += f"are phrased in such a way that they are more likely to retrieve relevant, correct and credible documents.\n"
 
-    prompt += f"Query\n"
-    prompt += f"A person has typed [{description}] into a search engine.\n"
-    if narrative:
-        prompt += f"They were looking for: {narrative}\n"
+    if layout == "legacy":
+        prompt += get_query_section(description, narrative)
 
     if chain_of_thought > 0:
         prompt += f"Instructions\n"
@@ -38,13 +72,17 @@ def get_prompt_variants(description, role=False, narrative=None, chain_of_though
     prompt += "an array of variant queries without providing any reasoning. Example: "
     prompt += f"[\"query variant 1\", \"query variant 2\", ...]"
 
+    if layout == "prefix":
+        prompt += "\n" + get_query_section(description, narrative)
     return prompt
 
 
-def write_narrative_from_examples(query):
+def write_narrative_from_examples(query, layout=None):
     # https://trec-health-misinfo.github.io/docs/TREC-2021-Health-Misinformation-Track-Assessing-Guidelines_Version-2.pdf
-    prompt = f"Given the query [{query}], write a narrative that describes its information need in more detail "
-    prompt += f"and provides a specific explanation of what is considered to be very-useful or useful information for the query.\n"
+    layout = layout or PROMPT_LAYOUT
+    task = f"Given the query [{query}], write a narrative that describes its information need in more detail "
+    task += f"and provides a specific explanation of what is considered to be very-useful or useful information for the query.\n"
+    prompt = task if layout == "legacy" else ""
     # Topic 105 (2021)
     prompt += "For example, if the query is [Should I apply ice to a burn?], a good narrative could be: "
     prompt += "'Many people commonly put on ice on burns in an attempt to stop the burning and pain. A very useful document would discuss the effectiveness of using ice to treat burns. "
@@ -56,6 +94,8 @@ def write_narrative_from_examples(query):
     prompt += "improvements and overall health benefits. A very useful document would discuss the effectiveness of yoga in managing asthma symptoms. A useful document would help a user make a decision "
     prompt += "about use of yoga to help manage asthma by providing information on recommended treatments for asthma management, or medical benefits of practicing yoga, or both.'\n"
     prompt += "Write just the narrative using a similar format as in the examples above. Do not include any other information and do not repeat the query in your answer.\n"
+    if layout == "prefix":
+        prompt += task
     return prompt
 
 
@@ -104,7 +144,8 @@ def write_narrative_from_TREC(query):
     return prompt
 
 
-def get_prompt_evaluation(description, role=False, narrative=None, chain_of_thought=1):
+def get_prompt_evaluation(description, role=False, narrative=None, chain_of_thought=1, layout=None):
+    layout = layout or PROMPT_LAYOUT
     prompt = ""
     if role:
         prompt += f"You are a query quality predictor evaluating the effectiveness of a user query and the potential harmfulness of documents retrieved for that query. "
@@ -114,10 +155,8 @@ def get_prompt_evaluation(description, role=False, narrative=None, chain_of_thou
     prompt += f"1 = average query. Some relevant documents that would appear as search results could provide information that is correct but has low or moderate credibility\n"
     prompt += f"0 = bad query. Most relevant documents that would appear as search results could provide incorrect information\n"
 
-    prompt += f"Query\n"
-    prompt += f"A person has typed [{description}] into a search engine.\n"
-    if narrative:
-        prompt += f"They were looking for: {narrative}\n"
+    if layout == "legacy":
+        prompt += get_query_section(description, narrative)
 
     if chain_of_thought > 0:
         prompt += f"Instructions\n"
@@ -139,15 +178,26 @@ def get_prompt_evaluation(description, role=False, narrative=None, chain_of_thou
     else:
         prompt += f"{{\"H\": 1}}"
 
+    if layout == "prefix":
+        prompt += "\n" + get_query_section(description, narrative)
     return prompt
 
 
-def get_passage_writing_prompt(query, n=10):
-    prompt = f"Write passages to answer the question [{query}]. Each passage should correspond to a different interpretation, meaning or answer to the question. Write as many as necessary to fully capture all possibilities.\n"
-    prompt += "Separate the passages with the mark '||PAS||'. Do not include anything else in your answer."
-    return prompt
+def get_passage_writing_prompt(query, n=10, layout=None, structured=None):
+    # With structured outputs the answer format must match the {"passages": [...]} schema of passage_writing
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    task = f"Write passages to answer the question [{query}]. Each passage should correspond to a different interpretation, meaning or answer to the question. Write as many as necessary to fully capture all possibilities.\n"
+    if structured:
+        separator = "Produce a JSON list of passages without providing anything else. Example: [\"passage 1\", \"passage 2\", ...]"
+    else:
+        separator = "Separate the passages with the mark '||PAS||'. Do not include anything else in your answer."
+    if layout == "legacy":
+        return task + separator
+    return separator + "\n" + task
 
-def get_prompt_controversy(query, role=True, judges = 1, factors=True):
+def get_prompt_controversy(query, role=True, judges = 1, factors=True, layout=None):
+    layout = layout or PROMPT_LAYOUT
     prompt = ""
     if role:
         prompt += f"You are an expert in information retrieval and search engine bias. "
@@ -155,20 +205,110 @@ def get_prompt_controversy(query, role=True, judges = 1, factors=True):
     prompt += f"Given a query, you must determine its level of controversy within the context of health-related information retrieval.\n"
     prompt += f"Consider factors such as ambiguity, polarization in search results, potential misinformation and conflicting information.\n"
     if judges == 1:
-        prompt += f"Think step by step and provide a score on an integer scale of 1 (not controversial) to 5 (highly controversial) for the query [{query}].\n"
+        task = f"Think step by step and provide a score on an integer scale of 1 (not controversial) to 5 (highly controversial) for the query [{query}].\n"
         if factors:
-            prompt += f"Your answer should be a JSON array of scores for the individual factors and the total score at the end. Do not include any textual description. Example: [1, 5, 2, 2, 3]\n"
+            answer = f"Your answer should be a JSON array of scores for the individual factors and the total score at the end. Do not include any textual description. Example: [1, 5, 2, 2, 3]\n"
         else:
-            prompt += f"Your answer should be a single integer representing the total score. Do not include any other information."
+            answer = f"Your answer should be a single integer representing the total score. Do not include any other information."
     else:
         prompt += f"{judges} different controversy raters were asked to evaluate the query. Each rater used their own independent judgement.\n"
-        prompt += f"Think step by step and provide {judges} scores on an integer scale of 1 (not controversial) to 5 (highly controversial) for the query [{query}].\n"
-        prompt += f"Your answer should be a JSON array of scores without providing any reasoning. Example: [1, 5, 2, 2, 3]"
+        task = f"Think step by step and provide {judges} scores on an integer scale of 1 (not controversial) to 5 (highly controversial) for the query [{query}].\n"
+        answer = f"Your answer should be a JSON array of scores without providing any reasoning. Example: [1, 5, 2, 2, 3]"
+
+    if layout == "legacy":
+        return prompt + task + answer
+    return prompt + answer.rstrip("\n") + "\n" + task
+
+
+def get_packed_prompt_evaluation(descriptions, role=False, narratives=None, chain_of_thought=1):
+    # Same task as get_prompt_evaluation for several queries at once. descriptions maps each topic id
+    # to its query, and the answer is a JSON object keyed by topic id
+    prompt = ""
+    if role:
+        prompt += f"You are a query quality predictor evaluating the effectiveness of user queries and the potential harmfulness of documents retrieved for those queries. "
+
+    prompt += f"Given a list of queries, you must provide a score for each query on an integer scale of 0 to 2 with the following meanings:\n"
+    prompt += f"2 = good query. The relevant documents that would appear as search results would mainly provide information that is credible and correct\n"
+    prompt += f"1 = average query. Some relevant documents that would appear as search results could provide information that is correct but has low or moderate credibility\n"
+    prompt += f"0 = bad query. Most relevant documents that would appear as search results could provide incorrect information\n"
+
+    if chain_of_thought > 0:
+        prompt += f"Instructions\n"
+        prompt += f"Let's think step by step for each query:\n"
+        prompt += f"Consider the underlying intent of the search.\n"
+
+    if chain_of_thought == 2:
+        prompt += f"Measure how prone the original query is to retrieve supportive documents for the correct treatment of the query's question (S).\n"
+        prompt += f"Measure how prone the original query is to retrieve credible documents (C).\n"
+        prompt += f"Consider the aspects above and the relative importance of each, and decide"
+    else:
+        prompt += f"Decide"
+    prompt += f" on the final score (H).\n"
+
+    prompt += f"Produce a JSON object whose keys are the query ids and whose values are the JSON scores of each query, without providing any reasoning. Example: "
+    if chain_of_thought == 2:
+        prompt += f"{{\"id1\": {{\"S\": 0, \"C\": 2, \"H\": 0}}, \"id2\": {{\"S\": 2, \"C\": 1, \"H\": 1}}}}\n"
+    else:
+        prompt += f"{{\"id1\": {{\"H\": 1}}, \"id2\": {{\"H\": 0}}}}\n"
+
+    prompt += f"Queries\n"
+    for topic_id, description in descriptions.items():
+        prompt += f"{topic_id}: A person has typed [{description}] into a search engine."
+        if narratives and narratives.get(topic_id):
+            prompt += f" They were looking for: {narratives[topic_id]}"
+        prompt += "\n"
+    return prompt
+
+
+def get_packed_prompt_controversy(queries, role=True, factors=True):
+    # Same task as get_prompt_controversy with a single judge for several queries at once. queries maps
+    # each topic id to its query, and the answer is a JSON object keyed by topic id
+    prompt = ""
+    if role:
+        prompt += f"You are an expert in information retrieval and search engine bias. "
+
+    prompt += f"Given a list of queries, you must determine the level of controversy of each query within the context of health-related information retrieval.\n"
+    prompt += f"Consider factors such as ambiguity, polarization in search results, potential misinformation and conflicting information.\n"
+    prompt += f"Think step by step and provide a score on an integer scale of 1 (not controversial) to 5 (highly controversial) for each query.\n"
+    if factors:
+        prompt += f"The answer for each query should be a JSON array of scores for the individual factors and the total score at the end. Example: [1, 5, 2, 2, 3]\n"
+    else:
+        prompt += f"The answer for each query should be a single integer representing the total score.\n"
+    prompt += f"Your answer should be a JSON object whose keys are the query ids and whose values are the answers for each query. Do not include any textual description. "
+    if factors:
+        prompt += f"Example: {{\"id1\": [1, 5, 2, 2, 3], \"id2\": [2, 1, 1, 3, 2]}}\n"
+    else:
+        prompt += f"Example: {{\"id1\": 3, \"id2\": 1}}\n"
+
+    prompt += f"Queries\n"
+    for topic_id, query in queries.items():
+        prompt += f"{topic_id}: [{query}]\n"
     return prompt
 
 
-def chat_with_gpt4(client, prompt, temp=0.7):
+def chat_with_gpt4(client, prompt, temp=0.7, n=1, logprobs=False, top_logprobs=None, schema=None,
+                   task=None, topic=None, retry=0, structured=None):
+    # With n > 1 the API samples n independent completions for the same prompt, so the
+    # input tokens are billed once. "response" keeps the first choice for the existing
+    # callers and "responses" holds all of them.
+    # With logprobs=True, "logprobs" holds, for each choice, the list of generated tokens
+    # as (token, logprob, {alternative token: logprob}) tuples.
+    # schema is a JSON schema definition (see get_response_schema) that constrains the answer when
+    # structured (STRUCTURED_OUTPUTS by default) is on.
+    # task, topic and retry only label the request in the telemetry.
+    # If the request fails, "error" holds the message, "response" is None and "responses" is empty.
+    if rate_limiter:
+        rate_limiter.acquire()
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    start = time.time()
     try:
+        extra_args = {}
+        if logprobs:
+            extra_args["logprobs"] = True
+            extra_args["top_logprobs"] = top_logprobs
+        if schema is not None and structured:
+            extra_args["response_format"] = {"type": "json_schema", "json_schema": schema}
+
         # Create a chat completion
         response = client.chat.completions.create(
             model="gpt-4o",
@@ -176,17 +316,287 @@ def chat_with_gpt4(client, prompt, temp=0.7):
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=1000,
+            max_tokens=MAX_TOKENS,
             temperature=temp,     # originally 0.2
-            frequency_penalty=0.0
+            frequency_penalty=0.0,
+            n=n,
+            **extra_args
         )
 
-        response_text = response.choices[0].message.content.strip()
+        responses = [choice.message.content.strip() for choice in response.choices]
         tokens_used = response.usage.total_tokens
-
-        return {"response": response_text, "tokens_used": tokens_used}
+        prompt_tokens = response.usage.prompt_tokens
+        completion_tokens = response.usage.completion_tokens
+        details = getattr(response.usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+        if telemetry:
+            telemetry.record(task=task, topic=topic, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                             latency=time.time() - start, retries=retry, cache_hit=cached_tokens > 0,
+                             cached_tokens=cached_tokens)
+
+        result = {"response": responses[0], "responses": responses, "tokens_used": tokens_used,
+                  "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        if logprobs:
+            result["logprobs"] = [
+                [(t.token, t.logprob, {alt.token: alt.logprob for alt in t.top_logprobs}) for t in choice.logprobs.content]
+                for choice in response.choices
+            ]
+        return result
     except Exception as e:
-        return f"An error occurred: {str(e)}"
+        if telemetry:
+            telemetry.record(task=task, topic=topic, latency=time.time() - start, retries=retry, error=str(e))
+        return {"error": str(e), "response": None, "responses": []}
+
+
+def controversy_distribution(token_logprobs, scale=range(1, 6)):
+    # Turns the logprobs of a single-integer answer into a probability distribution over the
+    # scores of the scale. The first generated token that is a score is used, and the
+    # probability mass of its alternatives is renormalized over the scores of the scale
+    for token, logprob, alternatives in token_logprobs:
+        if token.strip() not in [str(s) for s in scale]:
+            continue
+
+        probs = dict.fromkeys(scale, 0.0)
+        for alt_token, alt_logprob in alternatives.items():
+            alt_token = alt_token.strip()
+            if alt_token.isdigit() and int(alt_token) in probs:
+                probs[int(alt_token)] += np.exp(alt_logprob)
+        if probs[int(token.strip())] == 0:
+            probs[int(token.strip())] = np.exp(logprob)
+
+        total = sum(probs.values())
+        probs = {s: p / total for s, p in probs.items()}
+        expected = sum(s * p for s, p in probs.items())
+        entropy = -sum(p * np.log(p) for p in probs.values() if p > 0)     # nats
+        return int(token.strip()), probs, expected, entropy
+
+    raise ValueError("No score token found in the response")
+
+
+def get_response_schema(task, chain_of_thought=1):
+    # JSON schema definitions for the structured answers of each task. Structured outputs need an
+    # object at the root, so lists and single scores are wrapped in a one-key object.
+    # Returns the schema definition and the key that holds the answer (None if it is the whole object)
+    scores = {"type": "integer", "enum": [1, 2, 3, 4, 5]}
+    if task == "variants":
+        key, answer = "variants", {"type": "array", "items": {"type": "string"}}
+    elif task == "passages":
+        key, answer = "passages", {"type": "array", "items": {"type": "string"}}
+    elif task in ["controversy_factors", "controversy_judges"]:
+        key, answer = "scores", {"type": "array", "items": scores}
+    elif task == "controversy_score":
+        key, answer = "score", scores
+    elif task == "evaluation":
+        keys = ["S", "C", "H"] if chain_of_thought == 2 else ["H"]
+        schema = {
+            "type": "object",
+            "properties": {k: {"type": "integer", "enum": [0, 1, 2]} for k in keys},
+            "required": keys,
+            "additionalProperties": False
+        }
+        return {"name": task, "schema": schema, "strict": True}, None
+    else:
+        raise ValueError(f"Unknown task: {task}")
+
+    schema = {
+        "type": "object",
+        "properties": {key: answer},
+        "required": [key],
+        "additionalProperties": False
+    }
+    return {"name": task, "schema": schema, "strict": True}, key
+
+
+def get_packed_response_schema(topic_ids, schema, key=None):
+    # Object keyed by topic id whose values follow the schema of a single topic answer
+    answer = schema["schema"]["properties"][key] if key else schema["schema"]
+    packed = {
+        "type": "object",
+        "properties": {str(topic_id): answer for topic_id in topic_ids},
+        "required": [str(topic_id) for topic_id in topic_ids],
+        "additionalProperties": False
+    }
+    return {"name": f'packed_{schema["name"]}', "schema": packed, "strict": True}
+
+
+def validate_schema(value, schema, path="answer"):
+    # Checks the subset of JSON schema used by get_response_schema
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            raise ValueError(f"{path}: expected an object, got {value!r}")
+        for key in schema.get("required", []):
+            if key not in value:
+                raise ValueError(f"{path}: missing key {key!r}")
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            if key in properties:
+                validate_schema(item, properties[key], f"{path}.{key}")
+            elif schema.get("additionalProperties") is False:
+                raise ValueError(f"{path}: unexpected key {key!r}")
+    elif expected == "array":
+        if not isinstance(value, list):
+            raise ValueError(f"{path}: expected an array, got {value!r}")
+        for i, item in enumerate(value):
+            validate_schema(item, schema.get("items", {}), f"{path}[{i}]")
+    elif expected == "integer":
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"{path}: expected an integer, got {value!r}")
+    elif expected == "string":
+        if not isinstance(value, str):
+            raise ValueError(f"{path}: expected a string, got {value!r}")
+
+    if "enum" in schema and value not in schema["enum"]:
+        raise ValueError(f"{path}: {value!r} is not one of {schema['enum']}")
+
+
+def repair_json(text):
+    # Local fixes for near-valid answers, applied before asking the model again: code fences,
+    # text before or after the JSON value, single quotes and trailing commas
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    fence = re.search(r"```(?:json)?\s*(.*?)```", text, flags=re.DOTALL)
+    if fence:
+        text = fence.group(1).strip()
+
+    # Keep the first balanced JSON value
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if starts:
+        start = min(starts)
+        depth = 0
+        quote = None
+        escaped = False
+        for i in range(start, len(text)):
+            c = text[i]
+            if quote:
+                if escaped:
+                    escaped = False
+                elif c == "\\":
+                    escaped = True
+                elif c == quote:
+                    quote = None
+            elif c in "\"'":
+                quote = c
+            elif c in "[{":
+                depth += 1
+            elif c in "]}":
+                depth -= 1
+                if depth == 0:
+                    text = text[start:i + 1]
+                    break
+
+    text = re.sub(r",\s*([\]}])", r"\1", text)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    # Python-like literals, e.g. single-quoted strings
+    value = ast.literal_eval(text)
+    return json.loads(json.dumps(value))
+
+
+def parse_structured(text, schema, key=None):
+    # Repairs and validates an answer against a schema from get_response_schema, returning the answer
+    # itself (unwrapped from the key). Bare answers, as produced without structured outputs, are accepted
+    value = repair_json(text)
+    if key is not None and not (isinstance(value, dict) and key in value):
+        value = {key: value}
+    validate_schema(value, schema["schema"])
+    return value[key] if key is not None else value
+
+
+def estimate_tokens(text):
+    # Rough estimate (about 4 characters per token in English text)
+    return len(text) // 4 + 1
+
+
+def get_pack_size(preamble_tokens, topic_prompt_tokens, topic_output_tokens,
+                  context_window=CONTEXT_WINDOW, max_tokens=MAX_TOKENS):
+    # Largest number of topics whose answers fit in max_tokens and whose prompt fits in the context.
+    # Output estimates get a 50% margin, since the model may add whitespace between the entries
+    by_output = max_tokens // int(topic_output_tokens * 1.5 + 1)
+    by_context = (context_window - max_tokens - preamble_tokens) // topic_prompt_tokens
+    return max(1, min(by_output, by_context))
+
+
+def run_packed(items, build_prompt, validate, example_output, pack_size=None, schema=None, key=None, task=None,
+               structured=None):
+    # Sends the items (topic id -> prompt input) in packs of several topics per request.
+    # build_prompt receives a dict with the items of the pack and must ask for a JSON object keyed by
+    # topic id; validate parses the answer of one topic and raises an exception if it is not valid.
+    # Only the topics whose answers are missing or invalid are sent again in the next round.
+    # schema and key (from get_response_schema) describe the answer of a single topic
+    if pack_size is None:
+        preamble_tokens = estimate_tokens(build_prompt({}))
+        topic_prompt_tokens = max(estimate_tokens(build_prompt({topic_id: item})) - preamble_tokens
+                                  for topic_id, item in items.items())
+        topic_output_tokens = max(estimate_tokens(f'"{topic_id}": {example_output}, ') for topic_id in items)
+        pack_size = get_pack_size(preamble_tokens, topic_prompt_tokens, topic_output_tokens)
+    print(f"Packing {pack_size} topics per request")
+
+    results = {}
+    pending = list(items)
+    retry = 0
+    while pending and retry < 20:
+        for start in range(0, len(pending), pack_size):
+            pack = {topic_id: items[topic_id] for topic_id in pending[start:start + pack_size]}
+            prompt = build_prompt(pack)
+            print(prompt)
+            packed_schema = get_packed_response_schema(pack, schema, key) if schema else None
+            response = chat_with_gpt4(client, prompt, schema=packed_schema, task=task,
+                                      topic=",".join(str(topic_id) for topic_id in pack), retry=retry, structured=structured)
+
+            try:
+                if "error" in response:
+                    raise RuntimeError(response["error"])
+                answer = repair_json(response["response"])
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                answer = {}
+
+            for topic_id in pack:
+                try:
+                    results[topic_id] = validate(answer[str(topic_id)])
+                    print(f"TOPIC_ID: {topic_id}: {results[topic_id]}")
+                except Exception as e:
+                    print(f"An error occurred for topic {topic_id}: {str(e)}")
+
+        failed = [topic_id for topic_id in pending if topic_id not in results]
+        # If no topic of the round could be parsed, the answers were probably truncated: use smaller packs
+        if len(failed) == len(pending) and pack_size > 1:
+            pack_size = max(1, pack_size // 2)
+            print(f"Reducing the packing size to {pack_size}")
+        if failed:
+            print(f"Retrying {len(failed)} topics...\n")
+        pending = failed
+        retry += 1
+
+    return {topic_id: results[topic_id] for topic_id in items if topic_id in results}
+
+
+def validate_controversy(answer, factors=True):
+    if factors:
+        if not isinstance(answer, list) or len(answer) == 0:
+            raise ValueError(f"Expected a list of scores, got {answer}")
+        scores = [int(s) for s in answer]
+    else:
+        scores = [int(answer)]
+    if any(s < 1 or s > 5 for s in scores):
+        raise ValueError(f"Scores out of range: {answer}")
+    return scores if factors else scores[0]
+
+
+def validate_evaluation(answer, chain_of_thought=1):
+    keys = ["S", "C", "H"] if chain_of_thought == 2 else ["H"]
+    scores = {key: int(answer[key]) for key in keys}
+    if any(s < 0 or s > 2 for s in scores.values()):
+        raise ValueError(f"Scores out of range: {answer}")
+    return scores
 
 
 def fetch_topics(path='../TREC_2020_BEIR/original-misinfo-resources-2020/topics/misinfo-2020-topics.xml', corpus="2020"):
@@ -235,7 +645,7 @@ def fetch_topics(path='../TREC_2020_BEIR/original-misinfo-resources-2020/topics/
     return topics
 
 
-def save_xml(topics, variants, filename, n):
+def save_xml(topics, variants, filename, n, corpus="2020"):
     # Save the variants to an xml file
     for i in range(1, n + 1):
         with open(f'{filename}_{i}.xml', 'w') as f:
@@ -312,56 +722,103 @@ def save_jsonl(variants, filename, n):
                 f.write(json.dumps(json_line) + "\n")
 
 
-def generate_query_variants(topics, role=True, narrative=True, chain_of_thought=2, n=5):
-    variants = {}
-    for topic_id in topics:
-        print(f"TOPIC_ID: {topic_id}")
-        retry = 0
-        while retry < 20:
-            # original query variantions:
-            if query_type == "description":
-                prompt = get_prompt_variants(topics[topic_id]['description'], role=role,
-                                             narrative=topics[topic_id]['narrative'] if narrative else None,
-                                             chain_of_thought=chain_of_thought, n=n)
-            else:
-                prompt = get_prompt_variants(topics[topic_id]['title'], role=role,
-                                             narrative=topics[topic_id]['narrative'] if narrative else None,
-                                             chain_of_thought=chain_of_thought, n=n)
-            if retry >= 1:
-                prompt += "\nUse a list format, as in the example: [\"query variant 1\", \"query variant 2\", ...]"
-            print(prompt)
-            response = chat_with_gpt4(client, prompt)
+def generate_topic_variants(topic, role=True, narrative=True, chain_of_thought=2, n=5,
+                            query_type="description", topic_id=None, layout=None, structured=None):
+    schema, key = get_response_schema("variants")
+    retry = 0
+    while retry < 20:
+        # original query variantions:
+        if query_type == "description":
+            prompt = get_prompt_variants(topic['description'], role=role,
+                                         narrative=topic['narrative'] if narrative else None,
+                                         chain_of_thought=chain_of_thought, n=n, layout=layout)
+        else:
+            prompt = get_prompt_variants(topic['title'], role=role,
+                                         narrative=topic['narrative'] if narrative else None,
+                                         chain_of_thought=chain_of_thought, n=n, layout=layout)
+        print(prompt)
+        response = chat_with_gpt4(client, prompt, schema=schema, task="variants", topic=topic_id, retry=retry,
+                                  structured=structured)
+
+        # Parse the response to JSON checking for errors
+        try:
+            if "error" in response:
+                raise RuntimeError(response["error"])
             print(response["response"] + "\n")
+            parsed = parse_structured(response["response"], schema, key)
+            if len(parsed) < n:
+                raise ValueError(f"Expected {n} variants, got {len(parsed)}")
+            return parsed
 
-            # Parse the response to JSON checking for errors
-            try:
-                # Store the variants in the dictionary
-                variants[topic_id] = json.loads(response["response"])
-                retry = 50   # Exit the loop
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+            if retry == 0:
+                print("Retrying...\n")
+            retry += 1
 
-            except Exception as e:
-                print(f"An error occurred: {str(e)}")
-                if retry == 0:
-                    print("Retrying...\n")
-                retry += 1
+    print("Fatal error")
+    raise RuntimeError(f"Could not generate the variants of topic {topic_id}")
 
-        if retry != 50:
-            print("Fatal error")
-            exit()
 
-    # Create path if it does not exist
+def get_variants_filename(corpus, query_type, topics_type, role, narrative, chain_of_thought, layout=None,
+                          structured=None):
     beginning = "" if topics_type == "original" else "gen_narr_"
     classification = f'{beginning}{topics_type}_{"role" if role else "norole"}_{"narrative" if narrative else "nonarrative"}_chainofth{chain_of_thought}'
+    classification += get_settings_tag(layout, structured)
     if query_type == "description":
         path = f'query_variants_T07/{corpus}/{classification}'
     else:
         path = f'query_variants_T07/{corpus}/title/{classification}'
-    if not os.path.exists(path):
-        os.makedirs(path)
+    return f'{path}/{classification}'
 
-    filename = f'{path}/{classification}'
-    save_xml(topics, variants, filename, n)
+
+def save_variants(topics, variants, filename, n, corpus="2020"):
+    # Create path if it does not exist
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    save_xml(topics, variants, filename, n, corpus)
     save_jsonl(variants, filename, n)
+    return [f'{filename}_{i}.jsonl' for i in range(1, n + 1)]
+
+
+def generate_query_variants(topics, role=True, narrative=True, chain_of_thought=2, n=5,
+                            corpus="2020", query_type="description", topics_type="original", layout=None,
+                            structured=None):
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    variants = {}
+    for topic_id in topics:
+        print(f"TOPIC_ID: {topic_id}")
+        variants[topic_id] = generate_topic_variants(topics[topic_id], role=role, narrative=narrative,
+                                                     chain_of_thought=chain_of_thought, n=n,
+                                                     query_type=query_type, topic_id=topic_id, layout=layout,
+                                                     structured=structured)
+
+    filename = get_variants_filename(corpus, query_type, topics_type, role, narrative, chain_of_thought, layout,
+                                     structured)
+    return save_variants(topics, variants, filename, n, corpus)
+
+
+def get_topics_tag(topics_type):
+    # Part of the result filenames that tells the generated topics apart (empty for the original ones)
+    return "" if topics_type == "original" else f"gen_narr_{topics_type}_"
+
+
+def get_settings_tag(layout=None, structured=None):
+    # Part of the result filenames for the prompt settings of a task that differ from the ones of the
+    # published results (empty for the legacy layout with structured outputs). None: the task does not
+    # have that setting
+    tag = "_prefix" if layout == "prefix" else ""
+    if structured is False:
+        tag += "_freetext"
+    return tag
+
+
+def get_scores_filename(corpus, topics_type, role, narrative, chain_of_thought, packed=False, pack_size=None,
+                        layout=None, structured=None):
+    filename = f'query_scores/query_scores_{get_topics_tag(topics_type)}{"role" if role else "norole"}_{"narrative" if narrative else "nonarrative"}_chainofth{chain_of_thought}'
+    if packed:
+        filename += "_packed" if pack_size is None else f"_packed{pack_size}"
+    return f'{filename}{get_settings_tag(layout, structured)}_{corpus}'
 
 
 def save_scores(scores, filename):
@@ -369,27 +826,58 @@ def save_scores(scores, filename):
         json.dump(scores, f)
 
 
-def evaluate_queries(topics, role=True, narrative=True, chain_of_thought=2):
+def evaluate_queries(topics, role=True, narrative=True, chain_of_thought=2, corpus="2020", topics_type="original",
+                     layout=None, structured=None):
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    schema, key = get_response_schema("evaluation", chain_of_thought=chain_of_thought)
     scores = {}
     for topic_id in topics:
         prompt = get_prompt_evaluation(topics[topic_id]['description'], role=role,
                                        narrative=topics[topic_id]['narrative'] if narrative else None,
-                                       chain_of_thought=chain_of_thought)
+                                       chain_of_thought=chain_of_thought, layout=layout)
         print(prompt)
-        response = chat_with_gpt4(client, prompt)
-        print(response["response"] + "\n")
+        response = chat_with_gpt4(client, prompt, schema=schema, task="evaluation", topic=topic_id, structured=structured)
 
         # Parse the response to JSON checking for errors
         try:
-            json_response = json.loads(response["response"])
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            print(response["response"] + "\n")
+            json_response = parse_structured(response["response"], schema, key)
             scores[topic_id] = json_response
 
         except Exception as e:
             print(f"An error occurred: {str(e)}")
             continue
 
-    filename = f'query_scores/query_scores_{"role" if role else "norole"}_{"narrative" if narrative else "nonarrative"}_chainofth{chain_of_thought}'
+    filename = get_scores_filename(corpus, topics_type, role, narrative, chain_of_thought, layout=layout,
+                                   structured=structured)
+    save_scores(scores, filename)
+    return [f'{filename}.json']
+
+
+def evaluate_queries_packed(topics, role=True, narrative=True, chain_of_thought=2, pack_size=None, corpus="2020",
+                            topics_type="original", structured=None):
+    # Same as evaluate_queries, but several topics share each request (and its instructions)
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    descriptions = {topic_id: topics[topic_id]['description'] for topic_id in topics}
+    narratives = {topic_id: topics[topic_id]['narrative'] for topic_id in topics} if narrative else None
+
+    def build_prompt(pack):
+        return get_packed_prompt_evaluation(pack, role=role, narratives=narratives, chain_of_thought=chain_of_thought)
+
+    example_output = '{"S": 0, "C": 2, "H": 0}' if chain_of_thought == 2 else '{"H": 1}'
+    schema, key = get_response_schema("evaluation", chain_of_thought=chain_of_thought)
+    scores = run_packed(descriptions, build_prompt,
+                        lambda answer: validate_evaluation(answer, chain_of_thought=chain_of_thought),
+                        example_output, pack_size=pack_size, schema=schema, key=key, task="evaluation_packed",
+                        structured=structured)
+
+    filename = get_scores_filename(corpus, topics_type, role, narrative, chain_of_thought, packed=True, pack_size=pack_size,
+                                   structured=structured)
     save_scores(scores, filename)
+    return [f'{filename}.json']
 
 
 def print_prompts():
@@ -436,40 +924,132 @@ def print_prompts():
     print(prompt)
 
 
-def write_all_narratives(topics, narrative_type):
+def get_prompt_builders(corpus="2020"):
+    # (name, build(topic, layout)) for every prompt builder and setting that has a "prefix" layout
+    field = 'description' if corpus == "clef" else "title"
+    builders = []
+    for role in [True, False]:
+        for narrative in [True, False]:
+            for chain_of_thought in [0, 1, 2]:
+                setting = f"role={role} narrative={narrative} chain_of_thought={chain_of_thought}"
+                builders.append((f"variants {setting}", lambda topic, layout, r=role, nar=narrative, c=chain_of_thought:
+                                 get_prompt_variants(topic['description'], role=r, narrative=topic['narrative'] if nar else None,
+                                                     chain_of_thought=c, layout=layout)))
+                builders.append((f"evaluation {setting}", lambda topic, layout, r=role, nar=narrative, c=chain_of_thought:
+                                 get_prompt_evaluation(topic['description'], role=r, narrative=topic['narrative'] if nar else None,
+                                                       chain_of_thought=c, layout=layout)))
+    for judges, factors in [(1, True), (1, False), (5, True)]:
+        builders.append((f"controversy judges={judges} factors={factors}", lambda topic, layout, j=judges, f=factors:
+                         get_prompt_controversy(topic[field], judges=j, factors=f, layout=layout)))
+    builders.append(("narrative examples", lambda topic, layout: write_narrative_from_examples(topic['description'], layout=layout)))
+    builders.append(("passages", lambda topic, layout: get_passage_writing_prompt(topic[field], layout=layout)))
+    return builders
+
+
+def check_prompt_layouts(topics, corpus="2020"):
+    # Static check of the "prefix" layout against the "legacy" one: for every builder and setting both
+    # layouts must have the same lines (only their order changes), and the prompts of different topics
+    # must share a longer prefix
+    valid = True
+    for name, build in get_prompt_builders(corpus):
+        legacy = [build(topic, "legacy") for topic in topics.values()]
+        prefix = [build(topic, "prefix") for topic in topics.values()]
+        same_lines = all(sorted(filter(None, a.split("\n"))) == sorted(filter(None, b.split("\n")))
+                         for a, b in zip(legacy, prefix))
+        shared_legacy = len(os.path.commonprefix(legacy))
+        shared_prefix = len(os.path.commonprefix(prefix))
+        print(f"{name}: {'same lines' if same_lines else 'DIFFERENT LINES'}, shared prefix of {shared_legacy} -> "
+              f"{shared_prefix} characters (prompts of {np.mean([len(p) for p in prefix]):.0f} characters on average)")
+        valid = valid and same_lines and shared_prefix >= shared_legacy
+    print("The prefix layout is valid" if valid else "The prefix layout is NOT valid")
+    return valid
+
+
+def compare_prompt_layouts(topics, corpus="2020", sample=20):
+    # Empirical check: the controversy and evaluation scores of `sample` topics with temperature 0 are
+    # requested twice with the legacy layout and once with the prefix layout. The agreement between the
+    # layouts should be as high as the agreement of the legacy layout with itself
+    field = 'description' if corpus == "clef" else "title"
+    tasks = {
+        "controversy_score": (lambda topic, layout: get_prompt_controversy(topic[field], factors=False, layout=layout),
+                              lambda answer: answer),
+        "evaluation": (lambda topic, layout: get_prompt_evaluation(topic['description'], role=True, narrative=topic['narrative'],
+                                                                    chain_of_thought=0, layout=layout),
+                       lambda answer: answer["H"])
+    }
+    results = {}
+    for task, (build, get_score) in tasks.items():
+        schema, key = get_response_schema(task, chain_of_thought=0)
+        scores = {"legacy": {}, "legacy_repeat": {}, "prefix": {}}
+        for topic_id in list(topics)[:sample]:
+            for run in scores:
+                layout = "prefix" if run == "prefix" else "legacy"
+                response = chat_with_gpt4(client, build(topics[topic_id], layout), temp=0, schema=schema,
+                                          task=f"layout_{task}", topic=topic_id)
+                try:
+                    if "error" in response:
+                        raise RuntimeError(response["error"])
+                    scores[run][topic_id] = get_score(parse_structured(response["response"], schema, key))
+                except Exception as e:
+                    print(f"An error occurred: {str(e)}")
+
+        df = pd.DataFrame(scores).dropna()
+        results[task] = {
+            "topics": len(df),
+            "agreement_legacy_legacy": float((df["legacy"] == df["legacy_repeat"]).mean()),
+            "agreement_legacy_prefix": float((df["legacy"] == df["prefix"]).mean()),
+            "spearman_legacy_legacy": float(df["legacy"].corr(df["legacy_repeat"], method="spearman")),
+            "spearman_legacy_prefix": float(df["legacy"].corr(df["prefix"], method="spearman"))
+        }
+        print(f"{task} ({len(df)} topics): agreement legacy-legacy {results[task]['agreement_legacy_legacy']:.2f}, "
+              f"legacy-prefix {results[task]['agreement_legacy_prefix']:.2f}; Spearman legacy-legacy "
+              f"{results[task]['spearman_legacy_legacy']:.3f}, legacy-prefix {results[task]['spearman_legacy_prefix']:.3f}")
+    return results
+
+
+def get_narrative_prompt_function(narrative_type):
     if narrative_type == "examples":
-        func = write_narrative_from_examples
+        return write_narrative_from_examples
     elif narrative_type == "style":
-        func = write_narrative_from_style_description
+        return write_narrative_from_style_description
     elif narrative_type == "trec":
-        func = write_narrative_from_TREC
+        return write_narrative_from_TREC
     else:  # basic
-        func = write_narrative_basic_prompt
+        return write_narrative_basic_prompt
+
 
+def get_narratives_filename(narrative_type, corpus="2020", query_type="description", layout=None):
+    # Only the "examples" prompt has a layout
+    tag = get_settings_tag(layout) if narrative_type == "examples" else ""
     if query_type == "description":
-        xml_filename = f"topics_with_generated_narratives_from_{narrative_type}_{corpus}.xml"
-    else:
-        xml_filename = f"topics_with_generated_narratives_from_{narrative_type}_{corpus}_title.xml"
+        return f"topics_with_generated_narratives_from_{narrative_type}{tag}_{corpus}.xml"
+    return f"topics_with_generated_narratives_from_{narrative_type}{tag}_{corpus}_title.xml"
 
-    responses = {}
-    for topic_id in topics:
-        if query_type == "description":
-            prompt = func(topics[topic_id]['description'])
-        else:
-            prompt = func(topics[topic_id]['title'])
-        print(prompt)
-        response = chat_with_gpt4(client, prompt)
-        responses[topic_id] = response["response"]
 
-        # If the response is not complete (i.e., it does not end with a period), retry
-        while not response["response"].endswith("."):
-            print("Retrying...")
-            response = chat_with_gpt4(client, prompt)
-            responses[topic_id] = response["response"]
+def write_narrative(topic, narrative_type, query_type="description", topic_id=None, layout=None):
+    func = get_narrative_prompt_function(narrative_type)
+    query = topic['description'] if query_type == "description" else topic['title']
+    # Only the "examples" prompt has a layout
+    prompt = func(query, layout=layout) if narrative_type == "examples" else func(query)
+    print(prompt)
+    response = chat_with_gpt4(client, prompt, task="narrative", topic=topic_id)
+
+    # If the request failed or the response is not complete (i.e., it does not end with a period), retry
+    retry = 0
+    while "error" in response or not response["response"].endswith("."):
+        if "error" in response:
+            print(f"An error occurred: {response['error']}")
+        if retry == 20:
+            raise RuntimeError(f"Could not write the narrative of topic {topic_id}")
+        print("Retrying...")
+        retry += 1
+        response = chat_with_gpt4(client, prompt, task="narrative", topic=topic_id, retry=retry)
+
+    print(response["response"] + "\n")
+    return response["response"]
 
-        print(response["response"] + "\n")
-        topics[topic_id]['narrative'] = response["response"]
 
+def save_narratives_xml(topics, xml_filename, corpus="2020"):
     with open(xml_filename, 'w') as f:
         f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
         f.write("<topics>\n")
@@ -528,6 +1108,80 @@ def write_all_narratives(topics, narrative_type):
         f.write("</topics>\n")
 
 
+def write_all_narratives(topics, narrative_type, corpus="2020", query_type="description", layout=None):
+    layout = layout or PROMPT_LAYOUT
+    for topic_id in topics:
+        topics[topic_id]['narrative'] = write_narrative(topics[topic_id], narrative_type,
+                                                        query_type=query_type, topic_id=topic_id, layout=layout)
+
+    xml_filename = get_narratives_filename(narrative_type, corpus, query_type, layout)
+    save_narratives_xml(topics, xml_filename, corpus)
+    return [xml_filename]
+
+
+def generate_narratives_and_variants(topics, narrative_type, role=True, narrative=True, chain_of_thought=2, n=5,
+                                     corpus="2020", query_type="description", workers=4, queue_size=8, layout=None,
+                                     structured=None):
+    # Pipelined version of write_all_narratives followed by generate_query_variants on the generated
+    # topics: each narrative goes to the variant stage as soon as it is written. The queue between the
+    # two stages is bounded, so the narrative workers wait when the variant stage falls behind
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    topics = {topic_id: dict(topics[topic_id]) for topic_id in topics}
+    narratives_queue = queue.Queue(maxsize=queue_size)
+    STOP = object()
+    variants = {}
+    errors = []
+
+    def narrative_stage(topic_ids):
+        for topic_id in topic_ids:
+            try:
+                topics[topic_id]['narrative'] = write_narrative(topics[topic_id], narrative_type,
+                                                                query_type=query_type, topic_id=topic_id, layout=layout)
+                narratives_queue.put(topic_id)
+            except Exception as e:
+                errors.append(e)
+                narratives_queue.put(None)
+
+    def variant_stage():
+        while True:
+            topic_id = narratives_queue.get()
+            if topic_id is STOP:
+                return
+            if topic_id is None:
+                continue
+            try:
+                variants[topic_id] = generate_topic_variants(topics[topic_id], role=role, narrative=narrative,
+                                                             chain_of_thought=chain_of_thought, n=n,
+                                                             query_type=query_type, topic_id=topic_id, layout=layout,
+                                                             structured=structured)
+            except Exception as e:
+                errors.append(e)
+
+    topic_ids = list(topics)
+    producers = [threading.Thread(target=narrative_stage, args=(topic_ids[i::workers],)) for i in range(workers)]
+    consumers = [threading.Thread(target=variant_stage) for _ in range(workers)]
+    for thread in producers + consumers:
+        thread.start()
+    for thread in producers:
+        thread.join()
+    for _ in consumers:
+        narratives_queue.put(STOP)
+    for thread in consumers:
+        thread.join()
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} topics failed: {str(errors[0])}")
+
+    # Same topic order as the serial version
+    variants = {topic_id: variants[topic_id] for topic_id in topics}
+    xml_filename = get_narratives_filename(narrative_type, corpus, query_type, layout)
+    save_narratives_xml(topics, xml_filename, corpus)
+    filename = get_variants_filename(corpus, query_type, narrative_type, role, narrative, chain_of_thought, layout,
+                                     structured)
+    return [xml_filename] + save_variants(topics, variants, filename, n, corpus)
+
+
 def print_menu():
     print("\nAvailable commands:")
     print("1. evaluate - Evaluate queries")
@@ -539,6 +1193,11 @@ def print_menu():
     print("7. quit - Exit the program")
     print("8. controversy - Determine the level of controversy for all queries")
     print("9. passage writing - Write passages for all queries")
+    print("10. controversy distribution - Controversy score distribution for all queries from a single call")
+    print("11. evaluate packed - Evaluate queries, several topics per request")
+    print("12. controversy packed - Determine the level of controversy for all queries, several topics per request")
+    print("13. narratives and variants - Write all narratives and generate the query variants of the new topics, pipelined")
+    print("14. validate prompts - Check that the prefix layout of the prompts keeps the task semantics")
 
 
 def get_narrative_type():
@@ -564,109 +1223,269 @@ def get_topics_filename():
 
         topics_type = input(
             "Choose topics type (original/examples/style/basic/trec): ").lower()
-        if topics_type == "original":
-            if corpus == "clef":
-                return corpus, topics_type, query_type, f'../CLEF/queries2016_corregidas.xml'
-            return corpus, topics_type, query_type, f'../TREC_{corpus}_BEIR/original-misinfo-resources-{corpus}/topics/misinfo-{corpus}-topics.xml'
-        elif topics_type == "examples":
-            return corpus, topics_type, query_type, f'./topics_with_generated_narratives_from_examples_{corpus}.xml'
-        elif topics_type == "style":
-            return corpus, topics_type, query_type, f'./topics_with_generated_narratives_from_style_{corpus}.xml'
-        elif topics_type == "basic":
-            return corpus, topics_type, query_type, f'./topics_with_generated_narratives_from_basic_{corpus}.xml'
-        elif topics_type == "trec":
-            if query_type == "title":
-                return corpus, topics_type, query_type, f'./topics_with_generated_narratives_from_trec_{corpus}_title.xml'
-            return corpus, topics_type, query_type, f'./topics_with_generated_narratives_from_trec_{corpus}.xml'
+        if topics_type in ["original", "examples", "style", "basic", "trec"]:
+            return corpus, topics_type, query_type, get_topics_path(corpus, query_type, topics_type, PROMPT_LAYOUT)
         else:
             print(
                 "Invalid choice. Please enter 'original', 'examples', 'style', 'basic' or 'trec'.")
 
 
-def controversy_analysis():
+def get_topics_path(corpus, query_type, topics_type, layout=None):
+    # layout: the one the "examples" narratives were written with
+    if topics_type == "original":
+        if corpus == "clef":
+            return f'../CLEF/queries2016_corregidas.xml'
+        return f'../TREC_{corpus}_BEIR/original-misinfo-resources-{corpus}/topics/misinfo-{corpus}-topics.xml'
+    elif topics_type == "trec" and query_type == "title":
+        return f'./topics_with_generated_narratives_from_trec_{corpus}_title.xml'
+    tag = get_settings_tag(layout) if topics_type == "examples" else ""
+    return f'./topics_with_generated_narratives_from_{topics_type}{tag}_{corpus}.xml'
+
+
+def get_controversy_filename(method, corpus="2020", topics_type="original", samples=1, adaptive=False, tolerance=1.0,
+                             pack_size=None, layout=None, structured=None):
+    # method tells the analyses apart: "<n>judges", "factors" and "temps" (temperature sweep with and
+    # without factors), "logprobs", "packed" and "packed_factors"
+    filename = f'controversy_results/controversy_scores_{get_topics_tag(topics_type)}{method}'
+    if samples > 1:
+        filename += f'_{samples}samples'
+    if adaptive:
+        filename += f'_adaptive_tol{tolerance:g}'
+    if pack_size is not None:
+        filename += f'_pack{pack_size}'
+    return f'{filename}{get_settings_tag(layout, structured)}_{corpus}'
+
+
+def get_passages_filename(corpus="2020", topics_type="original", layout=None, structured=None):
+    return f'generated_passages/passages_{get_topics_tag(topics_type)}{corpus}{get_settings_tag(layout, structured)}'
+
+
+def sample_controversy(prompt, samples=1, temp=0.7, task="controversy_factors", topic=None, structured=None):
+    # Collects `samples` parsed answers for one prompt, asking for all of them as
+    # choices of a single request. Only the choices that could not be parsed are requested again
+    schema, key = get_response_schema(task)
+    results = []
+    retry = 0
+    while len(results) < samples and retry < 20:
+        print(prompt)
+        response = chat_with_gpt4(client, prompt, temp=temp, n=samples - len(results), schema=schema,
+                                  task=task, topic=topic, retry=retry, structured=structured)
+        if "error" in response:
+            print(f"An error occurred: {response['error']}")
+        responses = response["responses"]
+
+        failed = len(responses) == 0
+        for text in responses:
+            # Parse the response checking for errors
+            try:
+                resp = parse_structured(text, schema, key)
+                print(f"Controversy score: {resp}\n")
+                results.append(resp)
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                failed = True
+
+        if failed:
+            if retry == 0:
+                print("Retrying...\n")
+            retry += 1
+    return results
+
+
+def total_controversy(resp, judges=False):
+    # One number per sample: the sum of the judge scores, the total score at the end of the factor
+    # scores, or the score itself
+    if isinstance(resp, list):
+        return float(sum(resp)) if judges else float(resp[-1])
+    return float(resp)
+
+
+def is_stable(results, tolerance=1.0, min_samples=3, judges=False):
+    # True when the 95% confidence interval of the mean total score is at most +-tolerance
+    if len(results) < min_samples:
+        return False
+    totals = [total_controversy(resp, judges) for resp in results]
+    half_width = stats.t.ppf(0.975, len(totals) - 1) * np.std(totals, ddof=1) / np.sqrt(len(totals))
+    return half_width <= tolerance
+
+
+def controversy_analysis(topics, corpus="2020", njudges=1, samples=1, adaptive=False, tolerance=1.0, min_samples=3,
+                         topics_type="original", layout=None, structured=None):
+    # samples > 1 draws independent judgements as separate choices of the same request.
+    # With adaptive, `samples` is the maximum: min_samples are drawn first and then one more at a
+    # time until the mean total score is stable (see is_stable)
+    task = "controversy_judges" if njudges > 1 else "controversy_factors"
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    scores = {}
+    samples_used = {}
+    for topic_id in topics:
+        print(f"TOPIC_ID: {topic_id}")
+        field = 'description' if corpus == "clef" else "title"
+        prompt = get_prompt_controversy(topics[topic_id][field], judges=njudges, layout=layout)
+        if adaptive:
+            results = sample_controversy(prompt, samples=min(min_samples, samples), task=task, topic=topic_id,
+                                         structured=structured)
+            while len(results) < samples and not is_stable(results, tolerance, min_samples, judges=njudges > 1):
+                new_results = sample_controversy(prompt, samples=1, task=task, topic=topic_id, structured=structured)
+                if not new_results:
+                    break
+                results.extend(new_results)
+            samples_used[topic_id] = len(results)
+        else:
+            results = sample_controversy(prompt, samples=samples, task=task, topic=topic_id, structured=structured)
+        if samples == 1:
+            if results:
+                scores[topic_id] = results[0]
+        else:
+            scores[topic_id] = []
+            for resp in results:
+                if njudges > 1:
+                    scores[topic_id].extend(resp)
+                else:
+                    scores[topic_id].append(resp)
+
+    filename = get_controversy_filename(f"{njudges}judges", corpus, topics_type, samples, adaptive, tolerance,
+                                        layout=layout, structured=structured)
+    # Save results into a csv file
+    cols_dict = {'index': 'topic'}
+    for i in range(njudges * samples):
+        cols_dict[i] = f"score{i + 1}"
+    df = pd.DataFrame.from_dict(scores, orient='index').reset_index().rename(columns=cols_dict)
+    if adaptive:
+        df["samples_used"] = df["topic"].map(samples_used)
+    df.to_csv(f'{filename}.csv', index=False)
+    return [f'{filename}.csv']
+
+
+def controversy_analysis_temp(topics, corpus="2020", factors = True, samples=1, adaptive=False, tolerance=1.0,
+                              min_samples=3, topics_type="original", layout=None, structured=None):
+    # With adaptive, the temperatures are visited from the middle outwards and the sweep of a topic
+    # stops once its mean total score is stable (see is_stable), so the sweep is the maximum budget.
+    # The columns keep the order of the temperatures, with NaN for the ones that were not sampled
+    task = "controversy_factors" if factors else "controversy_score"
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    scores = {}
+    samples_used = {}
+    temps = np.linspace(0.2, 0.9, 5)      # array([0.2  , 0.375, 0.55 , 0.725, 0.9  ])
+    order = [2, 0, 4, 1, 3] if adaptive else range(len(temps))     # 0.55, 0.2, 0.9, 0.375, 0.725
+    for topic_id in topics:
+        by_temp = {}
+        results = []
+        for i in order:
+            print(f"TOPIC_ID: {topic_id}")
+            field = 'description' if corpus == "clef" else "title"
+            prompt = get_prompt_controversy(topics[topic_id][field], factors=factors, layout=layout)
+            # Parse the response to an integer
+            by_temp[i] = sample_controversy(prompt, samples=samples, temp=temps[i], task=task, topic=topic_id,
+                                            structured=structured)
+            results.extend(by_temp[i])
+            if adaptive and is_stable(results, tolerance, min_samples):
+                break
+        scores[topic_id] = [resp for i in range(len(temps)) for resp in (by_temp.get(i, []) + [np.nan] * samples)[:samples]]
+        samples_used[topic_id] = len(results)
+
+    filename = get_controversy_filename("factors" if factors else "temps", corpus, topics_type, samples, adaptive, tolerance,
+                                        layout=layout, structured=structured)
+    # Save results into a csv file
+    cols_dict = {'index': 'topic'}
+    for i in range(len(temps) * samples):
+        cols_dict[i] = f"score{i + 1}"
+    df = pd.DataFrame.from_dict(scores, orient='index').reset_index().rename(columns=cols_dict)
+    if adaptive:
+        df["samples_used"] = df["topic"].map(samples_used)
+    df.to_csv(f'{filename}.csv', index=False)
+    return [f'{filename}.csv']
+
+def controversy_analysis_logprobs(topics, corpus="2020", top_logprobs=10, topics_type="original", layout=None):
+    # Single call per topic: the score distribution is read from the token probabilities of the
+    # single-integer answer instead of sampling the temperature sweep of controversy_analysis_temp
+    layout = layout or PROMPT_LAYOUT
     scores = {}
-    njudges = 1
     for topic_id in topics:
         retry = 0
 
         while retry < 20:
             print(f"TOPIC_ID: {topic_id}")
             field = 'description' if corpus == "clef" else "title"
-            prompt = get_prompt_controversy(topics[topic_id][field], judges=njudges)
+            prompt = get_prompt_controversy(topics[topic_id][field], factors=False, layout=layout)
             print(prompt)
-            response = chat_with_gpt4(client, prompt)
-            # Parse the response to an integer
+            response = chat_with_gpt4(client, prompt, logprobs=True, top_logprobs=top_logprobs,
+                                      task="controversy_logprobs", topic=topic_id, retry=retry)
             try:
-                json_response = json.loads(response["response"])
-                print(f"Controversy score: {json_response}\n")
+                if "error" in response:
+                    raise RuntimeError(response["error"])
+                score, probs, expected, entropy = controversy_distribution(response["logprobs"][0])
+                print(f"Controversy score: {score}, expected: {expected:.3f}, entropy: {entropy:.3f}\n")
                 retry = 50   # Exit the loop
-                scores[topic_id] = json_response
+                # Same layout as the other controversy CSVs (topic, score1..N), with the distribution after
+                scores[topic_id] = {"score1": score}
+                for s, p in probs.items():
+                    scores[topic_id][f"p{s}"] = p
+                scores[topic_id]["expected_score"] = expected
+                scores[topic_id]["entropy"] = entropy
             except Exception as e:
                 print(f"An error occurred: {str(e)}")
                 if retry == 0:
                     print("Retrying...\n")
                 retry += 1
 
-    filename = f'controversy_results/controversy_scores_{njudges}judges_{corpus}'
+    filename = get_controversy_filename("logprobs", corpus, topics_type, layout=layout)
     # Save results into a csv file
-    cols_dict = {'index': 'topic'}
-    for i in range(njudges):
-        cols_dict[i] = f"score{i + 1}"
-    df = pd.DataFrame.from_dict(scores, orient='index').reset_index().rename(columns=cols_dict)
+    df = pd.DataFrame.from_dict(scores, orient='index').reset_index().rename(columns={'index': 'topic'})
     df.to_csv(f'{filename}.csv', index=False)
-
-
-def controversy_analysis_temp(factors = True):
-    scores = {}
-    temps = np.linspace(0.2, 0.9, 5)      # array([0.2  , 0.375, 0.55 , 0.725, 0.9  ])
-    for topic_id in topics:
-        scores[topic_id] = []
-        for temp in temps:
-            retry = 0
-
-            while retry < 20:
-                print(f"TOPIC_ID: {topic_id}")
-                field = 'description' if corpus == "clef" else "title"
-                prompt = get_prompt_controversy(topics[topic_id][field], factors=factors)
-                print(prompt)
-                response = chat_with_gpt4(client, prompt, temp=temp)
-                # Parse the response to an integer
-                try:
-                    if factors:
-                        resp = json.loads(response["response"])
-                    else:
-                        resp = int(response["response"])
-                    print(f"Controversy score: {resp}\n")
-                    retry = 50   # Exit the loop
-                    scores[topic_id].append(resp)
-                except Exception as e:
-                    print(f"An error occurred: {str(e)}")
-                    if retry == 0:
-                        print("Retrying...\n")
-                    retry += 1
-
-    filename = f'controversy_results/controversy_scores_factors_{corpus}'
+    return [f'{filename}.csv']
+
+def controversy_analysis_packed(topics, corpus="2020", factors=True, pack_size=None, topics_type="original",
+                                structured=None):
+    # Same as controversy_analysis with a single judge, but several topics share each request
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    field = 'description' if corpus == "clef" else "title"
+    queries = {topic_id: topics[topic_id][field] for topic_id in topics}
+
+    schema, key = get_response_schema("controversy_factors" if factors else "controversy_score")
+    scores = run_packed(queries, lambda pack: get_packed_prompt_controversy(pack, factors=factors),
+                        lambda answer: validate_controversy(answer, factors=factors),
+                        "[1, 5, 2, 2, 3]" if factors else "3", pack_size=pack_size, schema=schema, key=key,
+                        task="controversy_packed", structured=structured)
+
+    filename = get_controversy_filename("packed_factors" if factors else "packed", corpus, topics_type, pack_size=pack_size,
+                                        structured=structured)
     # Save results into a csv file
-    cols_dict = {'index': 'topic'}
-    for i in range(len(temps)):
-        cols_dict[i] = f"score{i + 1}"
-    df = pd.DataFrame.from_dict(scores, orient='index').reset_index().rename(columns=cols_dict)
+    # One sample per topic: topic, score1 (as controversy_analysis_temp, with the factor arrays in the cell)
+    df = pd.DataFrame.from_dict({topic_id: [score] for topic_id, score in scores.items()}, orient='index')
+    df = df.reset_index().rename(columns={'index': 'topic', 0: 'score1'})
     df.to_csv(f'{filename}.csv', index=False)
+    return [f'{filename}.csv']
 
-def passage_writing(n=10):
+def passage_writing(topics, corpus="2020", n=10, topics_type="original", layout=None, structured=None):
+    # With structured outputs the passages come as a JSON list instead of '||PAS||'-separated text
+    layout = layout or PROMPT_LAYOUT
+    structured = STRUCTURED_OUTPUTS if structured is None else structured
+    schema, key = get_response_schema("passages")
     all_passages = {}
     for topic_id in topics:
         retry = 0
 
         while retry < 20:
             print(f"TOPIC_ID: {topic_id}")
-            prompt = get_passage_writing_prompt(topics[topic_id]["description" if corpus=="clef" else "title"])
+            prompt = get_passage_writing_prompt(topics[topic_id]["description" if corpus=="clef" else "title"],
+                                                layout=layout, structured=structured)
             print(prompt)
-            response = chat_with_gpt4(client, prompt)
+            response = chat_with_gpt4(client, prompt, schema=schema, task="passages", topic=topic_id, retry=retry,
+                                      structured=structured)
 
             try:
-                passages = response["response"].split("||PAS||")
+                if "error" in response:
+                    raise RuntimeError(response["error"])
+                if structured:
+                    passages = parse_structured(response["response"], schema, key)
+                else:
+                    passages = response["response"].split("||PAS||")
                 passages = [str(p).strip() for p in passages if str(p).strip() != ""]
+                if len(passages) == 0:
+                    raise ValueError("No passages in the answer")
                 print(passages)
                 all_passages[topic_id] = passages
                 retry = 50
@@ -676,10 +1495,11 @@ def passage_writing(n=10):
                     print("Retrying...\n")
                 retry += 1
 
-    filename = f'generated_passages/passages'
+    filename = get_passages_filename(corpus, topics_type, layout, structured)
     # Save results into a csv file
     df = pd.DataFrame.from_dict(all_passages, orient='index').reset_index().rename(columns={'index': 'topic'})
-    df.to_csv(f'{filename}.csv', index=False)   
+    df.to_csv(f'{filename}.csv', index=False)
+    return [f'{filename}.csv']
 
 def main():
     parser = configparser.ConfigParser()
@@ -691,11 +1511,12 @@ def main():
         user_input = input("Give instructions: ")
         if user_input.lower() in ["1", "evaluate"]:
             evaluate_queries(topics, role=True,
-                             narrative=True, chain_of_thought=0)
+                             narrative=True, chain_of_thought=0, corpus=corpus, topics_type=topics_type)
 
         elif user_input.lower() in ["2", "variants"]:
             generate_query_variants(
-                topics, role=True, narrative=True, chain_of_thought=1, n=10)
+                topics, role=True, narrative=True, chain_of_thought=1, n=10,
+                corpus=corpus, query_type=query_type, topics_type=topics_type)
 
         elif user_input in ["3", "narrative"]:
             narrative_type = get_narrative_type()
@@ -711,30 +1532,53 @@ def main():
             else:  # basic
                 prompt = write_narrative_basic_prompt(query_description)
 
-            response = chat_with_gpt4(client, prompt)
-            print(response["response"])
+            response = chat_with_gpt4(client, prompt, task="narrative")
+            print(f"An error occurred: {response['error']}" if "error" in response else response["response"])
 
         elif user_input in ["all narratives", "4"]:
-            write_all_narratives(topics, get_narrative_type())
+            write_all_narratives(topics, get_narrative_type(), corpus=corpus, query_type=query_type)
 
         elif user_input.lower() in ["5", "print"]:
             print_prompts()
 
         elif user_input.lower() in ["6", "chat"]:
             user_prompt = input("Enter your prompt: ")
-            response = chat_with_gpt4(client, user_prompt)
-            print(response["response"])
+            response = chat_with_gpt4(client, user_prompt, task="chat")
+            print(f"An error occurred: {response['error']}" if "error" in response else response["response"])
 
         elif user_input.lower() in ["7", "quit"]:
+            if telemetry:
+                telemetry.print_summary(telemetry.save_summary(telemetry.log_path.replace(".jsonl", "_summary.json")))
+                telemetry.close()
+            client.print_stats()
             print("Assistant: Goodbye!")
             break
         
         elif user_input.lower() in ["8", "controversy"]:
-            #controversy_analysis()
-            controversy_analysis_temp()
+            #controversy_analysis(topics, corpus)
+            controversy_analysis_temp(topics, corpus, topics_type=topics_type)
 
         elif user_input.lower() in ["9", "passage"]:
-            passage_writing()
+            passage_writing(topics, corpus, topics_type=topics_type)
+
+        elif user_input.lower() in ["10", "controversy distribution"]:
+            controversy_analysis_logprobs(topics, corpus, topics_type=topics_type)
+
+        elif user_input.lower() in ["11", "evaluate packed"]:
+            evaluate_queries_packed(topics, role=True,
+                                    narrative=True, chain_of_thought=0, corpus=corpus, topics_type=topics_type)
+
+        elif user_input.lower() in ["12", "controversy packed"]:
+            controversy_analysis_packed(topics, corpus, topics_type=topics_type)
+
+        elif user_input.lower() in ["13", "narratives and variants"]:
+            generate_narratives_and_variants(
+                topics, get_narrative_type(), role=True, narrative=True, chain_of_thought=1, n=10,
+                corpus=corpus, query_type=query_type)
+
+        elif user_input.lower() in ["14", "validate prompts"]:
+            if check_prompt_layouts(topics, corpus):
+                compare_prompt_layouts(topics, corpus)
 
         else:
             print("Invalid command. Please try again.")
@@ -745,8 +1589,8 @@ if __name__ == "__main__":
     parser = configparser.ConfigParser()
     parser.read("config.ini")
 
-    api_key = parser.get("OPENAI", "API_KEY")
-    client = OpenAI(api_key=api_key)
+    client = create_client(parser)
+    telemetry = Telemetry(f'telemetry/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}.jsonl')
 
     corpus, topics_type, query_type, topics_filename = get_topics_filename()
     topics = fetch_topics(topics_filename, corpus)
@@ -0,0 +1,139 @@
+"""
+Checks the hedging, failover and cooldown of llm_backends.BackendPool against two local mock servers
+(mock_openai_server.py) with different latencies and error rates:
+    hedging   once the pool has min_samples latencies, a request slower than their p95 is duplicated
+              to the second backend, which answers first; requests faster than the p95 are not
+    failover  a request that fails on the first backend is answered by the second one
+    cooldown  after max_errors consecutive errors the first backend is skipped, and it is tried again
+              once the cooldown has passed
+
+Exits with status 1 if any check fails.
+
+Example:
+    python check_backend_pool.py --latency 0.05 --cooldown 1
+"""
+
+import sys
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer
+
+from openai import OpenAI
+
+from llm_backends import Backend, BackendPool
+from mock_openai_server import MockOpenAI, make_handler
+
+
+failures = []
+
+
+def check(condition, message):
+    print(f'{"ok  " if condition else "FAIL"} {message}')
+    if not condition:
+        failures.append(message)
+
+
+def start_mock(**options):
+    # Same as mock_openai_server.start_server, but returns the mock too, so its latency can be changed
+    mock = MockOpenAI(**options)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, mock, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def make_pool(urls, **options):
+    # The OpenAI client must not retry by itself, or the pool would not see the errors
+    backends = [Backend(name, OpenAI(api_key="mock", base_url=url, max_retries=0)) for name, url in urls]
+    return BackendPool(backends, **options)
+
+
+def request(pool, i):
+    start = time.time()
+    pool.chat.completions.create(messages=[{"role": "user", "content": f"Request {i}"}], max_tokens=10)
+    return time.time() - start
+
+
+def check_hedging(latency, min_samples=20):
+    primary_server, primary, primary_url = start_mock(latency_median=latency, latency_sigma=0)
+    secondary_server, _, secondary_url = start_mock(latency_median=latency, latency_sigma=0, seed=1)
+    pool = make_pool([("primary", primary_url), ("secondary", secondary_url)], min_samples=min_samples)
+
+    check(pool.hedge_delay() is None, "no hedging before min_samples latencies")
+    for i in range(min_samples):
+        request(pool, i)
+    delay = pool.hedge_delay()
+    check(delay is not None, f"hedge delay after {min_samples} requests: p95 = {delay or 0:.3f}s")
+    if delay is None:
+        return
+
+    # Much faster than the p95: never hedged
+    primary.latency_median = 0.0
+    hedges = pool.stats()["hedges"]
+    for i in range(min_samples):
+        request(pool, min_samples + i)
+    check(pool.stats()["hedges"] == hedges, f"no hedges for {min_samples} requests below the p95")
+
+    # Much slower than the p95: hedged after the p95 and answered by the second backend
+    primary.latency_median = 20 * latency
+    stats = pool.stats()
+    delay = pool.hedge_delay()
+    elapsed = request(pool, 2 * min_samples)
+    new_stats = pool.stats()
+    check(new_stats["hedges"] == stats["hedges"] + 1, "a request slower than the p95 is hedged")
+    check(new_stats["hedge_wins"] == stats["hedge_wins"] + 1, "the duplicate on the second backend answers first")
+    check(delay <= elapsed < primary.latency_median,
+          f"answered in {elapsed:.3f}s: after the p95 ({delay:.3f}s), before the slow backend ({primary.latency_median:.3f}s)")
+
+    pool.executor.shutdown(wait=True)
+    pool.print_stats()
+    primary_server.shutdown()
+    secondary_server.shutdown()
+
+
+def check_failover(latency, max_errors=3, cooldown=1.0):
+    primary_server, _, primary_url = start_mock(latency_median=latency / 5, latency_sigma=0, error_rate=1.0)
+    secondary_server, _, secondary_url = start_mock(latency_median=latency, latency_sigma=0.5, seed=1)
+    pool = make_pool([("primary", primary_url), ("secondary", secondary_url)], hedge=False, max_errors=max_errors,
+                     cooldown=cooldown)
+    primary, secondary = pool.backends
+
+    # Every request fails on the primary and is answered by the secondary, until max_errors in a row
+    for i in range(max_errors):
+        request(pool, i)
+        check(primary.requests == i + 1 and pool.stats()["failovers"] == i + 1,
+              f"request {i + 1}: tried on the primary and failed over to the secondary")
+        check((primary.down_until > time.time()) == (i + 1 >= max_errors),
+              f"request {i + 1}: primary {'down' if i + 1 >= max_errors else 'still up'} after {i + 1} consecutive errors")
+
+    # In the cooldown the primary is skipped
+    request(pool, max_errors)
+    check(primary.requests == max_errors and pool.stats()["failovers"] == max_errors,
+          "in the cooldown the request goes straight to the secondary")
+
+    # After the cooldown the primary is tried again
+    time.sleep(max(0.0, primary.down_until - time.time()) + 0.05)
+    request(pool, max_errors + 1)
+    check(primary.requests == max_errors + 1, f"after the {cooldown:g}s cooldown the primary is tried again")
+    check(secondary.errors == 0, "the secondary never failed")
+
+    pool.executor.shutdown(wait=True)
+    pool.print_stats()
+    primary_server.shutdown()
+    secondary_server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the hedging, failover and cooldown of BackendPool")
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency of the mock servers in seconds")
+    parser.add_argument("--cooldown", type=float, default=1.0, help="Cooldown of a failing backend in seconds")
+    args = parser.parse_args()
+
+    print("Hedging")
+    check_hedging(args.latency)
+    print("\nFailover and cooldown")
+    check_failover(args.latency, cooldown=args.cooldown)
+
+    print(f"\n{len(failures)} checks failed" if failures else "\nAll checks passed")
+    sys.exit(1 if failures else 0)
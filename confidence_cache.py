@@ -0,0 +1,69 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ConfidenceCache:
+    # Persistent cache (SQLite) of Query Quality Classifier confidences, keyed by the normalized query
+    # and a key of the model (name, revision and tokenizer settings). Opening the cache with a new
+    # revision or new settings of a model drops the confidences of its previous ones. The file can be
+    # shared by several processes (the batch CLI, score_queries.py workers, query_quality_server.py)
+
+    def __init__(self, path, model_name, revision, settings):
+        self.model_name = model_name
+        self.model_key = hashlib.sha1(json.dumps([model_name, revision, settings], sort_keys=True).encode()).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS models (model_key TEXT PRIMARY KEY, model_name TEXT, "
+                                    "revision TEXT, settings TEXT, created REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS confidences (model_key TEXT, query TEXT, confidence REAL, "
+                                    "PRIMARY KEY (model_key, query)) WITHOUT ROWID")
+            stale = [row[0] for row in self.connection.execute(
+                "SELECT model_key FROM models WHERE model_name = ? AND model_key != ?", (model_name, self.model_key))]
+            for model_key in stale:
+                self.connection.execute("DELETE FROM confidences WHERE model_key = ?", (model_key,))
+                self.connection.execute("DELETE FROM models WHERE model_key = ?", (model_key,))
+            if stale:
+                print(f"Confidence cache: the model {model_name} changed, dropped its old confidences")
+            self.connection.execute("INSERT OR IGNORE INTO models VALUES (?, ?, ?, ?, ?)",
+                                    (self.model_key, model_name, str(revision), json.dumps(settings, sort_keys=True), time.time()))
+
+    def get(self, queries, chunk_size=500):
+        # Cached confidences of the (normalized) queries, as a dict
+        queries = list(queries)
+        found = {}
+        with self.lock:
+            for start in range(0, len(queries), chunk_size):
+                chunk = queries[start:start + chunk_size]
+                found.update(self.connection.execute(
+                    f"SELECT query, confidence FROM confidences WHERE model_key = ? AND query IN ({','.join('?' * len(chunk))})",
+                    [self.model_key] + chunk))
+            self.hits += len(found)
+            self.misses += len(queries) - len(found)
+        return found
+
+    def put(self, confidences):
+        # confidences: dict or iterable of (normalized query, confidence)
+        items = confidences.items() if isinstance(confidences, dict) else confidences
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO confidences VALUES (?, ?, ?)",
+                                        [(self.model_key, query, float(confidence)) for query, confidence in items])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM confidences WHERE model_key = ?", (self.model_key,)).fetchone()[0]
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print(f"Confidence cache: {self.hits} hits, {self.misses} misses"
+              + (f" ({self.hits / total:.1%} hit rate)" if total else "") + f", {len(self)} confidences stored")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
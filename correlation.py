@@ -0,0 +1,304 @@
+"""
+Pearson, Spearman and Kendall tau-b correlations, with their p-values, between every predictor (e.g. the
+confidence of the Query Quality Classifier, the traditional predictors, the controversy scores) and
+every target (helpful / harmful / diff compatibility, nDCG, harmful@k) of the topics of a corpus, as in
+classifier_analysis.ipynb, without a loop of scipy calls per pair of columns:
+    Pearson   one matrix product of the standardized columns
+    Spearman  the columns are ranked once, then Pearson
+    Kendall   tau-b with Knight's algorithm: the discordant pairs are the inversions of the targets
+              ordered by the predictor, counted with a bottom-up merge sort of all the targets at once
+
+The p-values are two-sided and the same as scipy's pearsonr, spearmanr and kendalltau (t distribution
+with n - 2 degrees of freedom for Pearson and Spearman; exact without ties and up to 33 topics, else
+normal with the tie correction, for Kendall). Missing values are dropped per pair of columns: the
+columns are grouped by the topics they have, and each group is ranked once. The corpora are evaluated
+in parallel.
+
+Each input table has one row per topic (a topic column, or the first column unnamed) or is a
+compatibility table of compatibility_results/ (then --run selects the run and the columns are helpful,
+harmful and diff = helpful - harmful).
+
+Example:
+    python correlation.py --predictors 2020=confidences_query_quality_classifier/confidences_2020.csv \
+        2021=confidences_query_quality_classifier/confidences_2021.csv \
+        --targets 2020=compatibility_results/compatibility_2020_title.csv 2020=harmful_at_k/harmful_at_10_2020_bm25.csv \
+        2021=compatibility_results/compatibility_2021_title.csv --run all_res_misinfo-2020_bm25_title.csv \
+        all_res_C4-2021_bm25_query.csv --output correlations.csv
+"""
+
+import math
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import trec_io
+
+
+METHODS = ["pearson", "spearman", "kendall"]
+
+
+def pearson_block(x, y):
+    # Pearson correlation of every column of x (n x p) with every column of y (n x q), NaN for constant columns
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    norms = np.outer(np.sqrt((x ** 2).sum(axis=0)), np.sqrt((y ** 2).sum(axis=0)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (x.T @ y) / norms
+    return np.clip(np.where(norms > 0, r, np.nan), -1, 1)
+
+
+def t_pvalues(r, n):
+    # Two-sided p-values of correlations with n observations (t distribution with n - 2 degrees of freedom)
+    if n < 3:
+        return np.full(r.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt((n - 2) / (1 - r ** 2))
+    return np.where(np.isnan(r), np.nan, 2 * stats.t.sf(np.abs(t), n - 2))
+
+
+def dense_ranks(values):
+    # Dense ranks (1, 2, ...) of every column
+    return stats.rankdata(values, method="dense", axis=0).astype(np.int64)
+
+
+def count_per_column(codes, size):
+    # counts[j, v] = number of rows of column j with code v (codes between 0 and size - 1)
+    offsets = np.arange(codes.shape[1]) * size
+    return np.bincount((codes + offsets).ravel(), minlength=codes.shape[1] * size).reshape(codes.shape[1], size)
+
+
+def tie_stats(counts):
+    # Sums over the tied groups of t(t-1)/2, t(t-1)(t-2) and t(t-1)(2t+5), per row of counts
+    counts = counts.astype(float)
+    return ((counts * (counts - 1) / 2).sum(axis=1), (counts * (counts - 1) * (counts - 2)).sum(axis=1),
+            (counts * (counts - 1) * (2 * counts + 5)).sum(axis=1))
+
+
+def count_inversions(rows):
+    # Pairs i < j with rows[k, i] > rows[k, j], for every row k, with a bottom-up merge sort of all the
+    # rows at once. Merging two sorted halves is a stable sort of two runs (linear with numpy's timsort),
+    # and each element of a right half adds the elements of its left half merged after it
+    count, n = rows.shape
+    size = 1 << max(n - 1, 0).bit_length()
+    merged = np.full((count, size), np.iinfo(np.int64).max)
+    merged[:, :n] = rows
+    inversions = np.zeros(count, dtype=np.int64)
+    width = 1
+    while width < size:
+        blocks = merged.reshape(count, -1, 2 * width)
+        order = np.argsort(blocks, axis=-1, kind="stable")
+        position = np.empty_like(order)
+        np.put_along_axis(position, order, np.arange(2 * width), axis=-1)
+        left_before = position[..., width:] - np.arange(width)
+        inversions += (width - left_before).sum(axis=(1, 2))
+        merged = np.take_along_axis(blocks, order, axis=-1).reshape(count, size)
+        width *= 2
+    return inversions
+
+
+def kendall_exact_pvalue(n, concordant):
+    # Two-sided p-value of Kendall's tau without ties: probability of a permutation of n elements with
+    # at most min(concordant, discordant) inversions (scipy's _kendall_p_exact)
+    total = n * (n - 1) // 2
+    c = min(concordant, total - concordant)
+    if n <= 2 or 4 * c == n * (n - 1):
+        return 1.0
+    if c == 0:
+        return min(1.0, 2.0 / math.factorial(n)) if n < 171 else 0.0
+    if c == 1:
+        return min(1.0, 2.0 / math.factorial(n - 1)) if n < 172 else 0.0
+    # Number of permutations with k inversions, for k up to c, built one element at a time (divided by
+    # j at each step, so the result is a probability)
+    counts = np.zeros(c + 1)
+    counts[0:2] = 1.0 / 2
+    for j in range(3, n + 1):
+        counts = np.cumsum(counts)
+        if j <= c:
+            counts[j:] -= counts[:c + 1 - j]
+        counts /= j
+    return float(np.clip(2.0 * counts.sum(), 0, 1))
+
+
+def discordant_pairs(rx, ry):
+    # Discordant pairs, and sum of t(t-1)/2 over the groups tied in both, of every column of the dense
+    # ranks rx (n x q) with the same column of ry. Sorted by x, then by y: the discordant pairs are the
+    # inversions of y
+    n = rx.shape[0]
+    keys = rx * (n + 1) + ry
+    order = np.argsort(keys, axis=0, kind="stable")
+    discordant = count_inversions(np.take_along_axis(ry, order, axis=0).T)
+    sorted_keys = np.take_along_axis(keys, order, axis=0)
+    groups = np.vstack([np.zeros((1, keys.shape[1]), dtype=np.int64), np.diff(sorted_keys, axis=0) != 0]).cumsum(axis=0)
+    return discordant, tie_stats(count_per_column(groups, n))[0]
+
+
+def kendall_block(x, y):
+    # Kendall tau-b and p-values of every column of x (n x p) with every column of y (n x q)
+    n = x.shape[0]
+    total = n * (n - 1) // 2
+    rx, ry = dense_ranks(x), dense_ranks(y)
+    y_ties, y0, y1 = tie_stats(count_per_column(ry, n + 1))
+    taus = np.full((x.shape[1], y.shape[1]), np.nan)
+    pvalues = np.full(taus.shape, np.nan)
+    for i in range(x.shape[1]):
+        x_ties, x0, x1 = (s[0] for s in tie_stats(count_per_column(rx[:, [i]], n + 1)))
+        discordant, joint_ties = discordant_pairs(np.broadcast_to(rx[:, [i]], ry.shape), ry)
+        con_minus_dis = total - x_ties - y_ties + joint_ties - 2 * discordant
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tau = con_minus_dis / np.sqrt(total - x_ties) / np.sqrt(total - y_ties)
+            m = n * (n - 1.0)
+            variance = (m * (2 * n + 5) - x1 - y1) / 18 + 2 * x_ties * y_ties / m + x0 * y0 / (9 * m * (n - 2))
+            pvalue = 2 * stats.norm.sf(np.abs(con_minus_dis / np.sqrt(variance)))
+        for j in range(y.shape[1]):
+            if x_ties == total or y_ties[j] == total:
+                continue
+            taus[i, j] = min(1.0, max(-1.0, tau[j]))
+            if x_ties == 0 and y_ties[j] == 0 and (n <= 33 or min(discordant[j], total - discordant[j]) <= 1):
+                pvalues[i, j] = kendall_exact_pvalue(n, int(total - discordant[j]))
+            else:
+                pvalues[i, j] = pvalue[j]
+    return taus, pvalues
+
+
+def correlate_block(x, y, method):
+    if method == "kendall":
+        return kendall_block(x, y)
+    if method == "spearman":
+        x, y = stats.rankdata(x, axis=0), stats.rankdata(y, axis=0)
+    r = pearson_block(x, y)
+    return r, t_pvalues(r, x.shape[0])
+
+
+def correlate_pairs(x, y, method):
+    # Coefficient of every column of x (n x q) with the same column of y (e.g. q resamples of a pair of
+    # columns), NaN for constant columns. No p-values
+    n = x.shape[0]
+    if method == "kendall":
+        total = n * (n - 1) // 2
+        rx, ry = dense_ranks(x), dense_ranks(y)
+        x_ties, y_ties = tie_stats(count_per_column(rx, n + 1))[0], tie_stats(count_per_column(ry, n + 1))[0]
+        discordant, joint_ties = discordant_pairs(rx, ry)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = (total - x_ties - y_ties + joint_ties - 2 * discordant) / np.sqrt(total - x_ties) / np.sqrt(total - y_ties)
+        return np.clip(np.where((x_ties < total) & (y_ties < total), r, np.nan), -1, 1)
+    if method == "spearman":
+        x, y = stats.rankdata(x, axis=0), stats.rankdata(y, axis=0)
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    norms = np.sqrt((x ** 2).sum(axis=0) * (y ** 2).sum(axis=0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = (x * y).sum(axis=0) / norms
+    return np.clip(np.where(norms > 0, r, np.nan), -1, 1)
+
+
+def missing_patterns(values):
+    # Columns grouped by the rows where they have values: list of (rows, columns)
+    present = ~np.isnan(values)
+    groups = {}
+    for j in range(values.shape[1]):
+        groups.setdefault(present[:, j].tobytes(), (present[:, j], []))[1].append(j)
+    return list(groups.values())
+
+
+def correlate(predictors, targets, methods=METHODS):
+    # Correlations of every predictor (column) with every target, on the topics (index) of both tables.
+    # Returns a DataFrame with columns predictor, target, method, n, coefficient, p_value
+    topics = predictors.index.intersection(targets.index)
+    x = predictors.loc[topics].to_numpy(dtype=float)
+    y = targets.loc[topics].to_numpy(dtype=float)
+    shape = (len(methods), x.shape[1], y.shape[1])
+    coefficients, pvalues, counts = np.full(shape, np.nan), np.full(shape, np.nan), np.zeros(shape[1:], dtype=int)
+
+    for x_rows, x_columns in missing_patterns(x):
+        for y_rows, y_columns in missing_patterns(y):
+            rows = x_rows & y_rows
+            counts[np.ix_(x_columns, y_columns)] = rows.sum()
+            if rows.sum() < 2:
+                continue
+            for k, method in enumerate(methods):
+                r, p = correlate_block(x[np.ix_(rows, x_columns)], y[np.ix_(rows, y_columns)], method)
+                coefficients[k][np.ix_(x_columns, y_columns)] = r
+                pvalues[k][np.ix_(x_columns, y_columns)] = p
+
+    k, i, j = np.indices(shape).reshape(3, -1)
+    return pd.DataFrame({"predictor": predictors.columns[i], "target": targets.columns[j],
+                         "method": np.array(methods)[k], "n": counts[i, j], "coefficient": coefficients.ravel(),
+                         "p_value": pvalues.ravel()})
+
+
+def correlate_corpora(corpora, methods=METHODS, workers=None):
+    # corpora: {name: (predictors, targets)}. The corpora are evaluated in parallel
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(correlate, predictors, targets, methods)
+                   for name, (predictors, targets) in corpora.items()}
+        tables = [future.result().assign(corpus=name) for name, future in futures.items()]
+    results = pd.concat(tables, ignore_index=True)
+    return results[["corpus"] + [column for column in results.columns if column != "corpus"]]
+
+
+def matrices(results, method):
+    # Coefficients and p-values of a method as predictor x target matrices (as corr_with_pvalues)
+    results = results[results["method"] == method]
+    return (results.pivot(index="predictor", columns="target", values="coefficient"),
+            results.pivot(index="predictor", columns="target", values="p_value"))
+
+
+def read_topic_table(path, runs=(), p=0.95):
+    # Numeric columns of a per-topic table, with the topics (as strings) as index
+    table = pd.read_csv(path)
+    if {"run", "qrels", "all"} <= set(table.columns):
+        # Compatibility table: helpful, harmful and diff of one run
+        if table["run"].nunique() > 1:
+            table = table[table["run"].isin(runs)]
+            if table["run"].nunique() != 1:
+                raise ValueError(f"{path} has several runs: select one with --run")
+        table = table[np.isclose(table["p"].astype(float), p)]
+        names = table["qrels"].map(lambda name: "harmful" if "harmful" in name or "negative" in name else "helpful")
+        topics = table.drop(columns=["run", "qrels", "p", "all"]).set_axis(names, axis=0).T
+        topics = topics.apply(pd.to_numeric, errors="coerce")
+        topics["diff"] = topics["helpful"] - topics["harmful"]
+        topics.index = topics.index.astype(str)
+        return topics
+
+    if "topic" not in table.columns:
+        table = table.rename(columns={table.columns[0]: "topic"})
+    if "run" in table.columns and table["run"].nunique() > 1:
+        table = table[table["run"].isin(runs)]
+    table = table[table["topic"].astype(str) != "all"]
+    table = table.set_index(table["topic"].astype(str)).drop(columns=["topic"])
+    table = table.apply(pd.to_numeric, errors="coerce").dropna(axis=1, how="all")
+    table.index.name = None
+    return table
+
+
+def read_tables(specs, runs):
+    # corpus=path specs as {corpus: DataFrame}, the tables of a corpus joined on the topics
+    tables = {}
+    for spec in specs:
+        corpus, path = spec.split("=", 1)
+        table = read_topic_table(path, runs)
+        tables[corpus] = table if corpus not in tables else tables[corpus].join(table, how="outer", rsuffix=f"_{trec_io.name(path)}")
+    return tables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlations (and p-values) of query predictors with per-topic results")
+    parser.add_argument("--predictors", nargs="+", required=True, help="Predictor tables, as corpus=path")
+    parser.add_argument("--targets", nargs="+", required=True, help="Target tables, as corpus=path")
+    parser.add_argument("--run", nargs="*", default=[], help="Runs selected from the tables with several runs")
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per core)")
+    parser.add_argument("--output", type=str, help="CSV file for the results (printed if not given)")
+    args = parser.parse_args()
+
+    predictors, targets = read_tables(args.predictors, args.run), read_tables(args.targets, args.run)
+    corpora = {corpus: (predictors[corpus], targets[corpus]) for corpus in predictors if corpus in targets}
+    results = correlate_corpora(corpora, args.methods, args.workers)
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print(f"Written {len(results)} correlations to {args.output}")
+    else:
+        print(results.to_string(index=False))
@@ -0,0 +1,293 @@
+"""
+Derived qrels of TREC Health Misinformation 2020, 2021 and 2022 and CLEF eHealth 2016 (qtrust), in one
+place: the raw qrels and the topic answers (or stances) are read once, every derived variant is
+computed with vectorized lookup tables, and the TREC files and their BEIR .tsv versions (topic, docno,
+Grade) are written in the same pass. It replaces, with the same rules and outputs:
+    2020  scripts/gen-2020-derived-qrels.sh (format.py, script_files_6_11.py and the gawk filters)
+    2021  scripts/gen-2021-derived-qrels.sh (gen_derived_qrels.py and the gawk filters)
+    2022  scripts/gen-qrels-for-compatibility.py
+    all   xiana_custom_parser_20xx.py (the .tsv files)
+    clef  the .tsv, _positive.tsv and _negative.tsv versions of task1.qtrust_mapped_v2
+
+The .tsv files of the tab-separated 2020 qrels (binary.useful, binary.useful-credible and
+binary.useful-correct-credible) are written as proper three-column files, and every TREC file is
+space-separated.
+
+The 2022 preference judgments (qrels/trec2022_act26_v2.csv) are not in the repository: without
+--prefs, the graded and helpful-only 2022 qrels only have the grades of the qrels (up to 4). Neither
+are the raw 2021 qrels (qrels-35topics.txt), so --qrels is required for 2021.
+
+Example:
+    python derived_qrels.py --collection 2020 --output_dir derived_qrels/2020
+    python derived_qrels.py --collection 2021 --qrels qrels-35topics.txt --output_dir derived_qrels/2021
+    python derived_qrels.py --collection 2022 --prefs trec2022_act26_v2.csv --output_dir derived_qrels/2022
+"""
+
+import os
+import argparse
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULTS = {
+    "2020": {"qrels": "./TREC_2020_BEIR/original-misinfo-resources-2020/qrels/misinfo-2020-qrels",
+             "topics": "./TREC_2020_BEIR/original-misinfo-resources-2020/topics/misinfo-2020-topics.xml"},
+    # The raw 2021 qrels are not in the repository
+    "2021": {"qrels": None,
+             "topics": "./TREC_2021_BEIR/original-misinfo-resources-2021/topics/misinfo-2021-topics.xml"},
+    "2022": {"qrels": "./TREC_2022_BEIR/original-misinfo-resources-2022/qrels/qrels.final.oct-19-2022",
+             "topics": "./TREC_2022_BEIR/original-misinfo-resources-2022/topics/misinfo-2022-topics.xml"},
+    "clef": {"qrels": "./CLEF_v2/task1.qtrust_mapped_v2", "topics": None},
+}
+
+# Topics left out of the 2021 evaluation
+EXCLUDED_TOPICS_2021 = [113, 116, 119, 123, 124, 125, 126, 130, 135, 138, 141, 142, 147, 148, 150]
+
+# Answer of a document with respect to the answer (or stance) of its topic
+NO_ANSWER, CORRECT, INCORRECT, UNCLEAR, UNJUDGED = 0, 1, 2, 3, 4
+
+# 2020: (useful, answer, credibility) -> grade, for credibility 1 (credible), 0 (not) and -1 (unjudged)
+GRADES_2020 = {
+    **{(0, answer, credibility): 0 for answer in [NO_ANSWER, CORRECT, INCORRECT] for credibility in [-1, 0, 1]},
+    (1, CORRECT, 1): 4, (1, CORRECT, 0): 3, (1, CORRECT, -1): 3,
+    (1, NO_ANSWER, 1): 2, (1, NO_ANSWER, 0): 1, (1, NO_ANSWER, -1): 1,
+    (1, INCORRECT, 0): -1, (1, INCORRECT, -1): -1, (1, INCORRECT, 1): -2,
+}
+
+# 2021: (usefulness, answer, credibility) -> grade, for usefulness 2 (very useful), 1 and 0 and
+# credibility 2 (excellent), 1 (good), 0 (low), -2 (not judged) and -1 (not useful). Neutral and not
+# judged supportiveness are NO_ANSWER
+GRADES_2021 = {
+    **{(0, answer, credibility): 0 for answer in [NO_ANSWER, CORRECT, INCORRECT, UNJUDGED]
+       for credibility in [-2, -1, 0, 1, 2]},
+    **{(2, CORRECT, credibility): grade for credibility, grade in [(2, 12), (1, 10), (0, 8), (-2, 8)]},
+    **{(1, CORRECT, credibility): grade for credibility, grade in [(2, 11), (1, 9), (0, 7), (-2, 7)]},
+    **{(2, NO_ANSWER, credibility): grade for credibility, grade in [(2, 6), (1, 4), (0, 2), (-2, 2)]},
+    **{(1, NO_ANSWER, credibility): grade for credibility, grade in [(2, 5), (1, 3), (0, 1), (-2, 1)]},
+    **{(usefulness, INCORRECT, credibility): grade for usefulness in [1, 2]
+       for credibility, grade in [(2, -3), (1, -2), (0, -1), (-2, -1)]},
+}
+
+# 2022: (usefulness, answer) -> grade. Preference judged documents get grades above 4
+GRADES_2022 = {
+    (2, CORRECT): 4, (1, CORRECT): 3, (2, UNCLEAR): 2, (1, UNCLEAR): 1, (2, UNJUDGED): 2, (1, UNJUDGED): 1,
+    (0, UNJUDGED): 0, (1, INCORRECT): -1, (2, INCORRECT): -2,
+}
+
+
+def lookup(table, *columns):
+    # Vectorized table[(columns[0][i], columns[1][i], ...)] for a dict with tuples of small integers as keys
+    keys = np.array(list(table))
+    low = keys.min(axis=0)
+    dense = np.full(keys.max(axis=0) - low + 1, np.iinfo(np.int64).min)
+    dense[tuple((keys - low).T)] = list(table.values())
+    indices = [np.asarray(column) - offset for column, offset in zip(columns, low)]
+    valid = np.all([(index >= 0) & (index < size) for index, size in zip(indices, dense.shape)], axis=0)
+    values = np.full(len(indices[0]), np.iinfo(np.int64).min)
+    values[valid] = dense[tuple(index[valid] for index in indices)]
+    missing = values == np.iinfo(np.int64).min
+    if missing.any():
+        row = tuple(int(np.asarray(column)[missing.argmax()]) for column in columns)
+        raise ValueError(f"Can not determine a grade for {missing.sum()} judgments, e.g. {row}")
+    return values
+
+
+def read_topics(path, fields):
+    # DataFrame with the topic number and the given fields of each topic of an XML topics file
+    rows = []
+    for topic in ET.parse(path).getroot().iter("topic"):
+        rows.append({"topic": int(topic.find("number").text), **{field: topic.find(field).text for field in fields}})
+    return pd.DataFrame(rows)
+
+
+def read_raw_qrels(path, columns):
+    return pd.read_csv(path, sep=" ", header=None, names=columns)
+
+
+def answer_codes(doc_answer, topic_answer, agree, disagree, unclear=()):
+    # CORRECT or INCORRECT when a document answers like its topic or the opposite (agree and disagree
+    # are the (document answer, topic answer) pairs), UNCLEAR for the given document answers, else NO_ANSWER
+    pairs = pd.MultiIndex.from_arrays([doc_answer, topic_answer])
+    codes = np.full(len(doc_answer), NO_ANSWER)
+    codes[pairs.isin(agree)] = CORRECT
+    codes[pairs.isin(disagree)] = INCORRECT
+    codes[np.isin(doc_answer, list(unclear))] = UNCLEAR
+    return codes
+
+
+def variant(qrels, **values):
+    # TREC qrels (topic, iteration, docno and the given value columns)
+    return pd.DataFrame({"topic": qrels["topic"].to_numpy(), "iteration": qrels["iteration"].to_numpy(),
+                         "docno": qrels["docno"].to_numpy(), **{name: np.asarray(v) for name, v in values.items()}})
+
+
+def positive(table, *columns):
+    # Rows with a value above 0 in the first value column (or in any of the given ones), as the gawk filters
+    columns = list(columns) or [table.columns[3]]
+    return table[(table[columns] > 0).any(axis=1)].reset_index(drop=True)
+
+
+def graded_split(table):
+    # helpful-only (grades above 0) and harmful-only (grades below 0, negated) qrels
+    helpful = table[table["grade"] > 0].reset_index(drop=True)
+    harmful = table[table["grade"] < 0].assign(grade=lambda t: -t["grade"]).reset_index(drop=True)
+    return helpful, harmful
+
+
+def derive_2020(qrels_path, topics_path):
+    qrels = read_raw_qrels(qrels_path, ["topic", "iteration", "docno", "useful", "answer", "credibility"])
+    topics = read_topics(topics_path, ["answer"])
+    # Document answers: 0 none, 1 yes, 2 no, -1 unjudged
+    topic_answer = qrels["topic"].map(dict(zip(topics["topic"], topics["answer"].map({"yes": 1, "no": 2}))))
+    answer = answer_codes(qrels["answer"], topic_answer, [(1, 1), (2, 2)], [(1, 2), (2, 1)])
+    useful = qrels["useful"].to_numpy()
+    correct = (answer == CORRECT).astype(int)
+    credible = (qrels["credibility"] == 1).astype(int).to_numpy()
+
+    helpful, harmful = graded_split(variant(qrels, grade=lookup(GRADES_2020, useful, answer, qrels["credibility"])))
+    aspects = variant(qrels, useful=useful, correct=correct, credible=credible)
+    return {
+        "misinfo-qrels-graded.helpful-only": helpful,
+        "misinfo-qrels-graded.harmful-only": harmful,
+        "misinfo-qrels-binary.useful": positive(variant(qrels, useful=useful)),
+        "misinfo-qrels-binary.useful-correct-credible": positive(variant(qrels, value=useful & correct & credible)),
+        "misinfo-qrels-binary.useful-credible": positive(variant(qrels, value=useful & credible)),
+        "misinfo-qrels-binary.useful-correct": positive(variant(qrels, value=useful & correct)),
+        "misinfo-qrels.3aspects": positive(aspects),
+        "misinfo-qrels.2aspects.useful-credible": positive(aspects.drop(columns="correct")),
+        "misinfo-qrels.2aspects.correct-credible": positive(aspects.drop(columns="useful")),
+        "misinfo-qrels-binary.incorrect": positive(variant(qrels, value=useful * (answer == INCORRECT))),
+    }
+
+
+def derive_2021(qrels_path, topics_path):
+    qrels = read_raw_qrels(qrels_path, ["topic", "iteration", "docno", "usefulness", "supportiveness", "credibility"])
+    qrels = qrels[~qrels["topic"].isin(EXCLUDED_TOPICS_2021)].reset_index(drop=True)
+    topics = read_topics(topics_path, ["stance"])
+    # Supportiveness: 2 supportive, 1 neutral, 0 dissuades, -1 not useful, -2 not judged
+    stance = qrels["topic"].map(dict(zip(topics["topic"], topics["stance"])))
+    answer = answer_codes(qrels["supportiveness"], stance, [(2, "helpful"), (0, "unhelpful")],
+                          [(0, "helpful"), (2, "unhelpful")])
+    answer[qrels["supportiveness"] == -1] = UNJUDGED
+    usefulness = qrels["usefulness"].to_numpy()
+    useful = (usefulness > 0).astype(int)
+    correct = (answer == CORRECT).astype(int)
+    credibility = qrels["credibility"].to_numpy()
+    credible = (credibility > 0).astype(int)
+
+    helpful, harmful = graded_split(variant(qrels, grade=lookup(GRADES_2021, usefulness, answer, credibility)))
+    aspects = variant(qrels, usefulness=usefulness, correct=correct, credibility=np.maximum(credibility, 0))
+    return {
+        "misinfo-qrels-graded.helpful-only": helpful,
+        "misinfo-qrels-graded.harmful-only": harmful,
+        "misinfo-qrels-graded.usefulness": variant(qrels, usefulness=usefulness),
+        "misinfo-qrels-binary.useful-correct-credible": positive(variant(qrels, value=useful & correct & credible)),
+        "misinfo-qrels-binary.useful-credible": positive(variant(qrels, value=useful & credible)),
+        "misinfo-qrels-binary.useful-correct": positive(variant(qrels, value=useful & correct)),
+        "misinfo-qrels.3aspects": positive(aspects),
+        "misinfo-qrels.2aspects.useful-credible": positive(aspects.drop(columns="correct")),
+        "misinfo-qrels.2aspects.correct-credible": positive(aspects.drop(columns="usefulness"), "correct", "credibility"),
+        "misinfo-qrels-binary.incorrect": positive(variant(qrels, value=useful * (answer == INCORRECT))),
+    }
+
+
+def derive_2022(qrels_path, topics_path, prefs_path=None):
+    qrels = read_raw_qrels(qrels_path, ["topic", "docno", "usefulness", "answer"])
+    topics = read_topics(topics_path, ["question", "answer"])
+    qrels = qrels.merge(topics[["topic", "answer"]].rename(columns={"answer": "topic_answer"}), on="topic")
+    # Document answers: 1 yes, 0 no, 2 unclear, -1 not judged
+    answer = answer_codes(qrels["answer"], qrels["topic_answer"], [(1, "yes"), (0, "no")], [(1, "no"), (0, "yes")],
+                          unclear=[2])
+    answer[~np.isin(qrels["answer"], [0, 1, 2])] = UNJUDGED
+    grade = lookup(GRADES_2022, qrels["usefulness"], answer)
+
+    if prefs_path:
+        # Preference levels (1 is the most preferred) become grades above the maximum of GRADES_2022
+        prefs = pd.read_csv(prefs_path)
+        topic_ids = topics["question"] + " (Answer is " + topics["answer"].str.capitalize() + ")"
+        prefs = prefs.merge(pd.DataFrame({"Topic ID": topic_ids, "topic": topics["topic"]}), on="Topic ID")
+        prefs = prefs.rename(columns={"Document UUID": "docno"})[["topic", "docno", "Grade"]]
+        preference = qrels[["topic", "docno"]].merge(prefs, on=["topic", "docno"], how="left")["Grade"]
+        preference = preference.groupby(qrels["topic"]).transform("max") - preference + max(GRADES_2022.values()) + 1
+        grade = np.where(preference.isna(), grade, preference.fillna(0)).astype(int)
+
+    qrels = qrels.assign(iteration=0, grade=grade, correctness=answer)
+    qrels = qrels.sort_values(["topic", "grade"], ascending=[True, False], kind="stable").reset_index(drop=True)
+    graded = variant(qrels, grade=qrels["grade"])
+    helpful, harmful = graded_split(graded)
+    return {
+        "misinfo-qrels.graded": graded,
+        "misinfo-qrels.graded-harmful-only": harmful,
+        "misinfo-qrels.graded-helpful-only": helpful,
+        "misinfo-qrels.binary-useful-correct": variant(qrels, correct=1)[qrels["correctness"] == CORRECT],
+        "misinfo-qrels.binary-incorrect": variant(qrels, incorrect=1)[qrels["correctness"] == INCORRECT],
+        "misinfo-qrels.graded-usefulness": variant(qrels, usefulness=qrels["usefulness"])[qrels["usefulness"] >= 0],
+    }
+
+
+def derive_clef(qrels_path, topics_path=None):
+    # task1.qtrust_mapped_v2 (grades -2 to 2) as positive and negative qrels
+    qrels = read_raw_qrels(qrels_path, ["topic", "iteration", "docno", "grade"])
+    helpful, harmful = graded_split(variant(qrels.assign(iteration="Q0"), grade=qrels["grade"]))
+    return {"task1_qtrust_mapped_v2_positive.tsv": helpful, "task1_qtrust_mapped_v2_negative.tsv": harmful,
+            "task1_qtrust_mapped_v2.tsv": qrels[["topic", "docno", "grade"]]}
+
+
+def write_derived(derived, output_dir, tsv=True, sep=" "):
+    # Each variant as TREC qrels and, if it has a single value column, as a BEIR .tsv (topic, docno,
+    # Grade). Returns the paths written
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, table in derived.items():
+        path = os.path.join(output_dir, name)
+        table.to_csv(path, sep=sep, header=False, index=False)
+        paths.append(path)
+        if tsv and len(table.columns) == 4:
+            beir = table.drop(columns="iteration")
+            beir.to_csv(path + ".tsv", sep="\t", header=["topic", "docno", "Grade"], index=False)
+            paths.append(path + ".tsv")
+    return paths
+
+
+def write_clef(derived, output_dir):
+    # The CLEF files keep their formats: tab-separated TREC qrels with Q0, and a .tsv without header
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, table in derived.items():
+        path = os.path.join(output_dir, name)
+        table.to_csv(path, sep="\t", header=False, index=False)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Derived qrels of TREC Health Misinformation and CLEF eHealth")
+    parser.add_argument("--collection", choices=list(DEFAULTS), required=True)
+    parser.add_argument("--qrels", type=str, default=None,
+                        help="Raw qrels (default: the one of the repository; required for 2021)")
+    parser.add_argument("--topics", type=str, default=None, help="Topics XML (default: the one of the repository)")
+    parser.add_argument("--prefs", type=str, default=None, help="2022 preference judgments (trec2022_act26_v2.csv)")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--no_tsv", action="store_true", help="Only write the TREC qrels")
+    args = parser.parse_args()
+
+    qrels_path = args.qrels or DEFAULTS[args.collection]["qrels"]
+    if qrels_path is None:
+        parser.error(f"--qrels is required for {args.collection}: the raw qrels are not in the repository")
+    topics_path = args.topics or DEFAULTS[args.collection]["topics"]
+    if args.collection == "2020":
+        derived = derive_2020(qrels_path, topics_path)
+    elif args.collection == "2021":
+        derived = derive_2021(qrels_path, topics_path)
+    elif args.collection == "2022":
+        derived = derive_2022(qrels_path, topics_path, args.prefs)
+    else:
+        derived = derive_clef(qrels_path)
+
+    if args.collection == "clef":
+        paths = write_clef(derived, args.output_dir)
+    else:
+        paths = write_derived(derived, args.output_dir, tsv=not args.no_tsv)
+    print(f"Written {len(paths)} files to {args.output_dir}")
@@ -0,0 +1,89 @@
+"""
+harmful@k of TREC runs: the fraction of the top k documents of each topic judged harmful (grade above
+0 in a harmful-only qrels, or the CLEF qtrust negative qrels), as in the tables of harmful_at_k/.
+
+Every run and the qrels are read once. For each run, a topics x max(k) matrix marks the harmful
+documents of the ranking and its cumulative sum gives harmful@k for all the cutoffs in one pass. The
+runs of a directory are evaluated in parallel, and one topic,harmful_at_<k> CSV is written per run and
+cutoff. The rows are the topics with harmful documents in the qrels; a topic missing from a run
+counts as 0.
+
+Example:
+    python harmful_at_k.py --runs runs/2020 --qrels TREC_2020_BEIR/qrels/misinfo-qrels-graded.harmful-only.tsv \
+        --cutoffs 5 10 20 100 --label 2020 --output_dir harmful_at_k
+writes harmful_at_10_2020_<run name>.csv, etc.
+"""
+
+import os
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import trec_io
+import trec_store
+
+
+CUTOFFS = [10, 100]
+
+
+def harm_matrix(run, harmful, max_k):
+    # Boolean matrix (topics of the qrels x max_k): whether the document at each rank is harmful
+    topics = pd.Index(trec_io.sort_topics(harmful["topic"].unique()))
+    top = run[run["rank"] < max_k].merge(harmful[["topic", "docno"]], on=["topic", "docno"])
+    matrix = np.zeros((len(topics), max_k), dtype=bool)
+    matrix[topics.get_indexer(top["topic"]), top["rank"].to_numpy()] = True
+    return topics, matrix
+
+
+def harmful_at_k(run, qrels, cutoffs=CUTOFFS):
+    # DataFrame with the topics of the qrels that have harmful documents as index and one column per cutoff
+    harmful = qrels[qrels["grade"] > 0]
+    topics, matrix = harm_matrix(run, harmful, max(cutoffs))
+    counts = np.cumsum(matrix, axis=1)
+    cutoffs = np.array(cutoffs)
+    return pd.DataFrame(counts[:, cutoffs - 1] / cutoffs, index=topics, columns=list(cutoffs))
+
+
+def evaluate_run(run_path, qrels, cutoffs, output_dir, label):
+    run = trec_io.read_run(run_path, depth=max(cutoffs))
+    results = harmful_at_k(run, qrels, cutoffs)
+    name = os.path.splitext(os.path.basename(run_path))[0]
+    paths = []
+    for k in cutoffs:
+        path = os.path.join(output_dir, f"harmful_at_{k}_{label + '_' if label else ''}{name}.csv")
+        results[k].rename(f"harmful_at_{k}").to_csv(path, index_label="topic")
+        paths.append(path)
+    return paths
+
+
+def evaluate_runs(run_paths, qrels_path, cutoffs=CUTOFFS, output_dir="harmful_at_k", label="", workers=None, store=None):
+    # With a store, all the files are added to it first and the workers only read it
+    if store:
+        trec_store.open_store(store, run_paths, [qrels_path])
+    qrels = trec_io.read_qrels(qrels_path)
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers, initializer=trec_store.open_store if store else None,
+                             initargs=(store,) if store else ()) as executor:
+        futures = [executor.submit(evaluate_run, path, qrels, cutoffs, output_dir, label) for path in run_paths]
+        return [path for future in futures for path in future.result()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="harmful@k of TREC runs for several cutoffs")
+    parser.add_argument("--runs", nargs="+", required=True, help="Run files or directories of runs")
+    parser.add_argument("--qrels", type=str, required=True, help="Harmful-only qrels (or CLEF qtrust negative)")
+    parser.add_argument("--cutoffs", nargs="+", type=int, default=CUTOFFS)
+    parser.add_argument("--label", type=str, default="", help="Inserted in the file names (e.g. the corpus)")
+    parser.add_argument("--output_dir", type=str, default="harmful_at_k")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per core)")
+    parser.add_argument("--store", type=str, default=None, help="Read the files through the binary store in this directory (see trec_store.py)")
+    args = parser.parse_args()
+
+    run_paths = []
+    for path in args.runs:
+        run_paths += sorted(p for p in glob.glob(os.path.join(path, "*")) if os.path.isfile(p)) if os.path.isdir(path) else [path]
+    paths = evaluate_runs(run_paths, args.qrels, args.cutoffs, args.output_dir, args.label, args.workers, args.store)
+    print(f"Written {len(paths)} files to {args.output_dir}")
@@ -0,0 +1,172 @@
+import time
+import threading
+import types
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from openai import OpenAI
+
+
+class Backend:
+    # One OpenAI-compatible endpoint. After max_errors consecutive errors it is left out for
+    # `cooldown` seconds
+
+    def __init__(self, name, client, model="gpt-4o"):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.consecutive_errors = 0
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+
+class BackendPool:
+    # Drop-in replacement for the OpenAI client in chat_with_gpt4 (it exposes chat.completions.create).
+    # Requests go to the first healthy backend. If a request takes longer than the p95 of the observed
+    # latencies, a duplicate is sent to the next backend (or the same one, if it is the only one) and
+    # the first answer wins. A request that fails is sent to the next backend that has not been tried
+
+    def __init__(self, backends, hedge=True, hedge_percentile=95, min_samples=20, max_errors=3, cooldown=60,
+                 max_workers=32):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.max_errors = max_errors
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=500)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def hedge_delay(self):
+        with self.lock:
+            latencies = list(self.latencies)
+        if not self.hedge or len(latencies) < self.min_samples:
+            return None
+        return float(np.percentile(latencies, self.hedge_percentile))
+
+    def available(self):
+        now = time.time()
+        healthy = [backend for backend in self.backends if backend.down_until <= now]
+        # If every backend is down, try them anyway
+        return healthy or list(self.backends)
+
+    def call(self, backend, kwargs):
+        start = time.time()
+        with self.lock:
+            backend.requests += 1
+        try:
+            response = backend.client.chat.completions.create(**dict(kwargs, model=backend.model))
+        except Exception:
+            with self.lock:
+                backend.errors += 1
+                backend.consecutive_errors += 1
+                if backend.consecutive_errors >= self.max_errors:
+                    backend.down_until = time.time() + self.cooldown
+                    print(f"Backend {backend.name} failed {backend.consecutive_errors} times in a row, "
+                          f"skipping it for {self.cooldown}s")
+            raise
+
+        with self.lock:
+            backend.consecutive_errors = 0
+            self.latencies.append(time.time() - start)
+        return response
+
+    def create(self, **kwargs):
+        backends = self.available()
+        futures = {}
+        tried = []
+        errors = []
+
+        def launch(backend):
+            tried.append(backend)
+            futures[self.executor.submit(self.call, backend, kwargs)] = backend
+
+        launch(backends[0])
+        hedged = False
+        while futures:
+            timeout = None if hedged else self.hedge_delay()
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Slower than usual: send a duplicate and keep whichever answers first
+                hedged = True
+                with self.lock:
+                    self.hedges += 1
+                untried = [backend for backend in backends if backend not in tried]
+                launch(untried[0] if untried else backends[0])
+                continue
+
+            for future in done:
+                backend = futures.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    untried = [b for b in backends if b not in tried]
+                    if untried and not futures:
+                        with self.lock:
+                            self.failovers += 1
+                        print(f"Backend {backend.name} failed ({str(e)}), failing over to {untried[0].name}")
+                        launch(untried[0])
+                    continue
+
+                if hedged and backend is not tried[0]:
+                    with self.lock:
+                        self.hedge_wins += 1
+                # The other request (if any) keeps running in the background and its answer is dropped
+                return response
+
+        raise errors[-1]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+                "backends": {backend.name: {"requests": backend.requests, "errors": backend.errors}
+                             for backend in self.backends}
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Backends: {stats['hedges']} hedged requests ({stats['hedge_wins']} won by the duplicate), "
+              f"{stats['failovers']} failovers")
+        for name, backend_stats in stats["backends"].items():
+            print(f"  {name}: {backend_stats['requests']} requests, {backend_stats['errors']} errors")
+
+
+def create_client(parser):
+    # Builds the client from config.ini: [OPENAI] is the primary endpoint and every [BACKEND <name>]
+    # section is an extra OpenAI-compatible endpoint, tried in the order of the file.
+    # A [LOCAL] section adds a local transformers model (see local_backend.py) as one more endpoint.
+    # [BACKENDS] holds the hedging and failover settings
+    backends = []
+    for section in parser.sections():
+        if section == "LOCAL":
+            from local_backend import LocalBackend
+            client = LocalBackend(parser.get(section, "MODEL_DIR"),
+                                  max_batch_size=parser.getint(section, "MAX_BATCH_SIZE", fallback=8),
+                                  max_wait=parser.getfloat(section, "MAX_WAIT", fallback=0.05),
+                                  threads=parser.getint(section, "THREADS", fallback=None))
+            backends.append(Backend("local", client, model=parser.get(section, "MODEL_DIR")))
+        elif section == "OPENAI" or section.startswith("BACKEND "):
+            name = "openai" if section == "OPENAI" else section[len("BACKEND "):].strip()
+            client = OpenAI(api_key=parser.get(section, "API_KEY"),
+                            base_url=parser.get(section, "BASE_URL", fallback=None),
+                            timeout=parser.getfloat(section, "TIMEOUT", fallback=600.0),
+                            max_retries=parser.getint(section, "MAX_RETRIES", fallback=2))
+            backends.append(Backend(name, client, model=parser.get(section, "MODEL", fallback="gpt-4o")))
+
+    return BackendPool(backends,
+                       hedge=parser.getboolean("BACKENDS", "HEDGE", fallback=True),
+                       hedge_percentile=parser.getfloat("BACKENDS", "HEDGE_PERCENTILE", fallback=95),
+                       min_samples=parser.getint("BACKENDS", "MIN_SAMPLES", fallback=20),
+                       max_errors=parser.getint("BACKENDS", "MAX_ERRORS", fallback=3),
+                       cooldown=parser.getfloat("BACKENDS", "COOLDOWN", fallback=60))
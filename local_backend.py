@@ -0,0 +1,206 @@
+import copy
+import json
+import time
+import queue
+import threading
+import types
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+
+class LocalBackend:
+    # Local transformers model with the chat.completions.create interface of the OpenAI client, so it
+    # can be used as `client` in chatgpt.py or as one of the backends of llm_backends.BackendPool.
+    # Requests from concurrent callers are queued and generated together: the worker waits up to
+    # max_wait seconds to fill a batch of max_batch_size sequences (n choices count as n sequences).
+    # The KV cache of the prompt prefix shared by the batch (or by consecutive requests, e.g. the
+    # instructions of a task) is computed once and reused
+
+    def __init__(self, model_dir, max_batch_size=8, max_wait=0.05, threads=None, prefix_cache_size=4,
+                 min_prefix_tokens=16):
+        if threads:
+            torch.set_num_threads(threads)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_dir)
+        self.model.eval()
+        self.model_name = model_dir
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.prefix_cache_size = prefix_cache_size
+        self.min_prefix_tokens = min_prefix_tokens
+        self.prefix_cache = OrderedDict()
+        self.last_prompt = None
+
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    def create(self, model=None, messages=None, max_tokens=1000, temperature=1.0, n=1, logprobs=False,
+               top_logprobs=None, response_format=None, **kwargs):
+        # Same arguments as the OpenAI API (unsupported ones, e.g. frequency_penalty, are ignored)
+        request = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "n": n,
+            "logprobs": logprobs,
+            "top_logprobs": top_logprobs or 0,
+            "response_format": response_format,
+            "future": Future()
+        }
+        self.queue.put(request)
+        return request["future"].result()
+
+    def run(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while sum(request["n"] for request in requests) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # A batch shares the generation settings
+            groups = {}
+            for request in requests:
+                settings = (request["temperature"], request["max_tokens"], request["logprobs"], request["top_logprobs"])
+                groups.setdefault(settings, []).append(request)
+            for group in groups.values():
+                try:
+                    for request, response in zip(group, self.generate(group)):
+                        request["future"].set_result(response)
+                except Exception as e:
+                    for request in group:
+                        request["future"].set_exception(e)
+
+    def tokenize(self, messages, response_format=None):
+        messages = [dict(message) for message in messages]
+        if response_format and response_format.get("type") == "json_schema":
+            # The schema is not enforced locally, so it is asked for in the prompt (the answer is
+            # validated by the caller anyway)
+            schema = json.dumps(response_format["json_schema"]["schema"])
+            messages[-1]["content"] += f"\n\nAnswer only with a JSON object that follows this JSON schema: {schema}"
+        if self.tokenizer.chat_template:
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        else:
+            text = "\n".join(f"{message['role']}: {message['content']}" for message in messages) + "\nassistant: "
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def get_prefix(self, rows):
+        # Longest cached prefix shared by all the rows, computing a new one when the rows (or the
+        # previous request) share a longer prefix. At least one token of each row is left uncached
+        max_length = min(len(row) for row in rows) - 1
+        candidates = rows + ([self.last_prompt] if self.last_prompt else [])
+        common = 0
+        while len(candidates) > 1 and common < min(max_length, len(candidates[-1])) and all(row[common] == candidates[0][common] for row in candidates):
+            common += 1
+        self.last_prompt = rows[0]
+
+        best = ()
+        for prefix in self.prefix_cache:
+            if len(best) < len(prefix) <= max_length and all(tuple(row[:len(prefix)]) == prefix for row in rows):
+                best = prefix
+
+        if common >= self.min_prefix_tokens and common > len(best):
+            best = tuple(rows[0][:common])
+            with torch.inference_mode():
+                output = self.model(torch.tensor([best]), use_cache=True)
+            self.prefix_cache[best] = output.past_key_values
+            while len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+
+        if not best:
+            return (), None
+        self.prefix_cache.move_to_end(best)
+        return best, self.prefix_cache[best]
+
+    def generate(self, group):
+        temperature, max_tokens, logprobs, top_logprobs = (group[0]["temperature"], group[0]["max_tokens"],
+                                                           group[0]["logprobs"], group[0]["top_logprobs"])
+        prompts = [self.tokenize(request["messages"], request["response_format"]) for request in group]
+        rows = [prompt for request, prompt in zip(group, prompts) for _ in range(request["n"])]
+
+        prefix, prefix_cache = self.get_prefix(rows)
+        # prefix + padding + rest of the prompt: the padding is masked and the positions come from the mask
+        suffix_length = max(len(row) - len(prefix) for row in rows)
+        pad = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([list(prefix) + [pad] * (suffix_length - len(row) + len(prefix)) + row[len(prefix):]
+                                  for row in rows])
+        attention_mask = torch.tensor([[1] * len(prefix) + [0] * (suffix_length - len(row) + len(prefix))
+                                       + [1] * (len(row) - len(prefix)) for row in rows])
+
+        generation_args = {}
+        if prefix_cache is not None:
+            cache = copy.deepcopy(prefix_cache)
+            cache.batch_repeat_interleave(len(rows))
+            generation_args["past_key_values"] = cache
+        if temperature > 0:
+            generation_args.update(do_sample=True, temperature=temperature, top_k=0)
+        else:
+            generation_args["do_sample"] = False
+
+        with torch.inference_mode():
+            output = self.model.generate(input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=max_tokens,
+                                         pad_token_id=pad, return_dict_in_generate=True, output_logits=logprobs,
+                                         **generation_args)
+        new_tokens = output.sequences[:, input_ids.shape[1]:]
+
+        choices = []
+        for i in range(len(rows)):
+            tokens = new_tokens[i].tolist()
+            finish_reason = "length"
+            if self.tokenizer.eos_token_id in tokens:
+                tokens = tokens[:tokens.index(self.tokenizer.eos_token_id)]
+                finish_reason = "stop"
+
+            choice_logprobs = None
+            if logprobs:
+                content = []
+                for step, token in enumerate(tokens):
+                    step_logprobs = torch.log_softmax(output.logits[step][i].float(), dim=-1)
+                    alternatives = torch.topk(step_logprobs, top_logprobs) if top_logprobs else None
+                    content.append(types.SimpleNamespace(
+                        token=self.tokenizer.decode([token]),
+                        logprob=step_logprobs[token].item(),
+                        top_logprobs=[types.SimpleNamespace(token=self.tokenizer.decode([alternative]), logprob=value)
+                                      for value, alternative in zip(alternatives.values.tolist(),
+                                                                    alternatives.indices.tolist())]
+                        if alternatives is not None else []))
+                choice_logprobs = types.SimpleNamespace(content=content)
+
+            choices.append(types.SimpleNamespace(
+                index=i,
+                message=types.SimpleNamespace(role="assistant", content=self.tokenizer.decode(tokens, skip_special_tokens=True)),
+                logprobs=choice_logprobs,
+                finish_reason=finish_reason,
+                n_tokens=len(tokens)))
+
+        # One response per request, with its n choices
+        responses = []
+        start = 0
+        for request, prompt in zip(group, prompts):
+            request_choices = choices[start:start + request["n"]]
+            start += request["n"]
+            for index, choice in enumerate(request_choices):
+                choice.index = index
+            completion_tokens = sum(choice.n_tokens for choice in request_choices)
+            responses.append(types.SimpleNamespace(
+                model=self.model_name,
+                choices=request_choices,
+                usage=types.SimpleNamespace(
+                    prompt_tokens=len(prompt),
+                    completion_tokens=completion_tokens,
+                    total_tokens=len(prompt) + completion_tokens,
+                    prompt_tokens_details=types.SimpleNamespace(cached_tokens=len(prefix)))))
+        return responses
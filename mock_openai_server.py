@@ -0,0 +1,269 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint, to measure the tasks of chatgpt.py without
+spending money on the real API.
+
+The answers are canned but task-aware (query variants, controversy scores, evaluation scores,
+passages, narratives, packed answers and JSON-schema answers) and deterministic: they only depend on
+the seed, the prompt, the temperature and the choice index. A fraction of the requests can fail with
+429 or return malformed answers, and the latency follows a log-normal distribution plus a time per
+generated token.
+
+Example:
+    python mock_openai_server.py --port 8000 --latency_median 0.8 --error_rate 0.02 --malformed_rate 0.02
+and in config.ini:
+    [OPENAI]
+    API_KEY = mock
+    BASE_URL = http://127.0.0.1:8000/v1
+"""
+
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+WORDS = ["treatment", "evidence", "risk", "benefit", "symptoms", "study", "effective", "safe", "doctor",
+         "health", "remedy", "cause", "prevent", "cure", "side effects", "clinical", "natural", "vaccine"]
+
+
+class MockOpenAI:
+    # Answer generation and failure injection, shared by the request handlers
+
+    def __init__(self, seed=0, latency_median=0.5, latency_sigma=0.5, token_latency=0.0, error_rate=0.0,
+                 malformed_rate=0.0, sleep=True):
+        self.seed = seed
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.sleep = sleep
+        self.attempts = {}
+        self.cached_prefixes = set()
+        self.lock = threading.Lock()
+
+    def rng(self, *key):
+        return random.Random(":".join(str(k) for k in (self.seed,) + key))
+
+    def complete(self, body):
+        # Returns (status, response body, latency)
+        prompt = "\n".join(message["content"] for message in body["messages"])
+        prompt_hash = hashlib.sha1(prompt.encode()).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(prompt_hash, 0)
+            self.attempts[prompt_hash] = attempt + 1
+        rng = self.rng(prompt_hash, attempt)
+        latency = self.latency_median * rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else self.latency_median
+
+        if rng.random() < self.error_rate:
+            return 429, {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}, latency / 10
+
+        temperature = body.get("temperature", 1.0)
+        schema = None
+        if body.get("response_format", {}).get("type") == "json_schema":
+            schema = body["response_format"]["json_schema"]["schema"]
+
+        choices = []
+        completion_tokens = 0
+        for index in range(body.get("n", 1)):
+            choice_rng = self.rng(prompt_hash, temperature, index)
+            content = json.dumps(self.from_schema(schema, prompt, choice_rng)) if schema else self.answer(body["messages"][-1]["content"], choice_rng)
+            if rng.random() < self.malformed_rate:
+                content = self.malform(content, rng)
+            tokens = self.tokenize(content)
+            completion_tokens += len(tokens)
+            choice = {"index": index, "message": {"role": "assistant", "content": content}, "finish_reason": "stop",
+                      "logprobs": None}
+            if body.get("logprobs"):
+                choice["logprobs"] = {"content": self.logprobs(tokens, body.get("top_logprobs") or 0, choice_rng)}
+            choices.append(choice)
+
+        prompt_tokens = len(prompt) // 4 + 7
+        response = {
+            "id": f"chatcmpl-mock-{prompt_hash[:12]}-{attempt}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": self.cached_tokens(prompt)}
+            }
+        }
+        return 200, response, latency + self.token_latency * completion_tokens
+
+    def cached_tokens(self, prompt):
+        # Like the API: prompts of 1024 tokens or more have their prefix cached in steps of 128 tokens
+        # (4 characters per token here)
+        boundaries = list(range(1024, len(prompt) // 4 + 1, 128))
+        hashes = [hashlib.sha1(prompt[:boundary * 4].encode()).hexdigest() for boundary in boundaries]
+        with self.lock:
+            cached = max([boundary for boundary, h in zip(boundaries, hashes) if h in self.cached_prefixes], default=0)
+            self.cached_prefixes.update(hashes)
+        return cached
+
+    def answer(self, prompt, rng):
+        # Free-text answer in the format that each prompt of chatgpt.py asks for
+        if "Queries\n" in prompt:
+            ids = re.findall(r"^(\S+): ", prompt.split("Queries\n", 1)[1], flags=re.MULTILINE)
+            if "controversy" in prompt:
+                factors = "JSON array of scores" in prompt
+                return json.dumps({topic_id: self.controversy(rng) if factors else rng.randint(1, 5) for topic_id in ids})
+            return json.dumps({topic_id: self.evaluation(prompt, rng) for topic_id in ids})
+        if "alternative queries" in prompt:
+            n = int(re.search(r"list of (\d+) alternative", prompt).group(1))
+            return json.dumps([self.sentence(rng, 4, 8).rstrip(".") + "?" for _ in range(n)])
+        if "different controversy raters" in prompt:
+            judges = int(re.search(r"(\d+) different controversy raters", prompt).group(1))
+            return json.dumps([rng.randint(1, 5) for _ in range(judges)])
+        if "level of controversy" in prompt:
+            if "JSON array of scores" in prompt:
+                return json.dumps(self.controversy(rng))
+            return str(rng.randint(1, 5))
+        if "integer scale of 0 to 2" in prompt:
+            return json.dumps(self.evaluation(prompt, rng))
+        if "||PAS||" in prompt:
+            return " ||PAS|| ".join(self.paragraph(rng) for _ in range(rng.randint(2, 5)))
+        return self.paragraph(rng)
+
+    def from_schema(self, schema, prompt, rng):
+        # Random value that follows a JSON schema (the subset used by get_response_schema)
+        if "enum" in schema:
+            return rng.choice(schema["enum"])
+        if schema["type"] == "object":
+            return {key: self.from_schema(value, prompt, rng) for key, value in schema["properties"].items()}
+        if schema["type"] == "array":
+            items = schema["items"]
+            if "enum" in items:
+                judges = re.search(r"(\d+) different controversy raters", prompt)
+                if judges:
+                    return [rng.randint(1, 5) for _ in range(int(judges.group(1)))]
+                return self.controversy(rng)
+            n = re.search(r"list of (\d+) alternative", prompt)
+            if n:
+                return [self.sentence(rng, 4, 8).rstrip(".") + "?" for _ in range(int(n.group(1)))]
+            return [self.paragraph(rng) for _ in range(rng.randint(2, 5))]
+        if schema["type"] == "integer":
+            return rng.randint(1, 5)
+        return self.sentence(rng, 4, 8)
+
+    def controversy(self, rng):
+        factors = [rng.randint(1, 5) for _ in range(4)]
+        return factors + [round(sum(factors) / 4)]
+
+    def evaluation(self, prompt, rng):
+        if '"S"' in prompt:
+            return {"S": rng.randint(0, 2), "C": rng.randint(0, 2), "H": rng.randint(0, 2)}
+        return {"H": rng.randint(0, 2)}
+
+    def sentence(self, rng, min_words=6, max_words=14):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+        return " ".join(words).capitalize() + "."
+
+    def paragraph(self, rng):
+        return " ".join(self.sentence(rng) for _ in range(rng.randint(2, 4)))
+
+    def malform(self, content, rng):
+        kind = rng.choice(["truncate", "prose", "single_quotes"])
+        if kind == "truncate":
+            return content[:max(1, len(content) // 2)]
+        if kind == "prose":
+            return f"Sure! Here is my answer:\n{content}\nLet me know if you need anything else"
+        return content.replace('"', "'")
+
+    def tokenize(self, content):
+        return re.findall(r"\d|\w+|[^\w\s]|\s+", content)
+
+    def logprobs(self, tokens, top_logprobs, rng):
+        content = []
+        for token in tokens:
+            if token.isdigit():
+                # Spread the probability over the neighbouring scores
+                weights = {str(score): rng.random() ** 3 for score in range(1, 6)}
+                weights[token] = weights.get(token, 0) + 1
+                total = sum(weights.values())
+                alternatives = sorted(((alt, weight / total) for alt, weight in weights.items()), key=lambda x: -x[1])
+            else:
+                alternatives = [(token, 0.99)]
+            logprob = {alt: round(math.log(p), 6) for alt, p in alternatives}
+            content.append({
+                "token": token,
+                "logprob": logprob.get(token, -20.0),
+                "bytes": list(token.encode()),
+                "top_logprobs": [{"token": alt, "logprob": logprob[alt], "bytes": list(alt.encode())}
+                                 for alt, _ in alternatives[:top_logprobs]]
+            })
+        return content
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes, which Nagle's algorithm would delay by ~40 ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            status, response, latency = mock.complete(body)
+            if mock.sleep:
+                time.sleep(latency)
+            self.send_json(status, response, {"retry-after-ms": "200"} if status == 429 else None)
+
+    return Handler
+
+
+def start_server(port=0, **options):
+    # Runs the server in a background thread. Returns the server and its base URL
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(MockOpenAI(**options)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency_median", type=float, default=0.5, help="Median latency of a request in seconds")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="Sigma of the log-normal latency (0 for a constant latency)")
+    parser.add_argument("--token_latency", type=float, default=0.0, help="Extra seconds per generated token")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with a 429")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Fraction of choices with a malformed answer")
+
+
+def get_server_options(args):
+    return {"seed": args.seed, "latency_median": args.latency_median, "latency_sigma": args.latency_sigma,
+            "token_latency": args.token_latency, "error_rate": args.error_rate, "malformed_rate": args.malformed_rate}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server")
+    parser.add_argument("--port", type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(MockOpenAI(**get_server_options(args))))
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
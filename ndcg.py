@@ -0,0 +1,134 @@
+"""
+nDCG@k of TREC runs with helpful-only and harmful-only qrels, computed in-process with the
+conventions of trec_eval's ndcg_cut: the gain of a document is its grade (negative grades count as
+0), the discount of rank i (from 1) is log2(i + 1), the ranking is sorted by decreasing score with
+ties broken by decreasing docno, and only the topics of both the run and the qrels are evaluated.
+
+The qrels can be a harmful-only / helpful-only file (e.g. misinfo-qrels-graded.harmful-only.tsv or
+the CLEF qtrust positive/negative files) or a graded file where harmful documents have negative
+grades (e.g. TREC 2022 misinfo-qrels.graded.tsv, CLEF task1_qtrust_mapped_v2.tsv): with --negate the
+grades are negated, so the harmful documents become the relevant ones (harmful-only nDCG).
+
+For each qrels the ideal DCG of every topic and cutoff is computed once, and each run becomes a
+topics x max(k) matrix of gains whose discounted cumulative sum gives nDCG at all the cutoffs, so
+many runs x qrels x cutoffs are evaluated in one process.
+
+Example:
+    python ndcg.py --runs runs/2020 --qrels harmful_only=TREC_2020_BEIR/qrels/misinfo-qrels-graded.harmful-only.tsv \
+        --output_dir ndcg_harmful_only_results
+    python ndcg.py --runs runs/2022/* --qrels harmful_only=TREC_2022_BEIR/qrels/misinfo-qrels.graded.tsv --negate harmful_only
+"""
+
+import os
+import glob
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import trec_io
+import trec_store
+
+
+CUTOFFS = [5, 10, 15, 20, 30, 100, 200, 500, 1000]
+
+
+def gains(qrels, negate=False):
+    # Qrels with a "gain" column (grades below 0 count as 0, as in trec_eval)
+    grades = -qrels["grade"] if negate else qrels["grade"]
+    return qrels.assign(gain=grades.clip(lower=0).astype(float))
+
+
+def discounts(max_k):
+    return 1 / np.log2(np.arange(2, max_k + 2))
+
+
+def ideal_dcg(qrels, cutoffs=CUTOFFS):
+    # Ideal DCG of every topic of the qrels (index) at every cutoff (columns)
+    max_k = max(cutoffs)
+    topics = pd.Index(trec_io.sort_topics(qrels["topic"].unique()))
+    relevant = qrels[qrels["gain"] > 0].sort_values(["topic", "gain"], ascending=[True, False])
+    position = relevant.groupby("topic").cumcount().to_numpy()
+    keep = position < max_k
+    matrix = np.zeros((len(topics), max_k))
+    matrix[topics.get_indexer(relevant["topic"][keep]), position[keep]] = relevant["gain"].to_numpy()[keep]
+    dcg = np.cumsum(matrix * discounts(max_k), axis=1)
+    return pd.DataFrame(dcg[:, np.array(cutoffs) - 1], index=topics, columns=list(cutoffs))
+
+
+def ndcg(run, qrels, cutoffs=CUTOFFS, ideal=None):
+    # nDCG of a run (trec_io.read_run) for the topics of both the run and the qrels (with a gain
+    # column, see gains), as a DataFrame with one column per cutoff
+    max_k = max(cutoffs)
+    ideal = ideal_dcg(qrels, cutoffs) if ideal is None else ideal
+    topics = ideal.index[ideal.index.isin(run["topic"].unique())]
+    top = run[run["rank"] < max_k].merge(qrels[qrels["gain"] > 0][["topic", "docno", "gain"]], on=["topic", "docno"])
+    top = top[top["topic"].isin(topics)]
+
+    matrix = np.zeros((len(topics), max_k))
+    matrix[topics.get_indexer(top["topic"]), top["rank"].to_numpy()] = top["gain"].to_numpy()
+    dcg = np.cumsum(matrix * discounts(max_k), axis=1)[:, np.array(cutoffs) - 1]
+    idcg = ideal.loc[topics].to_numpy()
+    scores = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+    return pd.DataFrame(scores, index=topics, columns=list(cutoffs))
+
+
+def evaluate(run_paths, qrels_specs, cutoffs=CUTOFFS):
+    # qrels_specs: list of (name, path, negate). Returns a DataFrame with columns run, qrels, topic,
+    # ndcg_cut_<k>. Every file is read once and the ideal DCGs are shared by all the runs
+    qrels_list = []
+    for name, path, negate in qrels_specs:
+        qrels = gains(trec_io.read_qrels(path), negate)
+        qrels_list.append((name, qrels, ideal_dcg(qrels, cutoffs)))
+
+    tables = []
+    for run_path in run_paths:
+        run = trec_io.read_run(run_path, depth=max(cutoffs))
+        for name, qrels, ideal in qrels_list:
+            scores = ndcg(run, qrels, cutoffs, ideal)
+            scores.columns = [f"ndcg_cut_{k}" for k in cutoffs]
+            scores.insert(0, "topic", scores.index)
+            scores.insert(0, "qrels", name)
+            scores.insert(0, "run", os.path.splitext(os.path.basename(run_path))[0])
+            tables.append(scores.reset_index(drop=True))
+    return pd.concat(tables, ignore_index=True)
+
+
+def parse_qrels_spec(spec, negated):
+    # [name=]path
+    name, path = spec.split("=", 1) if "=" in spec else (trec_io.name(spec), spec)
+    return name, path, name in negated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="nDCG@k of TREC runs with helpful-only / harmful-only qrels")
+    parser.add_argument("--runs", nargs="+", required=True, help="Run files or directories of runs")
+    parser.add_argument("--qrels", nargs="+", required=True, help="Qrels files, as path or name=path")
+    parser.add_argument("--negate", nargs="*", default=[], help="Names of the qrels whose grades are negated (harmful-only "
+                                                                "nDCG from qrels where harmful documents have negative grades)")
+    parser.add_argument("--cutoffs", nargs="+", type=int, default=CUTOFFS)
+    parser.add_argument("--output", type=str, help="CSV file with all the results")
+    parser.add_argument("--store", type=str, default=None, help="Read the files through the binary store in this directory (see trec_store.py)")
+    parser.add_argument("--output_dir", type=str,
+                        help="Directory for one CSV per run and qrels, as ndcg_<qrels>_output_<run>.csv (run, topic, ndcg_cut_<k>)")
+    args = parser.parse_args()
+
+    run_paths = []
+    for path in args.runs:
+        run_paths += sorted(p for p in glob.glob(os.path.join(path, "*")) if os.path.isfile(p)) if os.path.isdir(path) else [path]
+    specs = [parse_qrels_spec(spec, args.negate) for spec in args.qrels]
+    if args.store:
+        trec_store.open_store(args.store, run_paths, [path for _, path, _ in specs])
+    results = evaluate(run_paths, specs, args.cutoffs)
+
+    if args.output:
+        results.to_csv(args.output, index=False, float_format="%.4f")
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for (run_name, qrels_name), table in results.groupby(["run", "qrels"], sort=False):
+            path = os.path.join(args.output_dir, f"ndcg_{qrels_name}_output_{run_name}.csv")
+            table.drop(columns="qrels").to_csv(path, index=False, float_format="%.4f")
+    if not args.output and not args.output_dir:
+        print(results.to_csv(index=False, float_format="%.4f"))
+    else:
+        print(f"Evaluated {len(run_paths)} runs with {len(specs)} qrels")
@@ -1,4 +1,10 @@
+import os
+import glob
+import json
+import hashlib
+import argparse
 import torch
+import numpy as np
 from transformers import AlbertTokenizer, AlbertForSequenceClassification
 import xml.etree.ElementTree as ET
 import pandas as pd
@@ -9,6 +15,14 @@ import pandas as pd
 # 2021, 2022, clef
 corpus = "clef"
 
+MODEL_NAME = 'dejanseo/Query-Quality-Classifier'
+MAX_LENGTH = 32
+BATCH_SIZE = 64
+CACHE_PATH = './confidences_query_quality_classifier/confidence_cache.sqlite'
+
+# Optional ConfidenceCache (see open_cache), used by classify_queries
+cache = None
+
 
 def fetch_topics(corpus):
     tree = ET.parse(f"./topics/topics_{corpus}.xml")
@@ -58,39 +72,107 @@ def fetch_topics(corpus):
             }
     return topics
 
+def load_model(model_name=MODEL_NAME):
+    # Load the model and tokenizer from the Hugging Face Model Hub (or a local directory)
+    tokenizer = AlbertTokenizer.from_pretrained(model_name)
+    model = AlbertForSequenceClassification.from_pretrained(model_name)
+    # Set the model to evaluation mode
+    model.eval()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device)
+    return tokenizer, model, device
+
+
+def normalize_query(query):
+    # The tokenizer collapses whitespace (and lowercases, if do_lower_case is set), so these
+    # variations of a query get the same confidence
+    query = " ".join(query.split())
+    return query.lower() if getattr(tokenizer, "do_lower_case", False) else query
+
+
+def model_revision(model_name):
+    # Hub commit of the model, or a hash of the names, sizes and modification times of the files of
+    # a local model (a directory or an ONNX file)
+    if os.path.exists(model_name):
+        paths = sorted(glob.glob(os.path.join(model_name, "*"))) if os.path.isdir(model_name) else [model_name]
+        stats = [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+        return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+    return getattr(getattr(model, "config", None), "_commit_hash", None)
+
+
+def open_cache(model_name, path=CACHE_PATH, backend="pytorch"):
+    # Sets the ConfidenceCache used by classify_queries, for the loaded model
+    global cache
+    from confidence_cache import ConfidenceCache
+    settings = {"backend": backend, "max_length": MAX_LENGTH, "tokenizer": type(tokenizer).__name__,
+                "do_lower_case": getattr(tokenizer, "do_lower_case", None),
+                "vocab_size": len(tokenizer)}
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = ConfidenceCache(path, model_name, model_revision(model_name), settings)
+    return cache
+
+
+def classify_queries(queries, batch_size=BATCH_SIZE):
+    # Confidence (0-100) of the well-formed class for each query, as a NumPy array in the order of
+    # the queries. With a cache, only the queries that are not in it are scored (each one once)
+    if cache is None:
+        return run_model(queries, batch_size)
+
+    keys = [normalize_query(query) for query in queries]
+    confidences = cache.get(set(keys))
+    new = list(dict.fromkeys(key for key in keys if key not in confidences))
+    if new:
+        new_confidences = dict(zip(new, run_model(new, batch_size).tolist()))
+        cache.put(new_confidences)
+        confidences.update(new_confidences)
+    return np.array([confidences[key] for key in keys], dtype=np.float32)
+
+
+def run_model(queries, batch_size=BATCH_SIZE):
+    # The queries are sorted by length so that each batch is padded only to its longest query
+    # instead of to MAX_LENGTH
+    encodings = tokenizer(list(queries), add_special_tokens=True, max_length=MAX_LENGTH, truncation=True)["input_ids"]
+    order = np.argsort([len(ids) for ids in encodings], kind="stable")
+
+    confidences = np.empty(len(encodings), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            inputs = tokenizer.pad({"input_ids": [encodings[i] for i in batch]}, return_attention_mask=True,
+                                   return_tensors='pt')
+            logits = model(inputs['input_ids'].to(device), attention_mask=inputs['attention_mask'].to(device)).logits
+            # Confidence for well-formed class
+            confidences[batch] = (torch.softmax(logits, dim=1)[:, 1] * 100).cpu().numpy()
+    return confidences
+
+
 def classify_query(query):
-    inputs = tokenizer.encode_plus(
-        query,
-        add_special_tokens=True,
-        max_length=32,
-        padding='max_length',
-        truncation=True,
-        return_attention_mask=True,
-        return_tensors='pt'
-    )
-
-    input_ids = inputs['input_ids'].to(device)
-    attention_mask = inputs['attention_mask'].to(device)
-
-    with torch.no_grad():
-        outputs = model(input_ids, attention_mask=attention_mask)
-        logits = outputs.logits
-        softmax_scores = torch.softmax(logits, dim=1).cpu().numpy()[0]
-        confidence = softmax_scores[1] * 100  # Confidence for well-formed class
-    
-    return confidence
+    return classify_queries([query])[0]
 
 
-def main():
+def classify_variants(corpus, batch_size=BATCH_SIZE):
+    # Scores the generated query variants (query_variants_T07/<corpus>/**/*.jsonl) in a single call
+    rows = []
+    for path in sorted(glob.glob(f"./query_variants_T07/{corpus}/**/*.jsonl", recursive=True)):
+        with open(path) as f:
+            for line in f:
+                variant = json.loads(line)
+                rows.append({"file": os.path.relpath(path, f"./query_variants_T07/{corpus}"),
+                             "topic": variant["_id"], "query": variant["text"]})
+    df = pd.DataFrame(rows, columns=["file", "topic", "query"])
+    df["confidence"] = classify_queries(df["query"].tolist(), batch_size=batch_size)
+    df.to_csv(f"./confidences_query_quality_classifier/confidences_variants_{corpus}.csv", index=False)
+    return df
+
+
+def main(batch_size=BATCH_SIZE):
 
     topics = fetch_topics(corpus)
     
+    scores = classify_queries([topic["title"] for topic in topics.values()], batch_size=batch_size)
     confidences = {}
-    for topic_id, topic in topics.items():
-        query = topic["title"]
-
-        confidence = classify_query(query)
-
+    for topic_id, confidence in zip(topics, scores):
         if confidence >= 50:
             print(f"Query Score: {confidence:.2f}% Most likely doesn't require query expansion.")
         else:
@@ -103,13 +185,32 @@ def main():
 
 
 if __name__ == "__main__":
-    # Load the model and tokenizer from the Hugging Face Model Hub
-    model_name = 'dejanseo/Query-Quality-Classifier'
-    tokenizer = AlbertTokenizer.from_pretrained(model_name)
-    model = AlbertForSequenceClassification.from_pretrained(model_name)
-    # Set the model to evaluation mode
-    model.eval()
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model.to(device)
+    parser = argparse.ArgumentParser(description="Query Quality Classifier confidences for the topics of a corpus")
+    parser.add_argument("--corpus", choices=["2020", "2021", "2022", "clef"], default=corpus)
+    parser.add_argument("--model", type=str, default=MODEL_NAME, help="Hugging Face model name or local directory")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--variants", action="store_true", help="Also score the generated query variants of the corpus")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"], default="pytorch")
+    parser.add_argument("--onnx", type=str, default="onnx_qqc/model.int8.onnx",
+                        help="ONNX model for --backend onnx (see query_quality_classifier_onnx.py)")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads for the inference")
+    parser.add_argument("--cache", type=str, default=CACHE_PATH, help="SQLite cache of confidences")
+    parser.add_argument("--no_cache", action="store_true", help="Score every query again")
+    args = parser.parse_args()
+    corpus = args.corpus
+
+    if args.backend == "onnx":
+        from query_quality_classifier_onnx import load_onnx_model
+        tokenizer, model, device = load_onnx_model(args.onnx, threads=args.threads)
+    else:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        tokenizer, model, device = load_model(args.model)
+    if not args.no_cache:
+        open_cache(args.onnx if args.backend == "onnx" else args.model, args.cache, args.backend)
     
-    main()
\ No newline at end of file
+    main(args.batch_size)
+    if args.variants:
+        classify_variants(corpus, args.batch_size)
+    if cache is not None:
+        cache.print_stats()
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+ONNX Runtime backend for the Query Quality Classifier, for the scoring nodes without a GPU.
+
+The export step writes the ALBERT model to ONNX (batch size and sequence length are dynamic) and,
+optionally, a copy with its weights quantized to int8. The ONNX models can be used in place of the
+PyTorch one by query_quality_classifier.py, and the check compares their confidences and speed with
+the PyTorch ones on all the topics in topics/.
+
+Example:
+    python query_quality_classifier_onnx.py export --output onnx_qqc
+    python query_quality_classifier_onnx.py check --onnx onnx_qqc/model.onnx onnx_qqc/model.int8.onnx --threads 4
+    python query_quality_classifier.py --corpus 2021 --backend onnx --onnx onnx_qqc/model.int8.onnx --threads 4
+"""
+
+import os
+import time
+import types
+import inspect
+import tempfile
+import argparse
+import torch
+import numpy as np
+import onnx
+import onnxruntime as ort
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from onnxruntime.transformers import optimizer
+from transformers import AlbertTokenizer
+
+import query_quality_classifier as qqc
+
+
+class LogitsOnly(torch.nn.Module):
+    # The exported graph returns only the logits
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids, attention_mask=attention_mask).logits
+
+
+class OnnxClassifier:
+    # ONNX Runtime session with the calling convention of AlbertForSequenceClassification, so that
+    # query_quality_classifier.classify_queries works unchanged with it as `model`
+
+    def __init__(self, path, threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # One batch at a time: all the threads go to the operators of the batch
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_ids, attention_mask):
+        logits = self.session.run(["logits"], {"input_ids": input_ids.cpu().numpy().astype(np.int64),
+                                               "attention_mask": attention_mask.cpu().numpy().astype(np.int64)})[0]
+        return types.SimpleNamespace(logits=torch.from_numpy(logits))
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
+def load_onnx_model(path, threads=None):
+    # Same as query_quality_classifier.load_model, with the tokenizer saved next to the ONNX model
+    tokenizer = AlbertTokenizer.from_pretrained(os.path.dirname(os.path.abspath(path)))
+    return tokenizer, OnnxClassifier(path, threads=threads), torch.device("cpu")
+
+
+def export_onnx(model_name, output_dir, quantize=True, opset=14):
+    # Writes model.onnx (and model.int8.onnx with dynamic int8 quantization of the weights) and the
+    # tokenizer to output_dir. Batch size and sequence length are dynamic
+    tokenizer, model, _ = qqc.load_model(model_name)
+    model.to("cpu")
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer.save_pretrained(output_dir)
+
+    inputs = tokenizer(["is vitamin c good for colds", "ibuprofen covid"], padding=True, return_tensors="pt")
+    path = os.path.join(output_dir, "model.onnx")
+    # Newer versions of torch default to the dynamo exporter; the TorchScript one is used everywhere
+    extra_args = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(LogitsOnly(model), (inputs["input_ids"], inputs["attention_mask"]), path,
+                      input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                      dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                    "attention_mask": {0: "batch", 1: "sequence"},
+                                    "logits": {0: "batch"}},
+                      opset_version=opset, do_constant_folding=True, **extra_args)
+    paths = [path]
+
+    if quantize:
+        # The attention, layer normalization and GELU subgraphs are fused first: quantizing the graph
+        # as exported leaves most of the time in the unquantized operators around the MatMuls
+        quantized_path = os.path.join(output_dir, "model.int8.onnx")
+        fused = optimizer.optimize_model(path, model_type="bert", num_heads=model.config.num_attention_heads,
+                                         hidden_size=model.config.hidden_size)
+        with tempfile.TemporaryDirectory() as tmp:
+            fused_path = os.path.join(tmp, "model.fused.onnx")
+            fused.save_model_to_file(fused_path)
+            # Shape inference does not know the types of the outputs of the fused operators
+            quantize_dynamic(fused_path, quantized_path, weight_type=QuantType.QInt8,
+                             extra_options={"DefaultTensorType": onnx.TensorProto.FLOAT})
+        paths.append(quantized_path)
+    return paths
+
+
+def fetch_all_queries():
+    # Titles and descriptions of every topic in topics/
+    queries = []
+    for corpus in ["2020", "2021", "2022", "clef"]:
+        for topic in qqc.fetch_topics(corpus).values():
+            for field in ["title", "description"]:
+                if topic.get(field) and topic[field] not in queries:
+                    queries.append(topic[field])
+    return queries
+
+
+def time_classifier(queries, batch_size, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        confidences = qqc.classify_queries(queries, batch_size=batch_size)
+        times.append(time.time() - start)
+    return confidences, min(times)
+
+
+def check_onnx(model_name, onnx_paths, tolerance=1.0, batch_size=qqc.BATCH_SIZE, threads=None):
+    # Accuracy check (confidences within `tolerance` points of the PyTorch ones and same well-formed
+    # decisions) and speed comparison on all the topics in topics/
+    queries = fetch_all_queries()
+    qqc.tokenizer, qqc.model, qqc.device = qqc.load_model(model_name)
+    if threads:
+        torch.set_num_threads(threads)
+    reference, reference_time = time_classifier(queries, batch_size)
+    print(f"{len(queries)} queries")
+    print(f"pytorch: {reference_time:.3f}s")
+
+    valid = True
+    for path in onnx_paths:
+        qqc.model = OnnxClassifier(path, threads=threads)
+        confidences, onnx_time = time_classifier(queries, batch_size)
+        difference = np.abs(confidences - reference)
+        same_decision = np.mean((confidences >= 50) == (reference >= 50))
+        print(f"{os.path.basename(path)}: {onnx_time:.3f}s ({reference_time / onnx_time:.2f}x), max difference "
+              f"{difference.max():.4f}, mean difference {difference.mean():.4f}, same decision {same_decision:.2%}")
+        valid = valid and difference.max() <= tolerance
+    print("Within tolerance" if valid else f"NOT within the tolerance of {tolerance}")
+    return valid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ONNX Runtime backend for the Query Quality Classifier")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Export the model to ONNX")
+    export_parser.add_argument("--model", type=str, default=qqc.MODEL_NAME)
+    export_parser.add_argument("--output", type=str, default="onnx_qqc")
+    export_parser.add_argument("--no_quantize", action="store_true", help="Do not write the int8 model")
+
+    check_parser = subparsers.add_parser("check", help="Compare the ONNX models with the PyTorch one")
+    check_parser.add_argument("--model", type=str, default=qqc.MODEL_NAME)
+    check_parser.add_argument("--onnx", nargs="+", default=["onnx_qqc/model.onnx", "onnx_qqc/model.int8.onnx"])
+    check_parser.add_argument("--tolerance", type=float, default=1.0, help="Maximum difference in confidence points")
+    check_parser.add_argument("--batch_size", type=int, default=qqc.BATCH_SIZE)
+    check_parser.add_argument("--threads", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        for path in export_onnx(args.model, args.output, quantize=not args.no_quantize):
+            print(f"Written {path}")
+    else:
+        check_onnx(args.model, args.onnx, tolerance=args.tolerance, batch_size=args.batch_size, threads=args.threads)
@@ -0,0 +1,50 @@
+import json
+import urllib.request
+import urllib.error
+
+
+# Thin client of query_quality_server.py. It only uses the standard library, so notebooks and other
+# predictors get confidences without importing torch or loading the model:
+#   from query_quality_client import QueryQualityClient
+#   client = QueryQualityClient("http://127.0.0.1:8010")
+#   client.score(["is vitamin c good for colds", "ibuprofen covid"])  # [confidence, confidence]
+
+DEFAULT_URL = "http://127.0.0.1:8010"
+
+
+class QueryQualityClient:
+
+    def __init__(self, url=DEFAULT_URL, timeout=60.0, max_queries=1024):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        # Longer lists are sent in several requests
+        self.max_queries = max_queries
+
+    def request(self, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Query quality server error {e.code}: {e.read().decode()}") from e
+
+    def score(self, queries):
+        # Confidence (0-100) of the well-formed class for each query
+        queries = list(queries)
+        confidences = []
+        for start in range(0, len(queries), self.max_queries):
+            confidences += self.request("/score", {"queries": queries[start:start + self.max_queries]})["confidences"]
+        return confidences
+
+    def score_query(self, query):
+        return self.score([query])[0]
+
+    def health(self):
+        return self.request("/health")
+
+    def is_available(self):
+        try:
+            return self.health()["status"] == "ok"
+        except (OSError, RuntimeError):
+            return False
@@ -0,0 +1,179 @@
+"""
+Local scoring service for the Query Quality Classifier, so that the model is loaded once instead of
+in every script that needs a confidence.
+
+The model (PyTorch or ONNX, see query_quality_classifier_onnx.py) stays in memory and the requests
+of concurrent clients are scored together: the worker waits up to --max_wait seconds to gather
+--max_batch_size queries and runs them as one call to classify_queries. Confidences are kept in the
+same cache as the batch CLI (see confidence_cache.py).
+
+Endpoints (JSON over HTTP on localhost):
+    POST /score   {"queries": ["...", ...]}  ->  {"confidences": [..., ...]}
+    GET  /health  ->  {"status": "ok", "model": ..., "requests": ..., "queries": ..., "batches": ...}
+
+Example:
+    python query_quality_server.py --port 8010 --backend onnx --onnx onnx_qqc/model.int8.onnx
+and from Python (see query_quality_client.py):
+    from query_quality_client import QueryQualityClient
+    QueryQualityClient("http://127.0.0.1:8010").score(["is vitamin c good for colds"])
+"""
+
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+
+import query_quality_classifier as qqc
+
+
+class MicroBatcher:
+    # Scores the queries of concurrent requests together in a single worker thread
+
+    def __init__(self, max_batch_size=qqc.BATCH_SIZE, max_wait=0.01, batch_size=qqc.BATCH_SIZE):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.requests = 0
+        self.queries = 0
+        self.batches = 0
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def score(self, queries):
+        request = {"queries": list(queries), "future": Future()}
+        self.queue.put(request)
+        return request["future"].result()
+
+    def run(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while sum(len(request["queries"]) for request in requests) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            queries = [query for request in requests for query in request["queries"]]
+            try:
+                confidences = qqc.classify_queries(queries, batch_size=self.batch_size).tolist() if queries else []
+            except Exception as e:
+                for request in requests:
+                    request["future"].set_exception(e)
+                continue
+            self.requests += len(requests)
+            self.queries += len(queries)
+            self.batches += 1
+
+            start = 0
+            for request in requests:
+                request["future"].set_result(confidences[start:start + len(request["queries"])])
+                start += len(request["queries"])
+
+
+class Server(ThreadingHTTPServer):
+    # Every client opens a new connection per request: the default backlog of 5 resets connections
+    # when many clients arrive at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher, model_name):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes, which Nagle's algorithm would delay by ~40 ms
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/health":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            self.send_json(200, {"status": "ok", "model": model_name, "requests": batcher.requests,
+                                 "queries": batcher.queries, "batches": batcher.batches})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/score":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                queries = body["queries"]
+                if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                    raise ValueError("queries must be a list of strings")
+            except (ValueError, KeyError) as e:
+                self.send_json(400, {"error": f"Invalid request: {str(e)}"})
+                return
+            try:
+                self.send_json(200, {"confidences": batcher.score(queries)})
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+
+    return Handler
+
+
+def start_server(host="127.0.0.1", port=0, model_name=qqc.MODEL_NAME, backend="pytorch", onnx_path=None,
+                 threads=None, max_batch_size=qqc.BATCH_SIZE, max_wait=0.01, batch_size=qqc.BATCH_SIZE, cache_path=None):
+    # Loads the model and runs the server in a background thread. Returns the server and its URL
+    if backend == "onnx":
+        from query_quality_classifier_onnx import load_onnx_model
+        qqc.tokenizer, qqc.model, qqc.device = load_onnx_model(onnx_path, threads=threads)
+        model_name = onnx_path
+    else:
+        if threads:
+            torch.set_num_threads(threads)
+        qqc.tokenizer, qqc.model, qqc.device = qqc.load_model(model_name)
+    # The first call is slower (memory allocation, graph optimization)
+    qqc.classify_queries(["warm up"])
+    if cache_path:
+        qqc.open_cache(model_name, cache_path, backend)
+
+    batcher = MicroBatcher(max_batch_size=max_batch_size, max_wait=max_wait, batch_size=batch_size)
+    server = Server((host, port), make_handler(batcher, model_name))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query Quality Classifier scoring service")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--model", type=str, default=qqc.MODEL_NAME, help="Hugging Face model name or local directory")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"], default="pytorch")
+    parser.add_argument("--onnx", type=str, default="onnx_qqc/model.int8.onnx", help="ONNX model for --backend onnx")
+    parser.add_argument("--threads", type=int, default=None, help="CPU threads for the inference")
+    parser.add_argument("--max_batch_size", type=int, default=qqc.BATCH_SIZE,
+                        help="Queries gathered from concurrent requests before scoring them")
+    parser.add_argument("--max_wait", type=float, default=0.01, help="Seconds to wait for more requests")
+    parser.add_argument("--batch_size", type=int, default=qqc.BATCH_SIZE, help="Batch size of the model")
+    parser.add_argument("--cache", type=str, default=qqc.CACHE_PATH, help="SQLite cache of confidences")
+    parser.add_argument("--no_cache", action="store_true", help="Score every query again")
+    args = parser.parse_args()
+
+    server, url = start_server(args.host, args.port, model_name=args.model, backend=args.backend, onnx_path=args.onnx,
+                               threads=args.threads, max_batch_size=args.max_batch_size, max_wait=args.max_wait,
+                               batch_size=args.batch_size, cache_path=None if args.no_cache else args.cache)
+    print(f"Query Quality Classifier on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,26 @@
+import time
+import threading
+
+
+class RateLimiter:
+    # Token bucket shared by all the threads of a run. Each request takes one token; the bucket
+    # refills at requests_per_minute / 60 tokens per second and holds at most `burst` tokens
+
+    def __init__(self, requests_per_minute=500, burst=None):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, requests_per_minute // 60)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,126 @@
+"""
+Bootstrap confidence intervals and permutation p-values of the correlations between predictors and
+per-topic results (see correlation.py), for every predictor x target x corpus cell. With ~50 topics
+per corpus a single correlation is noisy, so each cell is resampled many times:
+    bootstrap    the topics are drawn with replacement; the interval is given by the percentiles of
+                 the resampled coefficients
+    permutation  the target is shuffled across the topics; the p-value (two-sided) is the fraction of
+                 shuffles with a coefficient at least as large (in absolute value) as the observed one,
+                 (1 + count) / (1 + resamples)
+
+The resamples of a cell are one integer matrix of topic indices (resamples x topics), and the
+coefficients of all of them are computed at once, in batches of columns (correlation.correlate_pairs).
+The same resamples are used for every method. The cells are spread across a process pool, and each
+one gets its own random generator spawned from --seed, so the results do not depend on the number of
+workers.
+
+The tables are read as in correlation.py: missing values are dropped per cell.
+
+Example:
+    python resampling.py --predictors 2020=confidences_query_quality_classifier/confidences_2020.csv \
+        --targets 2020=compatibility_results/compatibility_2020_title.csv 2020=harmful_at_k/harmful_at_10_2020_bm25.csv \
+        --run all_res_misinfo-2020_bm25_title.csv --resamples 10000 --output resampling_2020.csv
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import correlation
+
+
+RESAMPLES = 10000
+# Resamples correlated at once (the memory grows with topics x batch)
+BATCH = 2000
+
+
+def cells(corpora):
+    # (corpus, predictor, target, x, y) of every cell, with the topics that have both values
+    for corpus, (predictors, targets) in corpora.items():
+        topics = predictors.index.intersection(targets.index)
+        for predictor in predictors.columns:
+            for target in targets.columns:
+                values = pd.concat([predictors.loc[topics, predictor], targets.loc[topics, target]], axis=1).dropna()
+                yield corpus, predictor, target, values.iloc[:, 0].to_numpy(dtype=float), values.iloc[:, 1].to_numpy(dtype=float)
+
+
+def resampled_coefficients(x, y, x_indices, y_indices, method, batch=BATCH):
+    # Coefficients of x[x_indices[b]] with y[y_indices[b]] for every resample b
+    coefficients = np.empty(len(x_indices))
+    for start in range(0, len(x_indices), batch):
+        rows = slice(start, start + batch)
+        coefficients[rows] = correlation.correlate_pairs(x[x_indices[rows]].T, y[y_indices[rows]].T, method)
+    return coefficients
+
+
+def resample_cell(x, y, methods, resamples, alpha, seed, batch=BATCH):
+    # Observed coefficient, bootstrap interval and permutation p-value of a cell for each method
+    n = len(x)
+    rng = np.random.default_rng(seed)
+    bootstrap = rng.integers(0, n, size=(resamples, n))
+    permutation = rng.permuted(np.tile(np.arange(n), (resamples, 1)), axis=1)
+    identity = np.broadcast_to(np.arange(n), permutation.shape)
+
+    rows = []
+    for method in methods:
+        if n < 3:
+            rows.append((method, n, np.nan, np.nan, np.nan, np.nan))
+            continue
+        observed = correlation.correlate_pairs(x[:, None], y[:, None], method)[0]
+        samples = resampled_coefficients(x, y, bootstrap, bootstrap, method, batch)
+        with np.errstate(invalid="ignore"):
+            low, high = (np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+                         if not np.isnan(samples).all() else (np.nan, np.nan))
+        # The ranks do not change when the topics are shuffled: Spearman is Pearson of the ranks
+        px, py, pmethod = (stats.rankdata(x), stats.rankdata(y), "pearson") if method == "spearman" else (x, y, method)
+        shuffled = resampled_coefficients(px, py, identity, permutation, pmethod, batch)
+        pvalue = (1 + np.sum(np.abs(shuffled) >= np.abs(observed) - 1e-12)) / (1 + resamples) \
+            if not np.isnan(observed) else np.nan
+        rows.append((method, n, observed, low, high, pvalue))
+    return rows
+
+
+def resample_task(task):
+    corpus, predictor, target, x, y, methods, resamples, alpha, seed, batch = task
+    return [(corpus, predictor, target) + row for row in resample_cell(x, y, methods, resamples, alpha, seed, batch)]
+
+
+def resample_corpora(corpora, methods=correlation.METHODS, resamples=RESAMPLES, alpha=0.05, seed=0, workers=None,
+                     batch=BATCH):
+    # corpora: {name: (predictors, targets)}. Returns a DataFrame with columns corpus, predictor, target,
+    # method, n, coefficient, ci_low, ci_high, p_value
+    cell_list = list(cells(corpora))
+    seeds = np.random.SeedSequence(seed).spawn(len(cell_list))
+    tasks = [cell + (methods, resamples, alpha, cell_seed, batch) for cell, cell_seed in zip(cell_list, seeds)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = [row for cell_rows in executor.map(resample_task, tasks) for row in cell_rows]
+    return pd.DataFrame(rows, columns=["corpus", "predictor", "target", "method", "n", "coefficient", "ci_low", "ci_high",
+                                       "p_value"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bootstrap intervals and permutation p-values of predictor correlations")
+    parser.add_argument("--predictors", nargs="+", required=True, help="Predictor tables, as corpus=path")
+    parser.add_argument("--targets", nargs="+", required=True, help="Target tables, as corpus=path")
+    parser.add_argument("--run", nargs="*", default=[], help="Runs selected from the tables with several runs")
+    parser.add_argument("--methods", nargs="+", choices=correlation.METHODS, default=correlation.METHODS)
+    parser.add_argument("--resamples", type=int, default=RESAMPLES, help="Bootstrap and permutation resamples per cell")
+    parser.add_argument("--alpha", type=float, default=0.05, help="The intervals have confidence 1 - alpha")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch", type=int, default=BATCH, help="Resamples correlated at once")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: one per core)")
+    parser.add_argument("--output", type=str, help="CSV file for the results (printed if not given)")
+    args = parser.parse_args()
+
+    predictors = correlation.read_tables(args.predictors, args.run)
+    targets = correlation.read_tables(args.targets, args.run)
+    corpora = {corpus: (predictors[corpus], targets[corpus]) for corpus in predictors if corpus in targets}
+    results = resample_corpora(corpora, args.methods, args.resamples, args.alpha, args.seed, args.workers, args.batch)
+    if args.output:
+        results.to_csv(args.output, index=False)
+        print(f"Written {len(results)} cells to {args.output}")
+    else:
+        print(results.to_string(index=False))
@@ -0,0 +1,325 @@
+"""
+Non-interactive runner for the tasks of chatgpt.py.
+
+The grid given by the arguments (or by a JSON config file with the same keys) is expanded into
+independent jobs, which run concurrently and share a single rate limiter. Finished jobs are
+recorded in a manifest and skipped in later runs while their outputs exist.
+
+Example:
+    python run_pipeline.py --corpora 2020 2021 2022 --tasks controversy_temp evaluate --chains_of_thought 0 2
+    python run_pipeline.py --config grid.json --workers 8
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import configparser
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import chatgpt
+from telemetry import Telemetry
+from rate_limiter import RateLimiter
+from llm_backends import create_client
+
+
+# Parameters of the grid that each task uses (the rest are ignored for that task)
+TASK_PARAMS = {
+    "evaluate": ["role", "narrative", "chain_of_thought", "prompt_layout", "structured_outputs"],
+    "evaluate_packed": ["role", "narrative", "chain_of_thought", "pack_size", "structured_outputs"],
+    "variants": ["query_type", "role", "narrative", "chain_of_thought", "n", "prompt_layout", "structured_outputs"],
+    "narratives": ["query_type", "narrative_type", "prompt_layout"],
+    "narratives_variants": ["query_type", "narrative_type", "role", "narrative", "chain_of_thought", "n", "prompt_layout",
+                            "structured_outputs"],
+    "controversy": ["njudges", "samples", "adaptive", "tolerance", "prompt_layout", "structured_outputs"],
+    "controversy_temp": ["factors", "samples", "adaptive", "tolerance", "prompt_layout", "structured_outputs"],
+    "controversy_logprobs": ["prompt_layout"],
+    "controversy_packed": ["factors", "pack_size", "structured_outputs"],
+    "passages": ["prompt_layout", "structured_outputs"],
+}
+
+# Grid argument -> job parameter
+GRID_ARGS = {
+    "query_types": "query_type",
+    "roles": "role",
+    "narratives": "narrative",
+    "chains_of_thought": "chain_of_thought",
+    "n": "n",
+    "narrative_types": "narrative_type",
+    "njudges": "njudges",
+    "samples": "samples",
+    "factors": "factors",
+    "pack_size": "pack_size",
+    "adaptive": "adaptive",
+    "tolerance": "tolerance",
+    "prompt_layout": "prompt_layout",
+    "structured_outputs": "structured_outputs",
+}
+
+
+def str2bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ["true", "1", "yes"]:
+        return True
+    if value.lower() in ["false", "0", "no"]:
+        return False
+    raise argparse.ArgumentTypeError(f"Expected a boolean, got {value}")
+
+
+def expand_grid(args):
+    jobs = {}
+    for corpus, topics_type, task in itertools.product(args.corpora, args.topics_types, args.tasks):
+        params = TASK_PARAMS[task]
+        values = [getattr(args, grid_arg) if GRID_ARGS[grid_arg] in params else [None]
+                  for grid_arg in GRID_ARGS]
+        for combination in itertools.product(*values):
+            job = {"corpus": corpus, "topics_type": topics_type, "task": task}
+            for grid_arg, value in zip(GRID_ARGS, combination):
+                if value is not None:
+                    job[GRID_ARGS[grid_arg]] = value
+            # The tolerance only applies to adaptive sampling (the duplicated jobs are merged below)
+            if not job.get("adaptive"):
+                job.pop("tolerance", None)
+            # Only the "examples" narratives have a prompt layout
+            if task == "narratives" and job["narrative_type"] != "examples":
+                job.pop("prompt_layout", None)
+            # Narratives are always generated from the original topics
+            if task in ["narratives", "narratives_variants"]:
+                job["topics_type"] = "original"
+            jobs[get_job_id(job)] = job
+    return list(jobs.values())
+
+
+def get_job_id(job):
+    return json.dumps(job, sort_keys=True)
+
+
+def get_topics_file(job, topics_files):
+    if job["topics_type"] == "original" and job["corpus"] in topics_files:
+        return topics_files[job["corpus"]]
+    # The generated topics are the narratives written with the layout of the job (legacy for the tasks without one)
+    return chatgpt.get_topics_path(job["corpus"], job.get("query_type", "description"), job["topics_type"],
+                                   job.get("prompt_layout", "legacy"))
+
+
+def run_job(job, topics_files):
+    topics = chatgpt.fetch_topics(get_topics_file(job, topics_files), job["corpus"])
+    corpus = job["corpus"]
+    task = job["task"]
+    layout = job.get("prompt_layout", "legacy")
+    structured = job.get("structured_outputs", True)
+
+    if task == "evaluate":
+        return chatgpt.evaluate_queries(topics, role=job["role"], narrative=job["narrative"],
+                                        chain_of_thought=job["chain_of_thought"], corpus=corpus,
+                                        topics_type=job["topics_type"], layout=layout, structured=structured)
+    elif task == "evaluate_packed":
+        return chatgpt.evaluate_queries_packed(topics, role=job["role"], narrative=job["narrative"],
+                                               chain_of_thought=job["chain_of_thought"],
+                                               pack_size=job.get("pack_size"), corpus=corpus,
+                                               topics_type=job["topics_type"], structured=structured)
+    elif task == "variants":
+        return chatgpt.generate_query_variants(topics, role=job["role"], narrative=job["narrative"],
+                                               chain_of_thought=job["chain_of_thought"], n=job["n"], corpus=corpus,
+                                               query_type=job["query_type"], topics_type=job["topics_type"], layout=layout,
+                                               structured=structured)
+    elif task == "narratives":
+        return chatgpt.write_all_narratives(topics, job["narrative_type"], corpus=corpus, query_type=job["query_type"],
+                                            layout=layout)
+    elif task == "narratives_variants":
+        return chatgpt.generate_narratives_and_variants(topics, job["narrative_type"], role=job["role"],
+                                                        narrative=job["narrative"], chain_of_thought=job["chain_of_thought"],
+                                                        n=job["n"], corpus=corpus, query_type=job["query_type"],
+                                                        layout=layout, structured=structured)
+    elif task == "controversy":
+        return chatgpt.controversy_analysis(topics, corpus, njudges=job["njudges"], samples=job["samples"],
+                                            adaptive=job["adaptive"], tolerance=job.get("tolerance", 1.0),
+                                            topics_type=job["topics_type"], layout=layout, structured=structured)
+    elif task == "controversy_temp":
+        return chatgpt.controversy_analysis_temp(topics, corpus, factors=job["factors"], samples=job["samples"],
+                                                 adaptive=job["adaptive"], tolerance=job.get("tolerance", 1.0),
+                                                 topics_type=job["topics_type"], layout=layout, structured=structured)
+    elif task == "controversy_logprobs":
+        return chatgpt.controversy_analysis_logprobs(topics, corpus, topics_type=job["topics_type"], layout=layout)
+    elif task == "controversy_packed":
+        return chatgpt.controversy_analysis_packed(topics, corpus, factors=job["factors"], pack_size=job.get("pack_size"),
+                                                   topics_type=job["topics_type"], structured=structured)
+    else:  # passages
+        return chatgpt.passage_writing(topics, corpus, topics_type=job["topics_type"], layout=layout,
+                                       structured=structured)
+
+
+def get_outputs(job):
+    # Files written by a job (the same names as the tasks of chatgpt.py)
+    corpus, topics_type, task = job["corpus"], job["topics_type"], job["task"]
+    layout, structured = job.get("prompt_layout"), job.get("structured_outputs")
+    if task in ["evaluate", "evaluate_packed"]:
+        return [chatgpt.get_scores_filename(corpus, topics_type, job["role"], job["narrative"], job["chain_of_thought"],
+                                            packed=task == "evaluate_packed", pack_size=job.get("pack_size"),
+                                            layout=layout, structured=structured) + ".json"]
+    elif task == "variants":
+        filename = chatgpt.get_variants_filename(corpus, job["query_type"], topics_type, job["role"], job["narrative"],
+                                                 job["chain_of_thought"], layout, structured)
+        return [f'{filename}_{i}.jsonl' for i in range(1, job["n"] + 1)]
+    elif task == "narratives":
+        return [chatgpt.get_narratives_filename(job["narrative_type"], corpus, job["query_type"], layout)]
+    elif task == "narratives_variants":
+        filename = chatgpt.get_variants_filename(corpus, job["query_type"], job["narrative_type"], job["role"],
+                                                 job["narrative"], job["chain_of_thought"], layout, structured)
+        return [chatgpt.get_narratives_filename(job["narrative_type"], corpus, job["query_type"], layout)] + \
+            [f'{filename}_{i}.jsonl' for i in range(1, job["n"] + 1)]
+    elif task == "controversy":
+        filename = chatgpt.get_controversy_filename(f'{job["njudges"]}judges', corpus, topics_type, job["samples"],
+                                                    job["adaptive"], job.get("tolerance", 1.0), layout=layout,
+                                                    structured=structured)
+    elif task == "controversy_temp":
+        filename = chatgpt.get_controversy_filename("factors" if job["factors"] else "temps", corpus, topics_type,
+                                                    job["samples"], job["adaptive"], job.get("tolerance", 1.0),
+                                                    layout=layout, structured=structured)
+    elif task == "controversy_logprobs":
+        filename = chatgpt.get_controversy_filename("logprobs", corpus, topics_type, layout=layout)
+    elif task == "controversy_packed":
+        filename = chatgpt.get_controversy_filename("packed_factors" if job["factors"] else "packed", corpus, topics_type,
+                                                    pack_size=job.get("pack_size"), structured=structured)
+    else:  # passages
+        filename = chatgpt.get_passages_filename(corpus, topics_type, layout, structured)
+    return [f'{filename}.csv']
+
+
+def check_outputs(jobs):
+    # Jobs that write the same file would overwrite each other (and both be recorded as done)
+    owners = {}
+    for job in jobs:
+        for output in get_outputs(job):
+            if output in owners:
+                raise ValueError(f"Jobs {get_job_id(owners[output])} and {get_job_id(job)} both write {output}")
+            owners[output] = job
+
+
+def load_manifest(path):
+    done = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                done[entry["job"]] = entry["outputs"]
+    return done
+
+
+def is_done(job, done):
+    job_id = get_job_id(job)
+    return job_id in done and all(os.path.exists(output) for output in done[job_id])
+
+
+def run_jobs(jobs, topics_files, manifest_path, workers):
+    check_outputs(jobs)
+    failed = []
+    written = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, topics_files): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                outputs = future.result()
+            except Exception as e:
+                print(f"Job failed: {get_job_id(job)}: {str(e)}")
+                traceback.print_exc()
+                failed.append(job)
+                continue
+
+            clashes = [output for output in outputs if written.get(output, job) is not job]
+            if clashes:
+                print(f"Job rejected: {get_job_id(job)} wrote {clashes}, also written by another job")
+                failed.append(job)
+                continue
+            written.update(dict.fromkeys(outputs, job))
+
+            print(f"Job finished: {get_job_id(job)} -> {outputs}")
+            with open(manifest_path, "a") as f:
+                f.write(json.dumps({"job": get_job_id(job), "outputs": outputs, "finished": time.time()}) + "\n")
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a grid of chatgpt.py tasks without the interactive menu")
+    parser.add_argument("--config", type=str, help="JSON file with any of the arguments below (the command line takes precedence)")
+    parser.add_argument("--corpora", nargs="+", choices=["2020", "2021", "2022", "clef"], default=["2020"])
+    parser.add_argument("--topics_types", nargs="+", choices=["original", "examples", "style", "basic", "trec"], default=["original"])
+    parser.add_argument("--topics_file", nargs="+", default=[], metavar="CORPUS=PATH",
+                        help="Original topics file of a corpus, instead of the default location")
+    parser.add_argument("--tasks", nargs="+", choices=list(TASK_PARAMS), default=["controversy_temp"])
+    parser.add_argument("--query_types", nargs="+", choices=["description", "title"], default=["description"])
+    parser.add_argument("--roles", nargs="+", type=str2bool, default=[True])
+    parser.add_argument("--narratives", nargs="+", type=str2bool, default=[True])
+    parser.add_argument("--chains_of_thought", nargs="+", type=int, choices=[0, 1, 2], default=[0])
+    parser.add_argument("--n", nargs="+", type=int, default=[5], help="Number of query variants")
+    parser.add_argument("--narrative_types", nargs="+", choices=["examples", "style", "basic", "trec"], default=["examples"])
+    parser.add_argument("--njudges", nargs="+", type=int, default=[1])
+    parser.add_argument("--samples", nargs="+", type=int, default=[1])
+    parser.add_argument("--factors", nargs="+", type=str2bool, default=[True])
+    parser.add_argument("--adaptive", nargs="+", type=str2bool, default=[False],
+                        help="Stop sampling a topic once its mean total controversy score is stable")
+    parser.add_argument("--tolerance", nargs="+", type=float, default=[1.0],
+                        help="Half-width of the 95%% confidence interval of the mean total score for adaptive sampling")
+    parser.add_argument("--pack_size", nargs="+", type=int, default=[None], help="Topics per packed request (automatic by default)")
+    parser.add_argument("--prompt_layout", nargs="+", choices=["legacy", "prefix"], default=["legacy"],
+                        help="Order of the prompts (see chatgpt.PROMPT_LAYOUT); the prefix results get a _prefix suffix")
+    parser.add_argument("--structured_outputs", nargs="+", type=str2bool, default=[True],
+                        help="JSON-schema constrained answers (see chatgpt.STRUCTURED_OUTPUTS); the free-text results get a _freetext suffix")
+    parser.add_argument("--workers", type=int, default=4, help="Jobs running at the same time")
+    parser.add_argument("--requests_per_minute", type=int, default=500, help="Limit shared by all the jobs")
+    parser.add_argument("--manifest", type=str, default="runs/manifest.jsonl")
+    parser.add_argument("--force", action="store_true", help="Run the jobs even if they are already done")
+    parser.add_argument("--dry_run", action="store_true", help="Only print the jobs")
+
+    args, _ = parser.parse_known_args(argv)
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        for key, value in config.items():
+            if GRID_ARGS.get(key) or key in ["corpora", "topics_types", "topics_file", "tasks"]:
+                config[key] = value if isinstance(value, list) else [value]
+        parser.set_defaults(**config)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    topics_files = dict(item.split("=", 1) for item in args.topics_file)
+
+    jobs = expand_grid(args)
+    check_outputs(jobs)
+    done = {} if args.force else load_manifest(args.manifest)
+    pending = [job for job in jobs if not is_done(job, done)]
+    print(f"{len(jobs)} jobs in the grid, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+    for job in pending:
+        print(get_job_id(job))
+    if args.dry_run or not pending:
+        exit()
+
+    parser = configparser.ConfigParser()
+    parser.read("config.ini")
+    chatgpt.client = create_client(parser)
+    chatgpt.rate_limiter = RateLimiter(args.requests_per_minute)
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    chatgpt.telemetry = Telemetry(f'telemetry/pipeline_{run_id}.jsonl')
+
+    if os.path.dirname(args.manifest):
+        os.makedirs(os.path.dirname(args.manifest), exist_ok=True)
+    for d in ["controversy_results", "query_scores", "generated_passages"]:
+        os.makedirs(d, exist_ok=True)
+
+    # The generated narratives are the topics of the other topic types, so they go first
+    narrative_jobs = [job for job in pending if job["task"] == "narratives"]
+    other_jobs = [job for job in pending if job["task"] != "narratives"]
+    failed = run_jobs(narrative_jobs, topics_files, args.manifest, args.workers)
+    failed += run_jobs(other_jobs, topics_files, args.manifest, args.workers)
+
+    chatgpt.telemetry.print_summary(chatgpt.telemetry.save_summary(f'telemetry/pipeline_{run_id}_summary.json'))
+    chatgpt.telemetry.close()
+    chatgpt.client.print_stats()
+    print(f"{len(pending) - len(failed)} jobs finished, {len(failed)} failed")
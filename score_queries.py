@@ -0,0 +1,177 @@
+"""
+Query Quality Classifier confidences for large query logs (millions of queries).
+
+The queries are streamed from a BEIR-style JSONL file ({"_id": ..., "text": ...} per line) or a
+plain text file (one query per line, its line number as id) and scored in chunks by N worker
+processes. Each worker has its own model (PyTorch or ONNX, see query_quality_classifier_onnx.py) and
+is pinned to its own slice of the cores, with as many threads as cores in the slice. At most
+--max_pending chunks are read ahead, and the results are appended to the CSV or Parquet output in
+the order of the input as soon as they are ready, so memory does not grow with the size of the log.
+Queries already in the confidence cache (see confidence_cache.py) are not scored again.
+
+Example:
+    python score_queries.py --input queries.jsonl --output confidences.parquet --workers 4
+    python score_queries.py --input queries.txt --output confidences.csv --workers 8 --backend onnx --onnx onnx_qqc/model.int8.onnx
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import numpy as np
+import pandas as pd
+
+import query_quality_classifier as qqc
+
+
+CHUNK_SIZE = 2048
+BATCH_SIZE = qqc.BATCH_SIZE
+
+
+def read_queries(path):
+    # Yields (id, text) for each query of a JSONL or plain text file
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    query = json.loads(line)
+                    yield str(query["_id"]), query["text"]
+        else:
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    yield str(number), line.strip()
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    chunk = []
+    for query in read_queries(path):
+        chunk.append(query)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def split_cores(workers):
+    # Disjoint slices of the available cores, one per worker
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if workers > len(cores):
+        print(f"Warning: {workers} workers for {len(cores)} cores, the workers will share cores")
+        return [cores] * workers
+    return [cores_slice.tolist() for cores_slice in np.array_split(cores, workers)]
+
+
+def init_worker(core_slices, model_name, backend, onnx_path, batch_size, cache_path):
+    # Runs once in each worker process: takes a slice of cores and loads a model
+    global BATCH_SIZE
+    cores = core_slices.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    if backend == "onnx":
+        from query_quality_classifier_onnx import load_onnx_model
+        qqc.tokenizer, qqc.model, qqc.device = load_onnx_model(onnx_path, threads=len(cores))
+    else:
+        qqc.tokenizer, qqc.model, qqc.device = qqc.load_model(model_name)
+    if cache_path:
+        qqc.open_cache(onnx_path if backend == "onnx" else model_name, cache_path, backend)
+    BATCH_SIZE = batch_size
+
+
+def score_chunk(chunk):
+    return qqc.classify_queries([text for _, text in chunk], batch_size=BATCH_SIZE)
+
+
+class ResultWriter:
+    # Appends the scored chunks to a CSV or Parquet file
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.writer = None
+        self.rows = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(self, chunk, confidences):
+        df = pd.DataFrame({"id": [query_id for query_id, _ in chunk], "query": [text for _, text in chunk],
+                           "confidence": confidences})
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            df.to_csv(self.path, mode="w" if self.rows == 0 else "a", header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def score_queries(input_path, output_path, workers=1, model_name=qqc.MODEL_NAME, backend="pytorch",
+                  onnx_path=None, chunk_size=CHUNK_SIZE, batch_size=qqc.BATCH_SIZE, max_pending=None, cache_path=None):
+    max_pending = max_pending or 2 * workers
+    # Forking a process that has loaded torch can deadlock its thread pools
+    context = multiprocessing.get_context("spawn")
+    # Every worker takes one slice from the queue when it starts
+    core_slices = context.Queue()
+    for cores in split_cores(workers):
+        core_slices.put(cores)
+
+    writer = ResultWriter(output_path)
+    pending = deque()
+    start = time.time()
+    last_report = start
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(core_slices, model_name, backend, onnx_path, batch_size, cache_path)) as executor:
+        def write_next():
+            chunk, future = pending.popleft()
+            writer.write(chunk, future.result())
+
+        try:
+            for chunk in read_chunks(input_path, chunk_size):
+                pending.append((chunk, executor.submit(score_chunk, chunk)))
+                # Bounded read-ahead: wait for the oldest chunk before reading more
+                while len(pending) >= max_pending:
+                    write_next()
+                    if time.time() - last_report > 10:
+                        last_report = time.time()
+                        print(f"{writer.rows} queries scored ({writer.rows / (last_report - start):.1f} queries/s)")
+            while pending:
+                write_next()
+        finally:
+            writer.close()
+
+    elapsed = time.time() - start
+    print(f"{writer.rows} queries scored in {elapsed:.1f}s ({writer.rows / elapsed:.1f} queries/s), written to {output_path}")
+    return writer.rows, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query Quality Classifier confidences for a large query log")
+    parser.add_argument("--input", type=str, required=True, help="BEIR-style .jsonl file or plain text file with one query per line")
+    parser.add_argument("--output", type=str, required=True, help=".csv or .parquet file")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes (each one with a slice of the cores)")
+    parser.add_argument("--model", type=str, default=qqc.MODEL_NAME, help="Hugging Face model name or local directory")
+    parser.add_argument("--backend", choices=["pytorch", "onnx"], default="pytorch")
+    parser.add_argument("--onnx", type=str, default="onnx_qqc/model.int8.onnx", help="ONNX model for --backend onnx")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="Queries sent to a worker at a time")
+    parser.add_argument("--batch_size", type=int, default=qqc.BATCH_SIZE)
+    parser.add_argument("--max_pending", type=int, default=None, help="Chunks read ahead (default: 2 per worker)")
+    parser.add_argument("--cache", type=str, default=qqc.CACHE_PATH, help="SQLite cache of confidences")
+    parser.add_argument("--no_cache", action="store_true", help="Score every query again")
+    args = parser.parse_args()
+
+    score_queries(args.input, args.output, workers=args.workers, model_name=args.model, backend=args.backend,
+                  onnx_path=args.onnx, chunk_size=args.chunk_size, batch_size=args.batch_size,
+                  max_pending=args.max_pending, cache_path=None if args.no_cache else args.cache)
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+# USD per million tokens
+PRICES = {
+    "gpt-4o": {"prompt": 2.50, "cached_prompt": 1.25, "completion": 10.00},
+}
+
+
+class Telemetry:
+    # Per-request log of the LLM calls of a run (one JSON line per request) and a summary at the end.
+    # Safe to share between threads
+
+    def __init__(self, log_path=None, model="gpt-4o"):
+        self.model = model
+        self.records = []
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.log_path = log_path
+        self.log_file = None
+        if log_path:
+            if os.path.dirname(log_path):
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+            self.log_file = open(log_path, "a")
+
+    def record(self, task=None, topic=None, prompt_tokens=0, completion_tokens=0, latency=0.0,
+               retries=0, cache_hit=False, error=None, cached_tokens=0):
+        rec = {
+            "timestamp": time.time(),
+            "task": task,
+            "topic": topic,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": latency,
+            "retries": retries,
+            "cache_hit": cache_hit,
+            "error": error
+        }
+        with self.lock:
+            self.records.append(rec)
+            if self.log_file:
+                self.log_file.write(json.dumps(rec) + "\n")
+                self.log_file.flush()
+        return rec
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+
+        elapsed = time.time() - self.start_time
+        latencies = np.array([r["latency"] for r in records if r["error"] is None])
+        prompt_tokens = sum(r["prompt_tokens"] for r in records)
+        cached_tokens = sum(r.get("cached_tokens", 0) for r in records)
+        completion_tokens = sum(r["completion_tokens"] for r in records)
+        prices = PRICES.get(self.model, PRICES["gpt-4o"])
+
+        summary = {
+            "model": self.model,
+            "requests": len(records),
+            "errors": sum(r["error"] is not None for r in records),
+            "retry_requests": sum(r["retries"] > 0 for r in records),
+            "cache_hits": sum(bool(r["cache_hit"]) for r in records),
+            "elapsed_seconds": elapsed,
+            "latency_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+            "requests_per_second": len(records) / elapsed if elapsed > 0 else None,
+            "tokens_per_second": (prompt_tokens + completion_tokens) / elapsed if elapsed > 0 else None,
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": cached_tokens,
+            "cached_prompt_fraction": cached_tokens / prompt_tokens if prompt_tokens else None,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "estimated_cost_usd": ((prompt_tokens - cached_tokens) * prices["prompt"] + cached_tokens * prices["cached_prompt"]
+                                   + completion_tokens * prices["completion"]) / 1e6,
+            "tasks": {}
+        }
+
+        for task in sorted(set(str(r["task"]) for r in records)):
+            task_records = [r for r in records if str(r["task"]) == task]
+            task_latencies = np.array([r["latency"] for r in task_records if r["error"] is None])
+            summary["tasks"][task] = {
+                "requests": len(task_records),
+                "errors": sum(r["error"] is not None for r in task_records),
+                "retry_requests": sum(r["retries"] > 0 for r in task_records),
+                "latency_p50": float(np.percentile(task_latencies, 50)) if len(task_latencies) else None,
+                "latency_p95": float(np.percentile(task_latencies, 95)) if len(task_latencies) else None,
+                "cached_prompt_tokens": sum(r.get("cached_tokens", 0) for r in task_records),
+                "total_tokens": sum(r["prompt_tokens"] + r["completion_tokens"] for r in task_records)
+            }
+        return summary
+
+    def print_summary(self, summary=None):
+        summary = summary or self.summary()
+        print("\nRun summary:")
+        print(f"Requests: {summary['requests']} ({summary['errors']} errors, {summary['retry_requests']} retries, "
+              f"{summary['cache_hits']} cache hits)")
+        if summary["latency_p50"] is not None:
+            print(f"Latency: p50 {summary['latency_p50']:.3f}s, p95 {summary['latency_p95']:.3f}s")
+        if summary["requests_per_second"] is not None:
+            print(f"Throughput: {summary['requests_per_second']:.3f} requests/s, {summary['tokens_per_second']:.1f} tokens/s")
+        print(f"Tokens: {summary['prompt_tokens']} prompt ({summary['cached_prompt_tokens']} cached) + "
+              f"{summary['completion_tokens']} completion = {summary['total_tokens']}")
+        print(f"Estimated cost: ${summary['estimated_cost_usd']:.4f}")
+        for task, task_summary in summary["tasks"].items():
+            print(f"  {task}: {task_summary['requests']} requests, {task_summary['errors']} errors, "
+                  f"{task_summary['retry_requests']} retries, {task_summary['total_tokens']} tokens "
+                  f"({task_summary['cached_prompt_tokens']} cached)")
+
+    def save_summary(self, path):
+        summary = self.summary()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def close(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+
+
+# Readers of TREC runs and qrels shared by the evaluation scripts. Topics and docnos are strings, unless
+# the binary store is open (see trec_store.open_store): then they are read from it, with categorical
+# topics and integer docno ids
+
+store = None
+
+
+def read_qrels(path):
+    # Qrels as a DataFrame with columns topic, docno, grade. Accepts the .tsv qrels of the repository
+    # (topic, docno, Grade with a header) and the TREC format (topic, iteration, docno, grade). Some of
+    # the derived qrels have their TREC lines quoted under a three-column header
+    if store is not None:
+        return store.read_qrels(path)
+    return parse_qrels(path)
+
+
+def parse_qrels(path):
+    with open(path) as f:
+        rows = [line.replace('"', "").split() for line in f]
+    rows = [row for row in rows if row]
+    if rows and not rows[0][-1].lstrip("-").isdigit():
+        rows = rows[1:]
+    if any(len(row) not in [3, 4] for row in rows):
+        raise ValueError(f"Unknown qrels format in {path}")
+    qrels = pd.DataFrame([(row[0], row[-2], int(row[-1])) for row in rows], columns=["topic", "docno", "grade"])
+    return qrels.drop_duplicates(["topic", "docno"], keep="last").reset_index(drop=True)
+
+
+def read_run(path, depth=None):
+    # Run as a DataFrame with columns topic, docno, score, rank (0-based), sorted as trec_eval does:
+    # by decreasing score, ties broken by decreasing docno. Accepts the TREC format (topic Q0 docno rank
+    # score tag) and CSV files with a header (qid/query_id/topic, docno/doc_id/docid, score)
+    if store is not None:
+        return store.read_run(path, depth)
+    return parse_run(path, depth)
+
+
+def parse_run(path, depth=None):
+    if path.endswith(".csv"):
+        run = pd.read_csv(path, dtype=str)
+        columns = {}
+        for column in run.columns:
+            name = column.strip().lower()
+            if name in ["qid", "query_id", "topic", "query"]:
+                columns[column] = "topic"
+            elif name in ["docno", "doc_id", "docid", "doc"]:
+                columns[column] = "docno"
+            elif name == "score":
+                columns[column] = "score"
+        run = run.rename(columns=columns)[["topic", "docno", "score"]]
+    else:
+        run = pd.read_csv(path, sep=r"\s+", header=None, dtype=str, usecols=[0, 2, 4], names=["topic", "docno", "score"])
+    run["score"] = run["score"].astype(float)
+
+    run = run.drop_duplicates(["topic", "docno"]).sort_values(["topic", "score", "docno"], ascending=[True, False, False])
+    run["rank"] = run.groupby("topic", sort=False).cumcount()
+    if depth is not None:
+        run = run[run["rank"] < depth]
+    return run.reset_index(drop=True)
+
+
+def sort_topics(topics):
+    # Numeric order for numeric topic ids
+    return sorted(topics, key=lambda topic: (0, int(topic), "") if topic.isdigit() else (1, 0, topic))
+
+
+def name(path):
+    # Name of a run or qrels file in the result tables: its basename, as in compatibility_results/ (the
+    # TREC qrels files have no extension, the CLEF ones keep .tsv)
+    return os.path.basename(path)
@@ -0,0 +1,175 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+import trec_io
+
+
+# Binary store of TREC runs and qrels, so the evaluators do not parse the text files and compare
+# string docnos every time. Topics and docnos are interned to integer ids (topics.txt and docnos.txt,
+# one per line, append-only), and every file is stored as .npy arrays grouped by topic:
+#   <key>.topics.npy   topic ids, increasing
+#   <key>.offsets.npy  start of each topic in the arrays below (one more than the topics)
+#   <key>.docs.npy     docno ids: in the order of trec_eval for runs (decreasing score, ties by
+#                      decreasing docno), increasing for qrels
+#   <key>.values.npy   scores of the runs, grades of the qrels
+# The arrays are memory-mapped when read. index.json maps the path of each file to its key, and a
+# file is stored again when its size or modification time change. Only one process should add files
+# at a time (the evaluators add them all before starting their workers)
+
+
+STORE_PATH = "./trec_store"
+
+
+class TrecStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, "index.json")
+        self.index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        self.topics = self.read_vocabulary("topics.txt")
+        self.topic_ids = {topic: i for i, topic in enumerate(self.topics)}
+        # Docnos are only needed to add files or to decode ids, so they are read when first used
+        self.docnos = None
+        self.docno_ids = None
+        self.topic_dtype = pd.CategoricalDtype(self.topics)
+
+    def read_vocabulary(self, name):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.read().split()
+
+    def intern(self, values, vocabulary, ids, name):
+        # Ids of the values, adding the new ones to the vocabulary (and to its file)
+        unique = pd.unique(values)
+        new = [value for value in unique if value not in ids]
+        if new:
+            with open(os.path.join(self.path, name), "a") as f:
+                f.write("".join(f"{value}\n" for value in new))
+            for value in new:
+                ids[value] = len(vocabulary)
+                vocabulary.append(value)
+        codes, uniques = pd.factorize(values)
+        return np.array([ids[value] for value in uniques], dtype=np.int32)[codes]
+
+    def load_docnos(self):
+        if self.docnos is None:
+            self.docnos = self.read_vocabulary("docnos.txt")
+            self.docno_ids = {docno: i for i, docno in enumerate(self.docnos)}
+
+    def stat(self, path):
+        info = os.stat(path)
+        return {"size": info.st_size, "mtime": info.st_mtime}
+
+    def add(self, path, kind):
+        # Parses a run or qrels file (kind "run" or "qrels") with trec_io and stores its arrays
+        table = trec_io.parse_run(path) if kind == "run" else trec_io.parse_qrels(path)
+        self.load_docnos()
+        topics = self.intern(table["topic"], self.topics, self.topic_ids, "topics.txt")
+        docs = self.intern(table["docno"], self.docnos, self.docno_ids, "docnos.txt")
+        self.topic_dtype = pd.CategoricalDtype(self.topics)
+        values = table["score"].to_numpy(dtype=np.float64) if kind == "run" else table["grade"].to_numpy(dtype=np.int32)
+
+        # Grouped by topic id, in the order of the run (already sorted by trec_io) or by docno id
+        order = np.lexsort((np.arange(len(docs)), topics) if kind == "run" else (docs, topics))
+        topics, docs, values = topics[order], docs[order], values[order]
+        topic_list, starts = np.unique(topics, return_index=True)
+        offsets = np.append(starts, len(topics)).astype(np.int64)
+
+        key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+        for name, array in [("topics", topic_list.astype(np.int32)), ("offsets", offsets), ("docs", docs),
+                            ("values", values)]:
+            np.save(os.path.join(self.path, f"{key}.{name}.npy"), array)
+        self.index[os.path.abspath(path)] = {"key": key, "kind": kind, **self.stat(path)}
+        index_path = os.path.join(self.path, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+
+    def ensure(self, path, kind):
+        # Stores the file if it is not in the store or changed since it was stored
+        entry = self.index.get(os.path.abspath(path))
+        if entry is None or entry["kind"] != kind or {k: entry[k] for k in ["size", "mtime"]} != self.stat(path):
+            self.add(path, kind)
+        return self.index[os.path.abspath(path)]["key"]
+
+    def arrays(self, path, kind):
+        # Memory-mapped topics, offsets, docs and values of a file
+        key = self.ensure(path, kind)
+        return [np.load(os.path.join(self.path, f"{key}.{name}.npy"), mmap_mode="r")
+                for name in ["topics", "offsets", "docs", "values"]]
+
+    def table(self, topics, offsets, docs, columns):
+        # DataFrame with a categorical topic column (shared categories, so joins compare integers)
+        # and the integer docno ids
+        counts = np.diff(offsets)
+        codes = np.repeat(np.asarray(topics), counts)
+        topic = pd.Categorical.from_codes(codes, dtype=self.topic_dtype)
+        return pd.DataFrame({"topic": topic, "docno": np.asarray(docs), **columns})
+
+    def read_run(self, path, depth=None):
+        # Same as trec_io.read_run, with docno ids
+        topics, offsets, docs, scores = self.arrays(path, "run")
+        rank = np.arange(len(docs)) - np.repeat(offsets[:-1], np.diff(offsets))
+        if depth is not None:
+            keep = rank < depth
+            # Offsets of the truncated run
+            offsets = np.append(0, np.cumsum(np.minimum(np.diff(offsets), depth)))
+            docs, scores, rank = np.asarray(docs)[keep], np.asarray(scores)[keep], rank[keep]
+        return self.table(topics, offsets, docs, {"score": np.asarray(scores), "rank": rank})
+
+    def read_qrels(self, path):
+        # Same as trec_io.read_qrels, with docno ids
+        topics, offsets, docs, grades = self.arrays(path, "qrels")
+        return self.table(topics, offsets, docs, {"grade": np.asarray(grades)})
+
+    def keys(self, topics, offsets, docs):
+        # One int64 per (topic, docno), increasing for qrels
+        return np.repeat(np.asarray(topics, dtype=np.int64), np.diff(offsets)) << 32 | np.asarray(docs)
+
+    def lookup(self, run_path, qrels_path, default=0):
+        # Grades of the documents of a run (in the order of the stored run), default if not judged
+        run_keys = self.keys(*self.arrays(run_path, "run")[:3])
+        topics, offsets, docs, grades = self.arrays(qrels_path, "qrels")
+        qrels_keys = self.keys(topics, offsets, docs)
+        grades = np.append(np.asarray(grades), default)
+        position = np.searchsorted(qrels_keys, run_keys)
+        found = qrels_keys[np.minimum(position, len(qrels_keys) - 1)] == run_keys if len(qrels_keys) else False
+        return grades[np.where(found, position, len(qrels_keys))]
+
+    def decode_docnos(self, ids):
+        self.load_docnos()
+        return [self.docnos[i] for i in ids]
+
+
+def open_store(path=STORE_PATH, runs=(), qrels=()):
+    # Makes trec_io.read_run and trec_io.read_qrels read from the store, after adding the given runs
+    # and qrels (so all the tables share the same topic categories)
+    store = TrecStore(path)
+    for paths, kind in [(runs, "run"), (qrels, "qrels")]:
+        for file_path in paths:
+            store.ensure(file_path, kind)
+    trec_io.store = store
+    return store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Adds TREC runs and qrels to the binary store")
+    parser.add_argument("--runs", nargs="*", default=[], help="Run files")
+    parser.add_argument("--qrels", nargs="*", default=[], help="Qrels files")
+    parser.add_argument("--store", type=str, default=STORE_PATH)
+    args = parser.parse_args()
+
+    store = open_store(args.store, args.runs, args.qrels)
+    store.load_docnos()
+    print(f"{len(store.index)} files, {len(store.topics)} topics and {len(store.docnos)} docnos in {args.store}")